@@ -0,0 +1,587 @@
+"""\
+Collection catalog stored in DynamoDB, with a local SQLite copy.
+
+Each ripped disc is recorded as a set of items in a single table, so questions
+about the collection are answered by indexed reads rather than by listing the
+S3 bucket and downloading every musicbrainz.json:
+
+    pk                  sk                  item
+    DISC#<disc-id>      DISC                the disc (MCN, release, position)
+    DISC#<disc-id>      TRACK#<nn>          a track (title, artist, ISRC)
+    DISC#<disc-id>      ARTIFACT#<key>      an object stored in S3
+    RELEASE#<mbid>      RELEASE             the release (title, artist, date)
+
+Two global secondary indexes cover the common lookups: by-release
+(release_pk, release_sk) finds the release and every disc and track on it,
+and by-artist (artist_pk, artist_sk) finds an artist's releases and tracks.
+
+Writes are coalesced into BatchWriteItem calls of up to 25 items; unprocessed
+items returned by DynamoDB are retried with jittered exponential backoff. An
+endpoint_url may be given to run against DynamoDB Local or another stand-in.
+
+SQLiteCatalog keeps the same items in a local database with indexes on disc
+ID, release ID, ISRC and artifact key plus a full-text index over titles and
+artist credits. It answers "have we already ripped this disc?" without a
+network round trip, and can be bootstrapped from an existing bucket by
+fetching every musicbrainz.json in parallel.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+from logging import getLogger
+from random import uniform
+import sqlite3
+from threading import Lock
+from time import sleep, time
+from typing import (
+    Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple)
+
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from boto3.session import Session
+
+from kanga.cdaudio.cd import DiscCodes
+from metadata import ReleaseIndex
+
+# pylint: disable=C0103,R0902,R0913
+
+BATCH_WRITE_MAX_ITEMS = 25
+DEFAULT_MAX_ATTEMPTS = 8
+DEFAULT_RETRY_BASE_DELAY = 0.05
+DEFAULT_RETRY_MAX_DELAY = 5.0
+
+RELEASE_INDEX = "by-release"
+ARTIST_INDEX = "by-artist"
+
+METADATA_FILENAME = "musicbrainz.json"
+DEFAULT_IMPORT_WORKERS = 16
+
+# Content types of the objects the ripper stores, by extension.
+CONTENT_TYPES = {
+    "cue": "text/plain",
+    "flac": "audio/flac",
+    "jpg": "image/jpeg",
+    "json": "application/json",
+    "log": "text/plain",
+    "m4a": "audio/mp4",
+    "mp3": "audio/mpeg",
+}
+
+log = getLogger(__name__)
+
+class CatalogError(Exception):
+    """
+    A catalog write could not be completed.
+    """
+
+def artist_key(artist: str) -> str:
+    """
+    Return the index key for an artist name; lookups are case-insensitive.
+    """
+    return "ARTIST#" + " ".join(artist.split()).casefold()
+
+def build_catalog_items(
+        disc_id: str, release: Mapping[str, Any], medium: Mapping[str, Any],
+        disc_index: int, tracks: Mapping[int, Mapping[str, Any]],
+        disc_codes: DiscCodes, artifacts: Mapping[str, str],
+        ripped: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Return the catalog items describing a ripped disc. release, medium and
+    tracks are the MusicBrainz structures chosen by the ripper (empty if the
+    disc was not found); artifacts maps S3 keys to content types.
+    """
+    ripped = time() if ripped is None else ripped
+    disc_pk = f"DISC#{disc_id}"
+    release_id = release.get("id")
+    release_pk = f"RELEASE#{release_id}" if release_id else None
+    release_artist = release.get("artist-credit-phrase")
+
+    disc: Dict[str, Any] = {
+        "pk": disc_pk, "sk": "DISC", "disc_id": disc_id,
+        "disc_index": disc_index, "track_count": len(tracks),
+        "ripped": int(ripped)}
+    if disc_codes.mcn:
+        disc["mcn"] = disc_codes.mcn
+    if medium.get("format"):
+        disc["format"] = medium["format"]
+    if release_pk:
+        disc["release_id"] = release_id
+        disc["release_pk"] = release_pk
+        disc["release_sk"] = f"DISC#{disc_index:03d}#{disc_id}"
+    items = [disc]
+
+    if release_pk:
+        item: Dict[str, Any] = {
+            "pk": release_pk, "sk": "RELEASE", "release_id": release_id,
+            "release_pk": release_pk, "release_sk": "RELEASE",
+            "medium_count": int(release.get("medium-count", 1))}
+        for attribute, field in (
+                ("title", "title"), ("date", "date"), ("country", "country"),
+                ("barcode", "barcode")):
+            if release.get(field):
+                item[attribute] = release[field]
+        if release_artist:
+            item["artist"] = release_artist
+            item["artist_pk"] = artist_key(release_artist)
+            item["artist_sk"] = f"RELEASE#{release.get('date', '')}#{release_id}"
+        items.append(item)
+
+    for number, track in sorted(tracks.items()):
+        recording = track.get("recording", {})
+        item = {
+            "pk": disc_pk, "sk": f"TRACK#{number:02d}", "disc_id": disc_id,
+            "track": number}
+        if recording.get("title"):
+            item["title"] = recording["title"]
+        if recording.get("id"):
+            item["recording_id"] = recording["id"]
+        isrc = (disc_codes.isrcs.get(number) or
+                (recording.get("isrc-list", []) + [None])[0])
+        if isrc:
+            item["isrc"] = isrc
+        artist = track.get("artist-credit-phrase") or release_artist
+        if artist:
+            item["artist"] = artist
+            item["artist_pk"] = artist_key(artist)
+            item["artist_sk"] = f"TRACK#{disc_id}#{number:02d}"
+        if release_pk:
+            item["release_pk"] = release_pk
+            item["release_sk"] = f"TRACK#{disc_index:03d}#{number:02d}"
+        items.append(item)
+
+    for key, content_type in sorted(artifacts.items()):
+        items.append({
+            "pk": disc_pk, "sk": f"ARTIFACT#{key}", "disc_id": disc_id,
+            "s3_key": key, "content_type": content_type})
+
+    return items
+
+class DynamoDBCatalog:
+    """
+    Read and write the collection catalog in a DynamoDB table.
+    """
+    def __init__(
+            self, boto: Session, table_name: str,
+            endpoint_url: Optional[str] = None,
+            max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+            retry_base_delay: float = DEFAULT_RETRY_BASE_DELAY,
+            retry_max_delay: float = DEFAULT_RETRY_MAX_DELAY) -> None:
+        super(DynamoDBCatalog, self).__init__()
+        self.table_name = table_name
+        self.client = boto.client("dynamodb", endpoint_url=endpoint_url)
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self._serializer = TypeSerializer()
+        self._deserializer = TypeDeserializer()
+
+    def ensure_table_exists(self) -> None:
+        """
+        Create the catalog table and its indexes if necessary.
+        """
+        try:
+            self.client.describe_table(TableName=self.table_name)
+            log.info("DynamoDB table %s exists", self.table_name)
+            return
+        except self.client.exceptions.ResourceNotFoundException:
+            pass
+
+        def index(name: str, prefix: str) -> Dict[str, Any]:
+            return {
+                "IndexName": name,
+                "KeySchema": [
+                    {"AttributeName": f"{prefix}_pk", "KeyType": "HASH"},
+                    {"AttributeName": f"{prefix}_sk", "KeyType": "RANGE"}],
+                "Projection": {"ProjectionType": "ALL"}}
+
+        log.info("Creating DynamoDB table %s", self.table_name)
+        self.client.create_table(
+            TableName=self.table_name,
+            BillingMode="PAY_PER_REQUEST",
+            AttributeDefinitions=[
+                {"AttributeName": name, "AttributeType": "S"}
+                for name in ("pk", "sk", "release_pk", "release_sk",
+                             "artist_pk", "artist_sk")],
+            KeySchema=[
+                {"AttributeName": "pk", "KeyType": "HASH"},
+                {"AttributeName": "sk", "KeyType": "RANGE"}],
+            GlobalSecondaryIndexes=[
+                index(RELEASE_INDEX, "release"), index(ARTIST_INDEX, "artist")])
+        self.client.get_waiter("table_exists").wait(TableName=self.table_name)
+
+    def batch_writer(self) -> "CatalogBatch":
+        """
+        Return a context manager that coalesces puts into batched writes,
+        flushing any remainder on exit.
+        """
+        return CatalogBatch(self)
+
+    def put_items(self, items: List[Dict[str, Any]]) -> None:
+        """
+        Write a list of items using as few BatchWriteItem calls as possible.
+        """
+        with self.batch_writer() as batch:
+            for item in items:
+                batch.put(item)
+
+    def get_disc(self, disc_id: str) -> List[Dict[str, Any]]:
+        """
+        Return the disc, track and artifact items for a disc; empty if the
+        disc has not been ripped.
+        """
+        return list(self._query(
+            KeyConditionExpression="pk = :pk",
+            ExpressionAttributeValues={":pk": {"S": f"DISC#{disc_id}"}}))
+
+    def has_disc(self, disc_id: str) -> bool:
+        """
+        Indicates whether a disc has already been ripped.
+        """
+        response = self.client.get_item(
+            TableName=self.table_name,
+            Key={"pk": {"S": f"DISC#{disc_id}"}, "sk": {"S": "DISC"}},
+            ProjectionExpression="pk")
+        return "Item" in response
+
+    def get_release(self, release_id: str) -> List[Dict[str, Any]]:
+        """
+        Return the release item followed by the disc and track items for
+        every ripped disc of a release.
+        """
+        return list(self._query(
+            IndexName=RELEASE_INDEX,
+            KeyConditionExpression="release_pk = :pk",
+            ExpressionAttributeValues={":pk": {"S": f"RELEASE#{release_id}"}}))
+
+    def get_artist_releases(self, artist: str) -> List[Dict[str, Any]]:
+        """
+        Return the release items for an artist, oldest first.
+        """
+        return list(self._query(
+            IndexName=ARTIST_INDEX,
+            KeyConditionExpression=(
+                "artist_pk = :pk AND begins_with(artist_sk, :prefix)"),
+            ExpressionAttributeValues={
+                ":pk": {"S": artist_key(artist)},
+                ":prefix": {"S": "RELEASE#"}}))
+
+    def get_artist_tracks(self, artist: str) -> List[Dict[str, Any]]:
+        """
+        Return the track items credited to an artist.
+        """
+        return list(self._query(
+            IndexName=ARTIST_INDEX,
+            KeyConditionExpression=(
+                "artist_pk = :pk AND begins_with(artist_sk, :prefix)"),
+            ExpressionAttributeValues={
+                ":pk": {"S": artist_key(artist)},
+                ":prefix": {"S": "TRACK#"}}))
+
+    def _query(self, **kw) -> Iterator[Dict[str, Any]]:
+        paginator = self.client.get_paginator("query")
+        for page in paginator.paginate(TableName=self.table_name, **kw):
+            for item in page.get("Items", []):
+                yield self.deserialize(item)
+
+    def serialize(self, item: Mapping[str, Any]) -> Dict[str, Any]:
+        """
+        Convert an item to DynamoDB's attribute-value format.
+        """
+        return {
+            name: self._serializer.serialize(value)
+            for name, value in item.items()}
+
+    def deserialize(self, item: Mapping[str, Any]) -> Dict[str, Any]:
+        """
+        Convert an item from DynamoDB's attribute-value format.
+        """
+        return {
+            name: self._deserializer.deserialize(value)
+            for name, value in item.items()}
+
+    def batch_write(self, requests: List[Dict[str, Any]]) -> None:
+        """
+        Send up to 25 write requests in a single BatchWriteItem call, retrying
+        any that DynamoDB leaves unprocessed.
+        """
+        pending = {self.table_name: requests}
+        attempt = 0
+        while pending:
+            attempt += 1
+            response = self.client.batch_write_item(RequestItems=pending)
+            pending = response.get("UnprocessedItems") or {}
+            if not pending:
+                return
+
+            remaining = sum(len(items) for items in pending.values())
+            if attempt >= self.max_attempts:
+                raise CatalogError(
+                    f"{remaining} catalog items unprocessed after {attempt} "
+                    f"attempts")
+
+            # Full jitter: wait a random time up to the exponential backoff.
+            delay = uniform(0, min(
+                self.retry_max_delay,
+                self.retry_base_delay * 2 ** (attempt - 1)))
+            log.debug("%d catalog items unprocessed; retrying in %.2fs",
+                      remaining, delay)
+            sleep(delay)
+
+class CatalogBatch:
+    """
+    Coalesce catalog puts into BatchWriteItem calls of up to 25 items.
+
+    A batch may not contain two writes to the same key, so a later put of a
+    key already buffered replaces the earlier one.
+    """
+    def __init__(self, catalog: DynamoDBCatalog) -> None:
+        super(CatalogBatch, self).__init__()
+        self.catalog = catalog
+        self._buffer: Dict[Tuple[str, str], Dict[str, Any]] = {}
+
+    def __enter__(self) -> "CatalogBatch":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.flush()
+
+    def put(self, item: Mapping[str, Any]) -> None:
+        """
+        Queue an item to be written.
+        """
+        key = (item["pk"], item["sk"])
+        if key not in self._buffer and (
+                len(self._buffer) >= BATCH_WRITE_MAX_ITEMS):
+            self.flush()
+        self._buffer[key] = {
+            "PutRequest": {"Item": self.catalog.serialize(item)}}
+
+    def flush(self) -> None:
+        """
+        Write all buffered items.
+        """
+        if self._buffer:
+            requests = list(self._buffer.values())
+            self._buffer = {}
+            self.catalog.batch_write(requests)
+
+class SQLiteCatalog:
+    """
+    Local catalog of ripped discs with full-text search.
+    """
+
+    def __init__(self, filename: str) -> None:
+        super(SQLiteCatalog, self).__init__()
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS discs(
+                    disc_id TEXT PRIMARY KEY,
+                    release_id TEXT,
+                    disc_index INTEGER NOT NULL,
+                    mcn TEXT,
+                    ripped REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS discs_release_id
+                    ON discs(release_id);
+                CREATE TABLE IF NOT EXISTS releases(
+                    release_id TEXT PRIMARY KEY,
+                    title TEXT,
+                    artist TEXT,
+                    date TEXT,
+                    country TEXT,
+                    barcode TEXT);
+                CREATE INDEX IF NOT EXISTS releases_barcode
+                    ON releases(barcode);
+                CREATE TABLE IF NOT EXISTS tracks(
+                    disc_id TEXT NOT NULL,
+                    track INTEGER NOT NULL,
+                    title TEXT,
+                    artist TEXT,
+                    isrc TEXT,
+                    recording_id TEXT,
+                    PRIMARY KEY (disc_id, track));
+                CREATE INDEX IF NOT EXISTS tracks_isrc ON tracks(isrc);
+                CREATE TABLE IF NOT EXISTS artifacts(
+                    s3_key TEXT PRIMARY KEY,
+                    disc_id TEXT NOT NULL,
+                    content_type TEXT);
+                CREATE INDEX IF NOT EXISTS artifacts_disc_id
+                    ON artifacts(disc_id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS search USING fts5(
+                    disc_id UNINDEXED, track UNINDEXED, title, artist);""")
+
+    def has_disc(self, disc_id: str) -> bool:
+        """
+        Indicates whether a disc has already been ripped.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT 1 FROM discs WHERE disc_id=?", (disc_id,)).fetchone()
+        return row is not None
+
+    def put_items(self, items: Sequence[Mapping[str, Any]]) -> None:
+        """
+        Record a disc from the items returned by build_catalog_items(),
+        replacing anything previously recorded for it.
+        """
+        disc_ids = {item["disc_id"] for item in items if item["sk"] == "DISC"}
+        with self.lock, self.db:
+            for disc_id in disc_ids:
+                for table in ("discs", "tracks", "artifacts", "search"):
+                    self.db.execute(
+                        f"DELETE FROM {table} WHERE disc_id=?", (disc_id,))
+
+            releases = {
+                item["release_id"]: item for item in items
+                if item["sk"] == "RELEASE"}
+            for item in items:
+                self._put_item(item, releases)
+
+    def _put_item(self, item: Mapping[str, Any],
+                  releases: Mapping[str, Mapping[str, Any]]) -> None:
+        kind = item["sk"].split("#", 1)[0]
+        get = item.get
+        if kind == "DISC":
+            self.db.execute(
+                "INSERT INTO discs VALUES (?, ?, ?, ?, ?)",
+                (item["disc_id"], get("release_id"), get("disc_index", 1),
+                 get("mcn"), get("ripped", time())))
+            release = releases.get(get("release_id"), {})
+            self.db.execute(
+                "INSERT INTO search VALUES (?, 0, ?, ?)",
+                (item["disc_id"], release.get("title"),
+                 release.get("artist")))
+        elif kind == "RELEASE":
+            self.db.execute(
+                "INSERT OR REPLACE INTO releases VALUES (?, ?, ?, ?, ?, ?)",
+                (item["release_id"], get("title"), get("artist"),
+                 get("date"), get("country"), get("barcode")))
+        elif kind == "TRACK":
+            self.db.execute(
+                "INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?)",
+                (item["disc_id"], item["track"], get("title"), get("artist"),
+                 get("isrc"), get("recording_id")))
+            self.db.execute(
+                "INSERT INTO search VALUES (?, ?, ?, ?)",
+                (item["disc_id"], item["track"], get("title"), get("artist")))
+        elif kind == "ARTIFACT":
+            self.db.execute(
+                "INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?)",
+                (item["s3_key"], item["disc_id"], get("content_type")))
+
+    def discs_for_release(self, release_id: str) -> List[str]:
+        """
+        Return the IDs of the ripped discs of a release.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT disc_id FROM discs WHERE release_id=? "
+                "ORDER BY disc_index", (release_id,)).fetchall()
+        return [row[0] for row in rows]
+
+    def discs_for_isrc(self, isrc: str) -> List[Tuple[str, int]]:
+        """
+        Return the (disc ID, track) pairs holding a recording.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT disc_id, track FROM tracks WHERE isrc=? "
+                "ORDER BY disc_id, track", (isrc.upper(),)).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def disc_for_artifact(self, s3_key: str) -> Optional[str]:
+        """
+        Return the ID of the disc an S3 object belongs to, if any.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT disc_id FROM artifacts WHERE s3_key=?",
+                (s3_key,)).fetchone()
+        return row[0] if row else None
+
+    def search(self, query: str, limit: int = 100
+              ) -> List[Tuple[str, int, str, str]]:
+        """
+        Full-text search titles and artist credits. Returns
+        (disc ID, track, title, artist) tuples, best matches first; track 0 is
+        the disc's release.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT disc_id, track, title, artist FROM search "
+                "WHERE search MATCH ? ORDER BY rank LIMIT ?",
+                (query, limit)).fetchall()
+        return [(row[0], int(row[1]), row[2], row[3]) for row in rows]
+
+    def import_bucket(
+            self, s3_client: Any, bucket_name: str, prefix: str = "",
+            country_preference: Sequence[str] = (),
+            max_workers: int = DEFAULT_IMPORT_WORKERS) -> int:
+        """
+        Bootstrap the catalog from a bucket written by the ripper. The bucket
+        is listed once, then every disc's musicbrainz.json is fetched in
+        parallel. Returns the number of discs imported.
+        """
+        artifacts: Dict[str, Dict[str, str]] = {}
+        paginator = s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                disc_id, _, name = obj["Key"][len(prefix):].partition("/")
+                if not name:
+                    continue
+                extension = name.rsplit(".", 1)[-1].lower()
+                artifacts.setdefault(disc_id, {})[obj["Key"]] = (
+                    CONTENT_TYPES.get(extension, "application/octet-stream"))
+
+        disc_ids = [
+            disc_id for disc_id, keys in artifacts.items()
+            if f"{prefix}{disc_id}/{METADATA_FILENAME}" in keys]
+        log.info("Importing %d discs from s3://%s/%s", len(disc_ids),
+                 bucket_name, prefix)
+
+        def fetch(disc_id: str) -> Dict[str, Any]:
+            response = s3_client.get_object(
+                Bucket=bucket_name, Key=f"{prefix}{disc_id}/{METADATA_FILENAME}")
+            return json.loads(response["Body"].read())
+
+        imported = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for disc_id, metadata in zip(
+                    disc_ids, executor.map(fetch, disc_ids)):
+                release, medium, disc_index = find_medium(
+                    metadata.get("disc", {}).get("release-list", []),
+                    disc_id, country_preference)
+                codes = metadata.get("disc-codes", {})
+                disc_codes = DiscCodes(
+                    mcn=codes.get("mcn"),
+                    isrcs={
+                        int(track): isrc
+                        for track, isrc in codes.get("isrcs", {}).items()})
+                tracks = {
+                    int(track["number"]): track
+                    for track in medium.get("track-list", [])
+                    if str(track.get("number", "")).isdigit()}
+                self.put_items(build_catalog_items(
+                    disc_id, release, medium, disc_index, tracks, disc_codes,
+                    artifacts[disc_id], ripped=0.0))
+                imported += 1
+
+        return imported
+
+def find_medium(
+        releases: Sequence[Mapping[str, Any]], disc_id: str,
+        country_preference: Sequence[str] = ()
+) -> Tuple[Mapping[str, Any], Mapping[str, Any], int]:
+    """
+    Return the (release, medium, disc index) holding a disc ID, preferring
+    releases from countries earlier in country_preference. Empty mappings are
+    returned if no medium lists the disc.
+    """
+    location = ReleaseIndex.build(releases, country_preference).find(disc_id)
+    if location is None:
+        return ({}, {}, 1)
+
+    release = releases[location[0]]
+    medium = release["medium-list"][location[1]]
+    return (release, medium, int(medium.get("position", 1)))
@@ -0,0 +1,288 @@
+"""\
+Loading of existing rips so they can be imported without re-reading discs.
+
+A rip is a directory holding either a cue sheet and the files it refers to
+(one WAV or FLAC file per track, or a single WAV/FLAC/BIN image), or just one
+WAV or FLAC file per track, named so they sort in track order. load_rip()
+reconstructs the disc's table of contents -- and so its MusicBrainz disc ID --
+from the cue sheet or, failing that, from the length of each file, and
+returns an ImageCDROMDrive serving the audio. The Ripper reads it like any
+other drive, so the rest of the pipeline (metadata lookup, encoding, upload
+and cataloging) is unchanged.
+
+Without a cue sheet, pregaps are assumed to be appended to the previous
+track's file, as the ripper and most ripping software write them; the disc
+ID is only right if the files were ripped that way.
+
+A rip is held in memory while it is imported: the image is assembled in a
+single buffer that the drive serves in place, and each file's audio is
+released once it has been copied in. Peak memory is about twice the disc's
+audio (up to roughly 1.6 GB for a full CD) while the image is assembled,
+and a single image file that needs no assembly is used as it is.
+"""
+
+from logging import getLogger
+import os
+from os.path import isdir, join, splitext
+from subprocess import run, PIPE
+from tempfile import TemporaryDirectory
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+import wave
+
+from kanga.cdaudio.cd import (
+    BYTES_PER_FRAME_RAW, LEADOUT_TRACK, DiscInformation, TrackFlags,
+    TrackInformation, TrackType)
+from kanga.cdaudio.cue import (
+    CUE_SECTOR_BYTES, CueError, cue_layout, parse_cue_sheet)
+from kanga.cdaudio.flac import read_wav_pcm
+from kanga.cdaudio.image import ImageCDROMDrive
+
+AUDIO_EXTENSIONS = (".flac", ".wav")
+CUE_EXTENSION = ".cue"
+
+log = getLogger(__name__)
+
+class RipImportError(Exception):
+    """
+    A directory could not be loaded as a rip.
+    """
+
+def is_rip_directory(directory: str) -> bool:
+    """
+    Indicates whether a directory holds a cue sheet or audio files.
+    """
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return False
+
+    return any(
+        splitext(name)[1].lower() in AUDIO_EXTENSIONS + (CUE_EXTENSION,)
+        for name in names)
+
+def find_rip_directories(roots: Iterable[str]) -> List[str]:
+    """
+    Return every rip directory at or below the given roots, in sorted order.
+    """
+    found: List[str] = []
+    for root in roots:
+        if not isdir(root):
+            raise RipImportError(f"Not a directory: {root}")
+
+        for directory, subdirectories, _ in os.walk(root):
+            subdirectories.sort()
+            if is_rip_directory(directory):
+                found.append(directory)
+    return found
+
+def read_cd_wav(wav_filename: str, filename: Optional[str] = None) -> bytes:
+    """
+    Read the PCM from a WAV file, raising RipImportError if it isn't CD audio
+    (16-bit stereo at 44.1 kHz). filename names the file in errors, if it
+    isn't wav_filename itself.
+    """
+    filename = filename or wav_filename
+    try:
+        return read_wav_pcm(wav_filename)
+    except ValueError as e:
+        raise RipImportError(f"{filename} is not CD audio") from e
+    except EOFError as e:
+        raise RipImportError(f"{filename} is truncated") from e
+    except wave.Error as e:
+        raise RipImportError(f"Unable to read {filename}: {e}") from e
+
+def decode_flac(filename: str) -> bytes:
+    """
+    Decode a FLAC file to 16-bit little-endian PCM using the flac binary.
+
+    The file is decoded to WAV rather than raw samples so its format is kept
+    and checked; raw output would silently pass through any bit depth, rate
+    or channel count.
+    """
+    with TemporaryDirectory() as tmpdir:
+        wav_filename = join(tmpdir, "decoded.wav")
+        cmd = ["flac", "--decode", "--silent", "--output-name", wav_filename,
+               filename]
+        cp = run(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        if cp.returncode != 0:
+            raise RipImportError(
+                f"Unable to decode {filename}: "
+                f"{cp.stderr.decode('utf-8', 'replace').strip()}")
+        return read_cd_wav(wav_filename, filename)
+
+def read_rip_file(
+        filename: str, file_type: str = "WAVE") -> Union[bytes, bytearray]:
+    """
+    Return the contents of a file referred to by a rip: PCM for WAV and FLAC
+    files, and the raw sectors for BINARY (little-endian) and MOTOROLA
+    (big-endian, byte-swapped here) images.
+    """
+    extension = splitext(filename)[1].lower()
+    if extension == ".flac":
+        return decode_flac(filename)
+    if extension == ".wav":
+        return read_cd_wav(filename)
+
+    with open(filename, "rb") as fd:
+        data = fd.read()
+
+    if file_type == "MOTOROLA":
+        swapped = bytearray(len(data) & ~1)
+        swapped[0::2] = data[1:len(swapped):2]
+        swapped[1::2] = data[0:len(swapped):2]
+        return swapped
+    return data
+
+def load_rip(directory: str) -> ImageCDROMDrive:
+    """
+    Load a rip directory into an image drive.
+    """
+    names = sorted(os.listdir(directory))
+    cue_names = [
+        name for name in names if splitext(name)[1].lower() == CUE_EXTENSION]
+    if cue_names:
+        if len(cue_names) > 1:
+            log.warning("%s has %d cue sheets; using %s", directory,
+                        len(cue_names), cue_names[0])
+        return _load_cue_rip(directory, cue_names[0])
+
+    audio_names = [
+        name for name in names
+        if splitext(name)[1].lower() in AUDIO_EXTENSIONS]
+    if not audio_names:
+        raise RipImportError(f"No cue sheet or audio files in {directory}")
+    return _load_track_files(directory, audio_names)
+
+def _pad_to_frames(
+        data: Union[bytes, bytearray], sector_bytes: int,
+        filename: str) -> Union[bytes, bytearray]:
+    """
+    Pad data to a whole number of sectors, warning if padding was needed.
+    """
+    remainder = len(data) % sector_bytes
+    if remainder:
+        log.warning("%s is not a whole number of sectors; padding %d bytes",
+                    filename, sector_bytes - remainder)
+        if not isinstance(data, bytearray):
+            data = bytearray(data)
+        data += bytes(sector_bytes - remainder)
+    return data
+
+def _load_cue_rip(directory: str, cue_name: str) -> ImageCDROMDrive:
+    """
+    Load a rip described by a cue sheet.
+    """
+    with open(join(directory, cue_name), "rb") as fd:
+        raw = fd.read()
+    try:
+        text = raw.decode("utf-8")
+    except UnicodeDecodeError:
+        text = raw.decode("latin-1")
+
+    try:
+        sheet = parse_cue_sheet(text)
+    except (CueError, ValueError) as e:
+        raise RipImportError(f"{join(directory, cue_name)}: {e}") from e
+
+    contents: Dict[str, Union[bytes, bytearray]] = {}
+    file_frames: Dict[str, int] = {}
+    for cue_file in sheet.files:
+        filename = _find_file(directory, cue_file.filename)
+        sector_bytes = CUE_SECTOR_BYTES.get(
+            cue_file.tracks[0].mode if cue_file.tracks else "AUDIO",
+            BYTES_PER_FRAME_RAW)
+        data = _pad_to_frames(
+            read_rip_file(filename, cue_file.file_type), sector_bytes,
+            filename)
+        file_frames[cue_file.filename] = len(data) // sector_bytes
+        if sector_bytes == BYTES_PER_FRAME_RAW:
+            contents[cue_file.filename] = data
+
+    try:
+        layout = cue_layout(sheet, file_frames)
+    except (CueError, KeyError) as e:
+        raise RipImportError(f"{join(directory, cue_name)}: {e}") from e
+
+    drive = ImageCDROMDrive(
+        _assemble_image(layout.segments, contents), layout.disc_information)
+    drive.track_indices.update(layout.track_indices)
+    drive.mcn = sheet.catalog
+    drive.isrcs = {
+        track.track: track.isrc for track in sheet.tracks if track.isrc}
+    return drive
+
+def _assemble_image(
+        segments: List[Tuple[Optional[str], int, int]],
+        contents: Dict[str, Union[bytes, bytearray]]
+) -> Union[bytes, bytearray]:
+    """
+    Lay the files' audio out as a disc image, emptying contents as each file
+    is copied in. Sectors from files in other formats (data tracks) are
+    never read as audio, so they are left as zeros.
+    """
+    if len(segments) == 1 and segments[0][0] is not None:
+        # A whole image file needs no copying.
+        source, first, count = segments[0]
+        data = contents.pop(source)
+        if first == 0 and count * BYTES_PER_FRAME_RAW == len(data):
+            return data
+        contents[source] = data
+
+    last_use = {
+        source: i for i, (source, _, _) in enumerate(segments)
+        if source is not None}
+    image = bytearray(
+        sum(count for _, _, count in segments) * BYTES_PER_FRAME_RAW)
+    view = memoryview(image)
+    position = 0
+    for i, (source, first, count) in enumerate(segments):
+        size = count * BYTES_PER_FRAME_RAW
+        data = contents.get(source) if source is not None else None
+        if data is not None:
+            start = first * BYTES_PER_FRAME_RAW
+            view[position:position + size] = memoryview(data)[
+                start:start + size]
+        if source is not None and last_use[source] == i:
+            contents.pop(source, None)
+        position += size
+    view.release()
+    return image
+
+def _find_file(directory: str, filename: str) -> str:
+    """
+    Locate a file named in a cue sheet. Sheets often name the file before
+    it was converted (e.g. a .wav that is now .flac) or use another case.
+    """
+    basename = filename.replace("\\", "/").rsplit("/", 1)[-1]
+    candidates = [basename] + [
+        splitext(basename)[0] + extension for extension in AUDIO_EXTENSIONS]
+    names = {name.lower(): name for name in os.listdir(directory)}
+    for candidate in candidates:
+        name = names.get(candidate.lower())
+        if name is not None:
+            return join(directory, name)
+    raise RipImportError(f"{filename} (named in the cue sheet) not found in "
+                         f"{directory}")
+
+def _load_track_files(
+        directory: str, audio_names: List[str]) -> ImageCDROMDrive:
+    """
+    Load a rip with one audio file per track and no cue sheet.
+    """
+    image = bytearray()
+    track_info: List[TrackInformation] = []
+    for track, name in enumerate(audio_names, 1):
+        filename = join(directory, name)
+        data = _pad_to_frames(
+            read_rip_file(filename), BYTES_PER_FRAME_RAW, filename)
+        track_info.append(TrackInformation(
+            track=track, track_type=TrackType.audio, flags=TrackFlags(0),
+            start_frame=len(image) // BYTES_PER_FRAME_RAW))
+        image += data
+
+    track_info.append(TrackInformation(
+        track=LEADOUT_TRACK, track_type=TrackType.leadout,
+        flags=TrackFlags(0), start_frame=len(image) // BYTES_PER_FRAME_RAW))
+    return ImageCDROMDrive(image, DiscInformation(
+        first_track=1, last_track=len(audio_names),
+        track_information=tuple(track_info)))
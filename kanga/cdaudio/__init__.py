@@ -1,5 +1,12 @@
 __all__ = [
-    "CDROMDrive", "DriveStatus", "LEADOUT_TRACK", "MSF", "TrackFlags", "TrackIndex", "TrackType",
+    "CDROMDrive", "DiscoveredDrive", "DriveCapability", "DriveStatus",
+    "ImageCDROMDrive", "LEADOUT_TRACK", "MSF", "SecureExtractor",
+    "SectorCache", "SubchannelQ", "TrackFlags", "TrackIndex", "TrackType",
+    "discover_drives",
 ]
-from .cd import LEADOUT_TRACK, MSF, TrackFlags, TrackIndex, TrackType
-from .drive import CDROMDrive, DriveStatus
+from .cd import (
+    LEADOUT_TRACK, MSF, SubchannelQ, TrackFlags, TrackIndex, TrackType)
+from .discovery import DiscoveredDrive, discover_drives
+from .drive import CDROMDrive, DriveCapability, DriveStatus
+from .extract import SecureExtractor, SectorCache
+from .image import ImageCDROMDrive
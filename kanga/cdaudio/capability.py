@@ -0,0 +1,317 @@
+"""
+Per-model drive capability profiles.
+
+Working out what a drive can do takes slow tests on a loaded disc: whether
+READ CD returns C2 error pointers, and whether the drive caches audio so
+re-reads must first be pushed out of its cache. The answers depend only on
+the drive's vendor, model and firmware, so DriveProfileCache records them
+in a JSON file the first time a drive is seen. Later sessions look the
+profile up and pick an extraction strategy without re-running the tests.
+
+A profile also records the drive's capability flags, its read offset in
+samples (when known; this cannot be detected without a reference disc, so it
+is usually entered by hand), and the fastest speed at which a track has been
+extracted without unrecoverable errors.
+"""
+import json
+from logging import getLogger
+import os
+from threading import RLock
+from time import monotonic, time
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .cd import BYTES_PER_FRAME_RAW, TrackType
+from .drive import CDROMDrive, DriveCapability, DriveIdentity, DriveStatus
+from .extract import CACHE_BUST_DISTANCE
+
+# pylint: disable=R0902,R0913
+
+# Frames timed when testing whether a drive caches audio.
+CACHE_TEST_FRAMES = 8
+
+# A re-read faster than this fraction of an uncached read was served from
+# the drive's cache.
+CACHE_TEST_RATIO = 0.25
+
+log = getLogger(__name__)
+
+class DriveProfile:
+    """
+    What a drive model supports, as detected by probe_profile(). Fields that
+    could not be determined are None.
+    """
+    __slots__ = (
+        "vendor", "model", "revision", "capabilities", "c2_pointers",
+        "caches_audio", "read_offset", "max_reliable_speed", "probed")
+
+    def __init__(
+            self, vendor: str, model: str, revision: str,
+            capabilities: DriveCapability = DriveCapability(0),
+            c2_pointers: Optional[bool] = None,
+            caches_audio: Optional[bool] = None,
+            read_offset: Optional[int] = None,
+            max_reliable_speed: Optional[int] = None,
+            probed: float = 0.0) -> None:
+        super(DriveProfile, self).__init__()
+        self.vendor = vendor
+        self.model = model
+        self.revision = revision
+        self.capabilities = capabilities
+        self.c2_pointers = c2_pointers
+        self.caches_audio = caches_audio
+        self.read_offset = read_offset
+        self.max_reliable_speed = max_reliable_speed
+        self.probed = probed
+
+    @property
+    def key(self) -> str:
+        """
+        The key identifying the drive model and firmware.
+        """
+        return str(DriveIdentity(self.vendor, self.model, self.revision))
+
+    @property
+    def complete(self) -> bool:
+        """
+        Whether every test that needs a disc has been run.
+        """
+        return self.c2_pointers is not None and self.caches_audio is not None
+
+    @property
+    def extraction_mode(self) -> str:
+        """
+        The fastest extraction mode that is valid for this drive: "secure"
+        (one pass, re-reading only flagged frames) if it returns C2 error
+        pointers, otherwise "cdparanoia".
+        """
+        return "secure" if self.c2_pointers else "cdparanoia"
+
+    @property
+    def defeat_drive_cache(self) -> bool:
+        """
+        Whether re-reads must first push the frame out of the drive's audio
+        cache. Assumed to be needed unless the drive is known not to cache.
+        """
+        return self.caches_audio is not False
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Return this profile as a JSON-serializable dict.
+        """
+        return {
+            "vendor": self.vendor, "model": self.model,
+            "revision": self.revision,
+            "capabilities": int(self.capabilities),
+            "c2_pointers": self.c2_pointers,
+            "caches_audio": self.caches_audio,
+            "read_offset": self.read_offset,
+            "max_reliable_speed": self.max_reliable_speed,
+            "probed": self.probed}
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "DriveProfile":
+        """
+        Create a DriveProfile from a dict produced by to_json().
+        """
+        return DriveProfile(
+            vendor=data["vendor"], model=data["model"],
+            revision=data["revision"],
+            capabilities=DriveCapability(int(data.get("capabilities", 0))),
+            c2_pointers=data.get("c2_pointers"),
+            caches_audio=data.get("caches_audio"),
+            read_offset=data.get("read_offset"),
+            max_reliable_speed=data.get("max_reliable_speed"),
+            probed=float(data.get("probed", 0.0)))
+
+def probe_profile(
+        drive: CDROMDrive, identity: Optional[DriveIdentity] = None,
+        profile: Optional[DriveProfile] = None,
+        clock: Callable[[], float] = monotonic) -> DriveProfile:
+    """
+    Detect what a drive supports. If profile is supplied, only the tests it
+    has no answer for are run. The C2 and caching tests need an audio disc
+    in the drive; without one, those fields are left as None.
+    """
+    if profile is None:
+        if identity is None:
+            identity = drive.get_identity()
+        profile = DriveProfile(
+            identity.vendor, identity.model, identity.revision)
+
+    try:
+        profile.capabilities = drive.get_capabilities()
+    except (IOError, NotImplementedError):
+        log.debug("Drive %s did not report its capabilities", profile.key,
+                  exc_info=True)
+
+    try:
+        ready = drive.get_status() == DriveStatus.ok
+    except (IOError, NotImplementedError):
+        ready = False
+
+    if ready and not profile.complete:
+        test_range = _audio_test_range(drive)
+        if test_range is not None:
+            start_frame, end_frame = test_range
+            if profile.c2_pointers is None:
+                profile.c2_pointers = _test_c2(drive, start_frame)
+            if profile.caches_audio is None:
+                profile.caches_audio = _test_caching(
+                    drive, start_frame, end_frame, clock)
+
+    profile.probed = time()
+    log.info("Drive %s: C2 pointers=%s, caches audio=%s, read offset=%s",
+             profile.key, profile.c2_pointers, profile.caches_audio,
+             profile.read_offset)
+    return profile
+
+def _audio_test_range(drive: CDROMDrive) -> Optional[Tuple[int, int]]:
+    """
+    Return the (start, end) frames of the longest audio track on the disc,
+    or None if there is none long enough to test with.
+    """
+    try:
+        disc_info = drive.get_disc_information()
+    except (IOError, NotImplementedError):
+        return None
+
+    best = None
+    tracks = disc_info.track_information
+    for track, next_track in zip(tracks, tracks[1:]):
+        if track.track_type != TrackType.audio:
+            continue
+        length = next_track.start_frame - track.start_frame
+        if best is None or length > best[1] - best[0]:
+            best = (track.start_frame, next_track.start_frame)
+
+    if best is None or best[1] - best[0] < 2 * CACHE_BUST_DISTANCE:
+        return None
+    return best
+
+def _test_c2(drive: CDROMDrive, frame: int) -> bool:
+    """
+    Indicates whether READ CD with C2 error pointers succeeds.
+    """
+    try:
+        audio, c2 = drive.read_audio_c2(frame, 1)
+    except (IOError, NotImplementedError):
+        return False
+    return len(audio) == BYTES_PER_FRAME_RAW and bool(c2)
+
+def _test_caching(
+        drive: CDROMDrive, start_frame: int, end_frame: int,
+        clock: Callable[[], float]) -> Optional[bool]:
+    """
+    Time a re-read of frames just read against a read of frames never read,
+    each after a seek across the same span of the disc so both pay the same
+    seek. A drive that caches audio serves the re-read much faster.
+    """
+    near = start_frame + CACHE_TEST_FRAMES
+    far = end_frame - CACHE_TEST_FRAMES
+    fresh = far - CACHE_TEST_FRAMES
+    try:
+        # Spin up and read the test frames, then seek back to them from the
+        # far end of the track.
+        drive.read_audio(near, CACHE_TEST_FRAMES)
+        drive.read_audio(far, CACHE_TEST_FRAMES)
+        began = clock()
+        drive.read_audio(near, CACHE_TEST_FRAMES)
+        reread = clock() - began
+
+        # Seek the same distance out to frames just short of the far ones,
+        # which read-ahead past them can't have fetched.
+        began = clock()
+        drive.read_audio(fresh, CACHE_TEST_FRAMES)
+        uncached = clock() - began
+    except (IOError, NotImplementedError):
+        log.debug("Cache test failed", exc_info=True)
+        return None
+
+    return reread < uncached * CACHE_TEST_RATIO
+
+class DriveProfileCache:
+    """
+    Drive profiles keyed by vendor, model and firmware, optionally persisted
+    to a JSON file.
+    """
+    def __init__(self, filename: Optional[str] = None) -> None:
+        super(DriveProfileCache, self).__init__()
+        self.filename = filename
+        self._profiles: Dict[str, DriveProfile] = {}
+        self._lock = RLock()
+
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def load(self) -> None:
+        """
+        Replace the in-memory profiles with the contents of the profile file.
+        """
+        if self.filename is None:
+            raise ValueError("No profile filename specified")
+
+        with open(self.filename, "r") as fd:
+            data = json.load(fd)
+
+        with self._lock:
+            self._profiles = {
+                key: DriveProfile.from_json(profile)
+                for key, profile in data.items()}
+
+    def save(self) -> None:
+        """
+        Write the profiles to the profile file, replacing it atomically.
+        """
+        if self.filename is None:
+            return
+
+        with self._lock:
+            data = {
+                key: profile.to_json()
+                for key, profile in self._profiles.items()}
+
+            temp_filename = f"{self.filename}.tmp"
+            with open(temp_filename, "w") as fd:
+                json.dump(data, fd, indent=2, sort_keys=True)
+            os.replace(temp_filename, self.filename)
+
+    def get(self, identity: DriveIdentity) -> Optional[DriveProfile]:
+        """
+        Return the stored profile for a drive model, if any.
+        """
+        with self._lock:
+            return self._profiles.get(str(identity))
+
+    def get_profile(
+            self, drive: CDROMDrive,
+            identity: Optional[DriveIdentity] = None) -> DriveProfile:
+        """
+        Return the profile for a drive, probing it (and saving the result) if
+        the model has not been seen before or an earlier probe could not
+        finish because no disc was loaded.
+        """
+        if identity is None:
+            identity = drive.get_identity()
+
+        with self._lock:
+            profile = self._profiles.get(str(identity))
+            if profile is not None and profile.complete:
+                return profile
+
+        log.info("Probing capabilities of drive %s", identity)
+        profile = probe_profile(drive, identity, profile)
+        with self._lock:
+            self._profiles[profile.key] = profile
+            self.save()
+        return profile
+
+    def record_speed(self, profile: DriveProfile, speed: int) -> None:
+        """
+        Record that a track was extracted at speed without unrecoverable
+        errors, raising the profile's maximum reliable speed if needed.
+        """
+        with self._lock:
+            if (profile.max_reliable_speed is None or
+                    speed > profile.max_reliable_speed):
+                profile.max_reliable_speed = speed
+                self.save()
@@ -4,14 +4,17 @@ Constants in the CD audio world.
 from base64 import b64encode
 from enum import auto, Enum, IntFlag
 from hashlib import sha1
-from typing import NamedTuple, Tuple
+from typing import Dict, NamedTuple, Optional, Tuple
 
 SECONDS_PER_MINUTE = 60
 FRAMES_PER_SECOND = 75
 FRAMES_PER_MINUTE = FRAMES_PER_SECOND * SECONDS_PER_MINUTE
 BYTES_PER_FRAME = 2048      # Bytes per frame without error correction headers
 BYTES_PER_FRAME_RAW = 2352  # Bytes per frame with error correction headers
+C2_BYTES_PER_FRAME = 294    # C2 error pointer bytes per frame (1 bit/byte)
+SUBCHANNEL_Q_BYTES = 16     # Formatted Q subchannel bytes per frame
 GAP_FRAMES = 150            # Standard leadin gap size
+SESSION_GAP_FRAMES = 11400  # Leadout + leadin + pregap between sessions
 
 TRACK_MAX = 99
 INDEX_MAX = 99
@@ -82,6 +85,34 @@ class DiscInformation(NamedTuple):
             b64encode(hasher.digest(), altchars=b"._").replace(b"=", b"-")
             .decode("ascii"))
 
+    def get_track_frames(self, track: int) -> Tuple[int, int]:
+        """
+        Return the [start, end) frame range occupied by the specified track.
+
+        If the following track is a data track in a later session (i.e. this
+        is an Enhanced CD), the inter-session gap is excluded from the range.
+        """
+        for i, info in enumerate(self.track_information[:-1]):
+            if info.track != track:
+                continue
+
+            following = self.track_information[i + 1]
+            end_frame = following.start_frame
+            if (info.track_type == TrackType.audio and
+                    following.track_type == TrackType.data):
+                end_frame -= SESSION_GAP_FRAMES
+
+            return (info.start_frame, end_frame)
+
+        raise ValueError(f"Track {track} is not on this disc")
+
+class DiscCodes(NamedTuple):
+    """
+    Identification codes recorded in a disc's Q subchannel.
+    """
+    mcn: Optional[str]          # Media catalog number (UPC/EAN), if recorded
+    isrcs: Dict[int, str]       # Track number -> ISRC, for tracks that have one
+
 class MSF(NamedTuple):
     """
     Position on a disc specified in minutes, seconds, and frames.
@@ -159,5 +190,116 @@ class TrackIndex:
         """
         return self._index
 
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, TrackIndex):
+            return NotImplemented
+
+        return (self._track, self._index) == (other._track, other._index)
+
+    def __lt__(self, other: "TrackIndex") -> bool:
+        if not isinstance(other, TrackIndex):
+            return NotImplemented
+
+        return (self._track, self._index) < (other._track, other._index)
+
+    def __hash__(self) -> int:
+        return hash((self._track, self._index))
+
     def __repr__(self) -> str:
         return f"TrackIndex(track={self.track}, index={self.index})"
+
+# Q subchannel ADR (mode) values
+Q_ADR_POSITION = 1
+Q_ADR_MCN = 2
+Q_ADR_ISRC = 3
+
+def bcd_to_int(value: int) -> int:
+    """
+    Convert a packed binary-coded decimal byte to an integer.
+    """
+    return (value >> 4) * 10 + (value & 0x0f)
+
+def int_to_bcd(value: int) -> int:
+    """
+    Convert an integer between 0 and 99 to a packed binary-coded decimal byte.
+    """
+    return ((value // 10) << 4) | (value % 10)
+
+def crc16_ccitt(data: bytes) -> int:
+    """
+    Compute the CRC-16/CCITT (polynomial 0x1021, initial value 0) used to
+    protect the Q subchannel.
+    """
+    crc = 0
+    for byte in data:
+        crc ^= byte << 8
+        for _ in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xffff
+            else:
+                crc = (crc << 1) & 0xffff
+    return crc
+
+class SubchannelQ(NamedTuple):
+    """
+    Mode 1 (position) data decoded from the Q subchannel of a frame.
+    """
+    control: int
+    track: int
+    index: int
+    relative: MSF           # Position within the track; counts down in pregaps
+    absolute: MSF           # Position on the disc, including the 2s leadin gap
+
+    @property
+    def track_index(self) -> TrackIndex:
+        """
+        The track and index this frame belongs to.
+        """
+        return TrackIndex(self.track, self.index)
+
+    @staticmethod
+    def from_bytes(data: bytes, check_crc: bool = True
+                  ) -> Optional["SubchannelQ"]:
+        """
+        Decode a 12+ byte formatted Q subchannel block. Returns None if the
+        block does not hold position data or fails its CRC check.
+        """
+        if len(data) < 12:
+            raise ValueError("Q subchannel data must be at least 12 bytes")
+
+        if (data[0] & 0x0f) != Q_ADR_POSITION:
+            return None
+
+        if check_crc:
+            expected = (data[10] << 8) | data[11]
+            if crc16_ccitt(data[:10]) ^ 0xffff != expected:
+                return None
+
+        track = bcd_to_int(data[1])
+        if track == 0 or track > TRACK_MAX:
+            # Track 0 is the leadin; anything else is corrupt.
+            return None
+
+        return SubchannelQ(
+            control=(data[0] >> 4) & 0x0f,
+            track=track,
+            index=bcd_to_int(data[2]),
+            relative=MSF(bcd_to_int(data[3]), bcd_to_int(data[4]),
+                         bcd_to_int(data[5])),
+            absolute=MSF(bcd_to_int(data[7]), bcd_to_int(data[8]),
+                         bcd_to_int(data[9])))
+
+    def to_bytes(self) -> bytes:
+        """
+        Encode this position as a 12-byte formatted Q subchannel block,
+        including its CRC.
+        """
+        body = bytes([
+            (self.control << 4) | Q_ADR_POSITION,
+            int_to_bcd(self.track), int_to_bcd(self.index),
+            int_to_bcd(self.relative.minute), int_to_bcd(self.relative.second),
+            int_to_bcd(self.relative.frame), 0,
+            int_to_bcd(self.absolute.minute), int_to_bcd(self.absolute.second),
+            int_to_bcd(self.absolute.frame)])
+        crc = crc16_ccitt(body) ^ 0xffff
+        return body + bytes([crc >> 8, crc & 0xff])
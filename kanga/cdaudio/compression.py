@@ -0,0 +1,335 @@
+"""
+Adaptive FLAC compression level selection.
+
+Higher FLAC compression levels store audio in less space but take longer to
+encode. The CompressionPolicy measures how fast each level encodes on this
+host and how fast audio is being extracted, and picks the highest level whose
+encode throughput (across every encoder worker) keeps up with extraction, so
+the queue of tracks waiting to be encoded stays bounded. Observations and the
+last level chosen are recorded per host in a CompressionHistory, so later
+sessions start from what this machine is known to sustain.
+"""
+import json
+from logging import getLogger
+import os
+from socket import gethostname
+from threading import RLock
+from typing import Any, Dict, Optional
+
+from .flac import DEFAULT_COMPRESSION_LEVEL
+
+# pylint: disable=R0902,R0913
+
+MIN_COMPRESSION_LEVEL = 0
+MAX_COMPRESSION_LEVEL = 8
+
+# Encode capacity required relative to the extraction rate.
+DEFAULT_HEADROOM = 1.25
+
+# Weight retained by older observations each time one is added, so the
+# throughput follows changes in load (or hardware) on the host.
+DEFAULT_DECAY = 0.95
+
+# Seconds of audio encoded at a level before its throughput is trusted.
+MIN_HISTORY_AUDIO_SECONDS = 60.0
+
+log = getLogger(__name__)
+
+class ThroughputRecord:
+    """
+    Decayed totals of audio processed and the time it took.
+    """
+    __slots__ = ("audio_seconds", "seconds")
+
+    def __init__(self, audio_seconds: float = 0.0,
+                 seconds: float = 0.0) -> None:
+        super(ThroughputRecord, self).__init__()
+        self.audio_seconds = audio_seconds
+        self.seconds = seconds
+
+    @property
+    def throughput(self) -> float:
+        """
+        Seconds of audio processed per second of wall-clock time.
+        """
+        if self.seconds <= 0.0:
+            return 0.0
+
+        return self.audio_seconds / self.seconds
+
+    def add(self, audio_seconds: float, seconds: float,
+            decay: float = DEFAULT_DECAY) -> None:
+        """
+        Add an observation, decaying the weight of earlier ones.
+        """
+        self.audio_seconds = self.audio_seconds * decay + audio_seconds
+        self.seconds = self.seconds * decay + seconds
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Return this record as a JSON-serializable dict.
+        """
+        return {"audio_seconds": self.audio_seconds, "seconds": self.seconds}
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "ThroughputRecord":
+        """
+        Create a ThroughputRecord from a dict produced by to_json().
+        """
+        return ThroughputRecord(
+            audio_seconds=float(data.get("audio_seconds", 0.0)),
+            seconds=float(data.get("seconds", 0.0)))
+
+class HostRecord:
+    """
+    Extraction and per-level encode throughput observed on a single host,
+    and the compression level last chosen there.
+    """
+    __slots__ = ("level", "extraction", "encode")
+
+    def __init__(self, level: Optional[int] = None,
+                 extraction: Optional[ThroughputRecord] = None,
+                 encode: Optional[Dict[int, ThroughputRecord]] = None
+                ) -> None:
+        super(HostRecord, self).__init__()
+        self.level = level
+        self.extraction = (
+            extraction if extraction is not None else ThroughputRecord())
+        self.encode: Dict[int, ThroughputRecord] = (
+            encode if encode is not None else {})
+
+    def encode_throughput(self, level: int) -> Optional[float]:
+        """
+        The encode throughput of a single worker at a level, or None if too
+        little has been encoded at it to judge.
+        """
+        record = self.encode.get(level)
+        if record is None or record.audio_seconds < MIN_HISTORY_AUDIO_SECONDS:
+            return None
+
+        return record.throughput
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Return this record as a JSON-serializable dict.
+        """
+        return {
+            "level": self.level, "extraction": self.extraction.to_json(),
+            "encode": {
+                str(level): record.to_json()
+                for level, record in self.encode.items()}}
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "HostRecord":
+        """
+        Create a HostRecord from a dict produced by to_json().
+        """
+        level = data.get("level")
+        return HostRecord(
+            level=int(level) if level is not None else None,
+            extraction=ThroughputRecord.from_json(data.get("extraction", {})),
+            encode={
+                int(level): ThroughputRecord.from_json(record)
+                for level, record in data.get("encode", {}).items()})
+
+class CompressionHistory:
+    """
+    Per-host compression observations, optionally persisted to a JSON file.
+    A single file may be shared by hosts ripping to the same collection.
+    """
+    def __init__(self, filename: Optional[str] = None) -> None:
+        super(CompressionHistory, self).__init__()
+        self.filename = filename
+        self._hosts: Dict[str, HostRecord] = {}
+        self._lock = RLock()
+
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def load(self) -> None:
+        """
+        Replace the in-memory history with the contents of the history file.
+        """
+        if self.filename is None:
+            raise ValueError("No history filename specified")
+
+        with open(self.filename, "r") as fd:
+            data = json.load(fd)
+
+        self._hosts = {
+            host: HostRecord.from_json(record)
+            for host, record in data.items()}
+
+    def save(self) -> None:
+        """
+        Write the history to the history file, replacing it atomically.
+        """
+        if self.filename is None:
+            return
+
+        with self._lock:
+            data = {
+                host: record.to_json() for host, record in self._hosts.items()}
+
+            temp_filename = f"{self.filename}.tmp"
+            with open(temp_filename, "w") as fd:
+                json.dump(data, fd, indent=2, sort_keys=True)
+            os.replace(temp_filename, self.filename)
+
+    def get(self, host: str) -> HostRecord:
+        """
+        Return the record for the specified host, creating it if necessary.
+        """
+        with self._lock:
+            record = self._hosts.get(host)
+            if record is None:
+                record = HostRecord()
+                self._hosts[host] = record
+            return record
+
+class CompressionPolicy:
+    """
+    Choose the FLAC compression level for each track.
+
+    A level keeps up if workers encoding at its measured throughput can
+    process audio headroom times faster than it is being extracted. The
+    highest such level is chosen; if the next level up has not been measured
+    and the encoders are not backed up, it is tried instead. If no measured
+    level keeps up, the level below the fastest measured one is tried. While
+    more than max_queue tracks are waiting to be encoded, one level lower is
+    used so the backlog drains.
+    """
+    def __init__(
+            self, history: Optional[CompressionHistory] = None,
+            host: Optional[str] = None, workers: int = 1,
+            min_level: int = MIN_COMPRESSION_LEVEL,
+            max_level: int = MAX_COMPRESSION_LEVEL,
+            initial_level: int = DEFAULT_COMPRESSION_LEVEL,
+            headroom: float = DEFAULT_HEADROOM,
+            max_queue: Optional[int] = None,
+            decay: float = DEFAULT_DECAY) -> None:
+        super(CompressionPolicy, self).__init__()
+        if not (MIN_COMPRESSION_LEVEL <= min_level <= max_level <=
+                MAX_COMPRESSION_LEVEL):
+            raise ValueError(
+                f"Invalid compression level range: {min_level}-{max_level}")
+
+        self.history = history if history is not None else (
+            CompressionHistory())
+        self.host = host if host is not None else gethostname()
+        self.workers = max(1, workers)
+        self.min_level = min_level
+        self.max_level = max_level
+        self.initial_level = min(max(initial_level, min_level), max_level)
+        self.headroom = headroom
+        self.max_queue = (
+            max_queue if max_queue is not None else 2 * self.workers)
+        self.decay = decay
+        self._queued = 0
+        self._lock = RLock()
+
+    @property
+    def queued(self) -> int:
+        """
+        The number of tracks submitted for encoding that have not finished.
+        """
+        return self._queued
+
+    def submitted(self) -> None:
+        """
+        Note that a track has been queued for encoding.
+        """
+        with self._lock:
+            self._queued += 1
+
+    def finished(self) -> None:
+        """
+        Note that a track queued for encoding has finished (or failed).
+        """
+        with self._lock:
+            self._queued = max(0, self._queued - 1)
+
+    def record_extraction(self, audio_seconds: float, seconds: float) -> None:
+        """
+        Record that audio_seconds of audio took seconds to extract.
+        """
+        if audio_seconds <= 0.0 or seconds <= 0.0:
+            return
+
+        with self._lock:
+            self.history.get(self.host).extraction.add(
+                audio_seconds, seconds, self.decay)
+
+    def record_encode(
+            self, level: int, audio_seconds: float, seconds: float) -> None:
+        """
+        Record that audio_seconds of audio took seconds to encode at a level.
+        """
+        if audio_seconds <= 0.0 or seconds <= 0.0:
+            return
+
+        with self._lock:
+            record = self.history.get(self.host)
+            level_record = record.encode.get(level)
+            if level_record is None:
+                level_record = ThroughputRecord()
+                record.encode[level] = level_record
+            level_record.add(audio_seconds, seconds, self.decay)
+
+    def choose_level(self) -> int:
+        """
+        Return the level to encode the next track at.
+        """
+        with self._lock:
+            record = self.history.get(self.host)
+            level = self._rate_level(record)
+
+            if self._queued > self.max_queue and level > self.min_level:
+                level -= 1
+
+            if level != record.level:
+                log.info("Using FLAC compression level %d on %s (%d tracks "
+                         "queued, extracting at %.1fx)", level, self.host,
+                         self._queued, record.extraction.throughput)
+                record.level = level
+            return level
+
+    def finish(self) -> None:
+        """
+        Persist the history at the end of a disc.
+        """
+        self.history.save()
+
+    def _rate_level(self, record: HostRecord) -> int:
+        """
+        Return the level chosen by comparing encode and extraction rates.
+        """
+        extraction = record.extraction.throughput
+        if extraction <= 0.0:
+            # Nothing extracted yet; start where this host left off.
+            level = record.level if record.level is not None else (
+                self.initial_level)
+            return min(max(level, self.min_level), self.max_level)
+
+        required = extraction * self.headroom / self.workers
+        measured = {
+            level: throughput
+            for level, throughput in (
+                (level, record.encode_throughput(level))
+                for level in range(self.min_level, self.max_level + 1))
+            if throughput is not None}
+
+        if not measured:
+            return self.initial_level
+
+        keeping_up = [
+            level for level, throughput in measured.items()
+            if throughput >= required]
+        if not keeping_up:
+            return max(self.min_level, min(measured) - 1)
+
+        level = max(keeping_up)
+        if (level < self.max_level and level + 1 not in measured and
+                self._queued <= self.workers):
+            level += 1
+        return level
@@ -0,0 +1,189 @@
+"""
+Offset-normalized hashing of CD audio content.
+
+Two rips of the same recording made on drives with different read offsets
+hold the same samples shifted by up to a few hundred samples, with a little
+audio from the neighbouring track at one end. A plain hash of the PCM
+therefore differs between them. PCMContentHasher instead hashes the samples
+between two content-defined anchor points: digital silence at either end is
+skipped, the first and last MAX_OFFSET_SAMPLES of audio are discarded, and
+each end is anchored within an ANCHOR_WINDOW_SAMPLES window next to the
+discarded region. The anchor is the occurrence of the window's peak sample
+value whose surrounding samples hash lowest, so it is unique even on clipped
+masters where the peak value recurs. Shifting the audio moves both anchors
+with it, so the same samples are hashed unless an anchor lies within the
+shift of a window edge, which merely causes a missed match.
+
+Everything between the anchors is hashed, and the windows are kept short, so
+at most MAX_OFFSET_SAMPLES + ANCHOR_WINDOW_SAMPLES (a third of a second) of
+audio at each end goes unhashed. Recordings that differ only within that
+much of either end -- after trimming digital silence -- hash the same.
+"""
+from array import array
+from hashlib import sha256
+from sys import byteorder
+from typing import Optional, Union
+
+from .flac import BYTES_PER_SAMPLE_FRAME
+
+MAX_OFFSET_SAMPLES = 2940           # 5 frames; larger than any drive offset
+ANCHOR_WINDOW_SAMPLES = 4 * MAX_OFFSET_SAMPLES  # 0.27 seconds
+
+# Sample frames around a peak hashed to choose between equal peaks.
+ANCHOR_CONTEXT_SAMPLES = 16
+
+# Audio held back until the end anchor can be chosen.
+_TAIL_SAMPLES = MAX_OFFSET_SAMPLES + ANCHOR_WINDOW_SAMPLES
+_TAIL_BYTES = _TAIL_SAMPLES * BYTES_PER_SAMPLE_FRAME
+
+class PCMContentHasher:
+    """
+    Incrementally compute an offset-normalized SHA-256 hash of 16-bit stereo
+    PCM. Feed audio with update() as it is extracted, then call hexdigest().
+    """
+    def __init__(self) -> None:
+        super(PCMContentHasher, self).__init__()
+        self._hasher = sha256()
+        self._head = bytearray()    # Audio before the start anchor is known
+        self._tail = bytearray()    # Audio not yet known to precede the end
+        self._started = False       # Whether the start anchor has been found
+        self._audible: Optional[int] = None # First non-silent sample in head
+        self._digest: Optional[str] = None
+
+    def update(self, pcm: bytes) -> None:
+        """
+        Add the next chunk of PCM data.
+        """
+        if self._digest is not None:
+            raise ValueError("hexdigest() has already been called")
+
+        if not self._started:
+            self._head.extend(pcm)
+            self._find_start()
+            return
+
+        self._tail.extend(pcm)
+        self._flush_tail()
+
+    def hexdigest(self) -> str:
+        """
+        Finish hashing and return the hex digest. Tracks too short to anchor
+        are hashed with only digital silence removed.
+        """
+        if self._digest is not None:
+            return self._digest
+
+        if not self._started:
+            # A short track: split what lies between the discarded regions
+            # into two anchor windows.
+            audio = _strip_silence(bytes(self._head))
+            audio_len = len(audio) // BYTES_PER_SAMPLE_FRAME
+            window = (audio_len - 2 * MAX_OFFSET_SAMPLES) // 2
+            if window > 0:
+                start = _peak(
+                    audio, MAX_OFFSET_SAMPLES, MAX_OFFSET_SAMPLES + window)
+                end = _peak(
+                    audio, MAX_OFFSET_SAMPLES + window,
+                    audio_len - MAX_OFFSET_SAMPLES)
+                audio = audio[start * BYTES_PER_SAMPLE_FRAME:
+                              end * BYTES_PER_SAMPLE_FRAME]
+            self._hasher.update(audio)
+        else:
+            tail = bytes(self._tail)
+            window_end = _last_audible(tail) - MAX_OFFSET_SAMPLES
+            window_start = max(0, window_end - ANCHOR_WINDOW_SAMPLES)
+            end = 0
+            if window_end > window_start:
+                end = _peak(tail, window_start, window_end)
+            self._hasher.update(tail[:end * BYTES_PER_SAMPLE_FRAME])
+
+        self._digest = self._hasher.hexdigest()
+        return self._digest
+
+    def _find_start(self) -> None:
+        if self._audible is None:
+            self._audible = _first_audible(self._head)
+            if self._audible is None:
+                # All silence so far; nothing worth keeping.
+                self._head.clear()
+                return
+
+        window_start = self._audible + MAX_OFFSET_SAMPLES
+        window_end = window_start + ANCHOR_WINDOW_SAMPLES
+        if len(self._head) < window_end * BYTES_PER_SAMPLE_FRAME:
+            return
+
+        head = bytes(self._head)
+        anchor = _peak(head, window_start, window_end)
+        self._started = True
+        self._tail = bytearray(head[anchor * BYTES_PER_SAMPLE_FRAME:])
+        self._head = bytearray()
+        self._flush_tail()
+
+    def _flush_tail(self) -> None:
+        # Only flush once the tail has doubled so trimming it stays cheap.
+        excess = len(self._tail) - _TAIL_BYTES
+        if excess >= _TAIL_BYTES:
+            excess -= excess % BYTES_PER_SAMPLE_FRAME
+            self._hasher.update(self._tail[:excess])
+            del self._tail[:excess]
+
+def _samples(pcm: bytes) -> array:
+    samples = array("h")
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % BYTES_PER_SAMPLE_FRAME])
+    if byteorder == "big":
+        samples.byteswap()
+    return samples
+
+def _first_audible(pcm: Union[bytes, bytearray]) -> Optional[int]:
+    """
+    Return the index of the first sample frame that is not digital silence.
+    """
+    stripped = len(pcm) - len(pcm.lstrip(b"\0"))
+    if stripped == len(pcm):
+        return None
+    return stripped // BYTES_PER_SAMPLE_FRAME
+
+def _last_audible(pcm: bytes) -> int:
+    """
+    Return one past the index of the last sample frame that is not digital
+    silence.
+    """
+    return -(-len(pcm.rstrip(b"\0")) // BYTES_PER_SAMPLE_FRAME)
+
+def _strip_silence(pcm: bytes) -> bytes:
+    start = _first_audible(pcm)
+    if start is None:
+        return b""
+    return pcm[start * BYTES_PER_SAMPLE_FRAME:
+               _last_audible(pcm) * BYTES_PER_SAMPLE_FRAME]
+
+def _peak(pcm: bytes, start: int, end: int) -> int:
+    """
+    Return the index of the anchor sample frame in [start, end): among the
+    samples holding the window's largest-magnitude value, the one whose
+    surrounding samples have the lowest hash.
+    """
+    samples = _samples(
+        pcm[start * BYTES_PER_SAMPLE_FRAME:end * BYTES_PER_SAMPLE_FRAME])
+    highest = max(samples)
+    lowest = min(samples)
+    peak = highest if highest >= -lowest else lowest
+
+    best: Optional[bytes] = None
+    best_index = 0
+    index = samples.index(peak)
+    while True:
+        frame = start + index // 2
+        context = sha256(pcm[
+            max(0, frame - ANCHOR_CONTEXT_SAMPLES) * BYTES_PER_SAMPLE_FRAME:
+            (frame + ANCHOR_CONTEXT_SAMPLES) * BYTES_PER_SAMPLE_FRAME
+        ]).digest()
+        if best is None or context < best:
+            best = context
+            best_index = frame
+
+        try:
+            index = samples.index(peak, index + 1)
+        except ValueError:
+            return best_index
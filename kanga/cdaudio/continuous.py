@@ -0,0 +1,244 @@
+"""
+Whole-disc extraction in a single sequential pass.
+
+Extracting track by track makes the drive stop, seek and spin back up around
+every track boundary. Reading each run of adjacent audio tracks in one pass
+avoids that; TrackSplitter then cuts the stream at the track boundaries in
+the table of contents and hands back each track as soon as its last sector
+has been read, so encoding and uploading overlap with the rest of the read.
+It can also hand back each track a piece at a time as the stream arrives, so
+per-track analysis (loudness, content hashing) keeps pace with the read
+rather than starting once the track is complete.
+
+A drive's read offset shifts the audio it returns by a fixed number of
+samples. If one is given, TrackSplitter moves every boundary by that many
+samples, so samples that belong to the next (or previous) track end up in
+the right place. Samples that would have to come from outside the run (the
+lead-in or lead-out, which most drives cannot read) are filled with silence.
+"""
+from logging import getLogger
+from typing import (
+    Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple)
+
+from .cd import BYTES_PER_FRAME_RAW, DiscInformation, TrackType
+from .drive import CDROMDrive
+from .extract import DEFAULT_BATCH_FRAMES, SILENT_FRAME
+from .flac import BYTES_PER_SAMPLE_FRAME
+
+log = getLogger(__name__)
+
+class TrackSpan(NamedTuple):
+    """
+    The [start_frame, end_frame) range occupied by a track.
+    """
+    track: int
+    start_frame: int
+    end_frame: int
+
+class TrackPiece(NamedTuple):
+    """
+    The next piece of a track's audio; complete is set on its last piece.
+    """
+    track: int
+    pcm: bytes
+    complete: bool
+
+def contiguous_audio_runs(
+        disc_info: DiscInformation) -> List[List[TrackSpan]]:
+    """
+    Return the audio tracks on a disc grouped into runs that can be read in
+    one pass: each track in a run starts where the previous one ends.
+    """
+    runs: List[List[TrackSpan]] = []
+    for info in disc_info.track_information:
+        if info.track_type != TrackType.audio:
+            continue
+
+        start_frame, end_frame = disc_info.get_track_frames(info.track)
+        span = TrackSpan(info.track, start_frame, end_frame)
+        if runs and runs[-1][-1].end_frame == start_frame:
+            runs[-1].append(span)
+        else:
+            runs.append([span])
+    return runs
+
+class TrackSplitter:
+    """
+    Split PCM read sequentially from a run of adjacent tracks into tracks.
+
+    read_offset is the drive's read offset in samples; the audio for a
+    track's first sample is read_offset samples after the nominal start of
+    the track. read_limits is the [start, end) range of frames that may be
+    read, by default the run itself; passing the bounds of a longer run lets
+    a single track be split out with its neighbours' samples, rather than
+    silence, at its edges. Read frames [read_start, read_end) and pass the
+    data, in order, to feed() or split() for whole tracks, or to
+    feed_pieces() or split_pieces() for tracks a piece at a time; don't mix
+    the two.
+    """
+    def __init__(
+            self, tracks: Sequence[TrackSpan], read_offset: int = 0,
+            read_limits: Optional[Tuple[int, int]] = None) -> None:
+        super(TrackSplitter, self).__init__()
+        if not tracks:
+            raise ValueError("No tracks to split")
+
+        for previous, track in zip(tracks, tracks[1:]):
+            if previous.end_frame != track.start_frame:
+                raise ValueError(
+                    f"Track {track.track} does not start where track "
+                    f"{previous.track} ends")
+
+        self.tracks = list(tracks)
+        self.offset_bytes = read_offset * BYTES_PER_SAMPLE_FRAME
+
+        # Read whole frames covering the shifted run, but not beyond the read
+        # limits.
+        if read_limits is None:
+            read_limits = (tracks[0].start_frame, tracks[-1].end_frame)
+        first_byte = tracks[0].start_frame * BYTES_PER_FRAME_RAW
+        last_byte = tracks[-1].end_frame * BYTES_PER_FRAME_RAW
+        self.read_start = max(
+            read_limits[0],
+            (first_byte + self.offset_bytes) // BYTES_PER_FRAME_RAW)
+        self.read_end = min(
+            read_limits[1],
+            -(-(last_byte + self.offset_bytes) // BYTES_PER_FRAME_RAW))
+
+        self._next = 0
+        self._buffer = bytearray()
+        self._buffer_start = self.read_start * BYTES_PER_FRAME_RAW
+        self._position = first_byte + self.offset_bytes
+        self._pieces: List[bytes] = []
+
+    def feed(self, data: bytes) -> List[Tuple[int, bytes]]:
+        """
+        Add the next piece of the stream, returning (track, pcm) for each
+        track that is now complete.
+        """
+        return self._join(self.feed_pieces(data))
+
+    def finish(self) -> List[Tuple[int, bytes]]:
+        """
+        Return the remaining tracks once the stream has ended. Any audio the
+        stream did not supply is filled with silence.
+        """
+        return self._join(self.finish_pieces())
+
+    def split(
+            self, chunks: Iterable[bytes]) -> Iterator[Tuple[int, bytes]]:
+        """
+        Split a stream of chunks, yielding (track, pcm) for each track as soon
+        as it is complete.
+        """
+        for chunk in chunks:
+            yield from self.feed(chunk)
+        yield from self.finish()
+
+    def feed_pieces(self, data: bytes) -> List[TrackPiece]:
+        """
+        Add the next piece of the stream, returning the track audio it
+        completes or extends.
+        """
+        self._buffer += data
+        return self._emit(final=False)
+
+    def finish_pieces(self) -> List[TrackPiece]:
+        """
+        Return the rest of the tracks' audio once the stream has ended. Any
+        audio the stream did not supply is filled with silence.
+        """
+        expected = (self.read_end * BYTES_PER_FRAME_RAW -
+                    self._buffer_start)
+        if len(self._buffer) != expected:
+            log.warning("Stream ended %d bytes %s the end of track %d",
+                        abs(len(self._buffer) - expected),
+                        "short of" if len(self._buffer) < expected
+                        else "beyond", self.tracks[-1].track)
+        return self._emit(final=True)
+
+    def split_pieces(self, chunks: Iterable[bytes]) -> Iterator[TrackPiece]:
+        """
+        Split a stream of chunks, yielding each piece of track audio as soon
+        as it has been read.
+        """
+        for chunk in chunks:
+            yield from self.feed_pieces(chunk)
+        yield from self.finish_pieces()
+
+    def _join(self, pieces: Iterable[TrackPiece]) -> List[Tuple[int, bytes]]:
+        """
+        Gather pieces into whole tracks.
+        """
+        result = []
+        for piece in pieces:
+            self._pieces.append(piece.pcm)
+            if piece.complete:
+                result.append((piece.track, b"".join(self._pieces)))
+                self._pieces = []
+        return result
+
+    def _emit(self, final: bool) -> List[TrackPiece]:
+        """
+        Cut the audio available for the current track, and every track after
+        it that is complete, out of the buffer.
+        """
+        result = []
+        while self._next < len(self.tracks):
+            track = self.tracks[self._next]
+            end = track.end_frame * BYTES_PER_FRAME_RAW + self.offset_bytes
+            buffer_end = self._buffer_start + len(self._buffer)
+
+            # Audio before the start of the stream is silence, as is audio
+            # after its end once it has finished.
+            lead = max(0, min(end, self._buffer_start) - self._position)
+            available = min(end, buffer_end)
+            pcm = bytes(lead) + bytes(self._buffer[
+                max(0, self._position - self._buffer_start):
+                max(0, available - self._buffer_start)])
+            self._position = max(self._position + lead, available)
+            if final and self._position < end:
+                pcm += bytes(end - self._position)
+                self._position = end
+
+            # Drop what has been handed back, and anything before it.
+            drop = min(self._position, buffer_end) - self._buffer_start
+            if drop > 0:
+                del self._buffer[:drop]
+                self._buffer_start += drop
+
+            complete = self._position == end
+            if pcm or complete:
+                result.append(TrackPiece(track.track, pcm, complete))
+            if not complete:
+                break
+            self._next += 1
+        return result
+
+def read_sequential(
+        drive: CDROMDrive, start_frame: int, end_frame: int,
+        batch_frames: int = DEFAULT_BATCH_FRAMES,
+        failed_frames: Optional[List[int]] = None) -> Iterator[bytes]:
+    """
+    Read frames [start_frame, end_frame) in order without error detection,
+    yielding the audio a batch at a time. Frames that cannot be read are
+    returned as silence and, if failed_frames is supplied, appended to it.
+    """
+    for batch_start in range(start_frame, end_frame, batch_frames):
+        count = min(batch_frames, end_frame - batch_start)
+        try:
+            yield drive.read_audio(batch_start, count)
+            continue
+        except IOError:
+            log.debug("Read of frames %d-%d failed", batch_start,
+                      batch_start + count, exc_info=True)
+
+        # Narrow the failure down to the frames responsible.
+        for frame in range(batch_start, batch_start + count):
+            try:
+                yield drive.read_audio(frame, 1)
+            except IOError:
+                log.warning("Unable to read frame %d", frame)
+                if failed_frames is not None:
+                    failed_frames.append(frame)
+                yield SILENT_FRAME
@@ -0,0 +1,365 @@
+"""
+Cue sheet generation and parsing.
+
+parse_cue_sheet() reads the cue sheets written alongside existing rips (one
+file per track, or a single image file) and cue_layout() turns one into the
+disc's table of contents, given the length of each file it refers to.
+"""
+from re import compile as re_compile
+from typing import (
+    Callable, Dict, List, Mapping, NamedTuple, Optional, Tuple)
+
+from .cd import (
+    BYTES_PER_FRAME, BYTES_PER_FRAME_RAW, LEADOUT_TRACK, MSF,
+    SESSION_GAP_FRAMES, DiscCodes, DiscInformation, TrackFlags, TrackIndex,
+    TrackInformation, TrackType)
+
+# Bytes per sector stored in an image file for each cue track mode.
+CUE_SECTOR_BYTES = {
+    "AUDIO": BYTES_PER_FRAME_RAW,
+    "CDG": 2448,
+    "MODE1/2048": BYTES_PER_FRAME,
+    "MODE1/2352": BYTES_PER_FRAME_RAW,
+    "MODE2/2336": 2336,
+    "MODE2/2352": BYTES_PER_FRAME_RAW,
+    "CDI/2336": 2336,
+    "CDI/2352": BYTES_PER_FRAME_RAW,
+}
+
+CUE_FLAGS = {
+    "4CH": TrackFlags.QUAD_CHANNEL,
+    "DCP": TrackFlags.COPY_PERMITTED,
+    "PRE": TrackFlags.PREEMPHASIS,
+}
+
+CUE_FILE_RE = re_compile(r'^FILE\s+(?:"(?P<quoted>[^"]*)"|(?P<bare>\S+))'
+                         r'\s+(?P<type>\S+)$')
+CUE_MSF_RE = re_compile(r"^(?P<m>[0-9]+):(?P<s>[0-9]{1,2}):(?P<f>[0-9]{1,2})$")
+
+class CueError(ValueError):
+    """
+    A cue sheet could not be parsed or laid out.
+    """
+
+class CueTrack(NamedTuple):
+    """
+    A TRACK entry. indices map index numbers to frame offsets within the file
+    each index appears in; index_files map index numbers to that file's
+    position in CueSheet.files. A track's pregap (index 0) is often at the
+    end of the previous file. pregap is the length of a PREGAP (silence not
+    stored in any file).
+    """
+    track: int
+    mode: str
+    flags: TrackFlags
+    isrc: Optional[str]
+    indices: Dict[int, int]
+    index_files: Dict[int, int]
+    pregap: int
+
+    @property
+    def track_type(self) -> TrackType:
+        """
+        Whether this is an audio or a data track.
+        """
+        return TrackType.audio if self.mode == "AUDIO" else TrackType.data
+
+class CueFile(NamedTuple):
+    """
+    A FILE entry and the tracks whose index 1 it holds.
+    """
+    filename: str
+    file_type: str
+    tracks: List[CueTrack]
+
+class CueSheet(NamedTuple):
+    """
+    A parsed cue sheet.
+    """
+    catalog: Optional[str]
+    files: List[CueFile]
+
+    @property
+    def tracks(self) -> List[CueTrack]:
+        """
+        Every track on the sheet, in order.
+        """
+        return [track for cue_file in self.files for track in cue_file.tracks]
+
+class CueLayout(NamedTuple):
+    """
+    A cue sheet laid out on a disc. segments lists, in disc order from frame
+    0, the (filename, first frame, frame count) runs that make up the disc's
+    contents; a filename of None is silence that is not stored in any file.
+    """
+    disc_information: DiscInformation
+    track_indices: Dict[TrackIndex, int]
+    segments: List[Tuple[Optional[str], int, int]]
+
+def default_track_filename(track: int) -> str:
+    """
+    The per-track filename used by the ripper: NN.flac.
+    """
+    return f"{track:02d}.flac"
+
+def format_cue_sheet(
+        disc_information: DiscInformation,
+        track_indices: Mapping[TrackIndex, int],
+        track_filename: Callable[[int], str] = default_track_filename,
+        file_type: str = "WAVE",
+        rem: Optional[Mapping[str, str]] = None,
+        codes: Optional[DiscCodes] = None) -> str:
+    """
+    Format a cue sheet describing a disc ripped to one file per track.
+
+    Each track's file runs from its index 1 to the next track's index 1, so
+    pregaps are appended to the end of the previous track's file (the layout
+    produced by get_track_frames()). Index positions are relative to the
+    start of the file containing them.
+
+    If codes is supplied, the media catalog number and track ISRCs are
+    included.
+    """
+    lines: List[str] = []
+    for key, value in (rem or {}).items():
+        lines.append(f"REM {key} {value}")
+
+    if codes is not None and codes.mcn:
+        lines.append(f"CATALOG {codes.mcn}")
+    isrcs = codes.isrcs if codes is not None else {}
+
+    # Group indices by track for quick lookup.
+    indices_by_track: Dict[int, Dict[int, int]] = {}
+    for track_index, frame in track_indices.items():
+        indices_by_track.setdefault(track_index.track, {})[
+            track_index.index] = frame
+
+    file_start = 0
+    have_file = False
+    for info in disc_information.track_information:
+        if info.track_type != TrackType.audio:
+            continue
+
+        indices = indices_by_track.get(info.track, {1: info.start_frame})
+        index_1 = indices.get(1, info.start_frame)
+
+        # The pregap, if any, is still in the previous track's file.
+        pregap = indices.get(0)
+        if pregap is not None and have_file and pregap < index_1:
+            lines.append(f"  TRACK {info.track:02d} AUDIO")
+            _append_track_info(lines, info.flags, isrcs.get(info.track))
+            lines.append(f"    INDEX 00 {_cue_msf(pregap - file_start)}")
+            lines.append(f'FILE "{track_filename(info.track)}" {file_type}')
+        else:
+            lines.append(f'FILE "{track_filename(info.track)}" {file_type}')
+            lines.append(f"  TRACK {info.track:02d} AUDIO")
+            _append_track_info(lines, info.flags, isrcs.get(info.track))
+
+        have_file = True
+        file_start = index_1
+        lines.append("    INDEX 01 00:00:00")
+        for index in sorted(indices):
+            if index > 1:
+                lines.append(
+                    f"    INDEX {index:02d} "
+                    f"{_cue_msf(indices[index] - file_start)}")
+
+    return "\n".join(lines) + "\n"
+
+def _append_track_info(
+        lines: List[str], flags: TrackFlags, isrc: Optional[str]) -> None:
+    names = []
+    if flags & TrackFlags.COPY_PERMITTED:
+        names.append("DCP")
+    if flags & TrackFlags.QUAD_CHANNEL:
+        names.append("4CH")
+    if flags & TrackFlags.PREEMPHASIS:
+        names.append("PRE")
+
+    if names:
+        lines.append(f"    FLAGS {' '.join(names)}")
+
+    if isrc:
+        lines.append(f"    ISRC {isrc}")
+
+def _cue_msf(frame: int) -> str:
+    msf = MSF.from_lba(frame)
+    return f"{msf.minute:02d}:{msf.second:02d}:{msf.frame:02d}"
+
+def _parse_msf(value: str) -> int:
+    m = CUE_MSF_RE.match(value)
+    if not m:
+        raise CueError(f"Invalid MM:SS:FF position: {value!r}")
+
+    msf = MSF(int(m.group("m")), int(m.group("s")), int(m.group("f")))
+    if not msf.is_valid:
+        raise CueError(f"Invalid MM:SS:FF position: {value!r}")
+    return msf.lba
+
+def parse_cue_sheet(text: str) -> CueSheet:
+    """
+    Parse a cue sheet. Commands that do not affect the disc layout or its
+    codes (TITLE, PERFORMER, REM, ...) are ignored.
+    """
+    catalog: Optional[str] = None
+    files: List[CueFile] = []
+    track: Optional[Dict] = None
+
+    def finish_track() -> None:
+        # A track stays open across FILE lines, so it is only complete at
+        # the next TRACK or the end of the sheet.
+        if track is None:
+            return
+        if 1 not in track["indices"]:
+            raise CueError(f"Track {track['track']} has no INDEX 01")
+        files[track["index_files"][1]].tracks.append(CueTrack(**track))
+
+    for line_number, line in enumerate(text.splitlines(), 1):
+        line = line.strip().lstrip("\ufeff")
+        if not line:
+            continue
+
+        command, _, rest = line.partition(" ")
+        command = command.upper()
+        rest = rest.strip()
+
+        if command == "CATALOG":
+            catalog = rest
+        elif command == "FILE":
+            m = CUE_FILE_RE.match(line)
+            if not m:
+                raise CueError(f"Line {line_number}: invalid FILE: {line!r}")
+            files.append(CueFile(
+                filename=m.group("quoted") or m.group("bare"),
+                file_type=m.group("type").upper(), tracks=[]))
+        elif command == "TRACK":
+            if not files:
+                raise CueError(f"Line {line_number}: TRACK before FILE")
+            number, _, mode = rest.partition(" ")
+            finish_track()
+            track = {
+                "track": int(number), "mode": mode.strip().upper(),
+                "flags": TrackFlags(0), "isrc": None, "indices": {},
+                "index_files": {}, "pregap": 0}
+        elif command in ("INDEX", "FLAGS", "ISRC", "PREGAP") and track is None:
+            raise CueError(f"Line {line_number}: {command} outside a TRACK")
+        elif command == "INDEX":
+            index, _, position = rest.partition(" ")
+            track["indices"][int(index)] = _parse_msf(position.strip())
+            track["index_files"][int(index)] = len(files) - 1
+        elif command == "FLAGS":
+            for name in rest.upper().split():
+                track["flags"] |= CUE_FLAGS.get(name, TrackFlags(0))
+        elif command == "ISRC":
+            track["isrc"] = rest
+        elif command == "PREGAP":
+            track["pregap"] = _parse_msf(rest)
+
+    finish_track()
+    if not any(cue_file.tracks for cue_file in files):
+        raise CueError("Cue sheet has no tracks")
+    return CueSheet(catalog=catalog, files=files)
+
+def cue_layout(sheet: CueSheet, file_frames: Mapping[str, int]) -> CueLayout:
+    """
+    Lay a cue sheet out on a disc, given the length in frames of each file.
+    Frame 0 is track 1's index 1; audio before it (a hidden pregap) is
+    dropped, and a PREGAP on track 1 is the standard two-second lead-in
+    rather than extra silence. A data track following audio tracks is
+    placed in a second session, after the gap between sessions.
+    """
+    segments: List[Tuple[Optional[str], int, int]] = []
+    # The disc position of each file's first frame, and the (offset, length)
+    # of the silence inserted into it.
+    file_starts: List[int] = []
+    insertions: List[List[Tuple[int, int]]] = []
+    position = 0
+    previous: Optional[CueTrack] = None
+    cursor = 0
+
+    def insert_silence(filename: str, at: int, length: int) -> None:
+        # Split the file at offset at and insert length frames of silence.
+        nonlocal cursor
+        segments.append((filename, cursor, at - cursor))
+        segments.append((None, 0, length))
+        cursor = at
+        insertions[-1].append((at, length))
+
+    for file_number, cue_file in enumerate(sheet.files):
+        frames = file_frames[cue_file.filename]
+        file_starts.append(position)
+        insertions.append([])
+        cursor = 0
+
+        for track in cue_file.tracks:
+            offsets = [
+                offset for index, offset in track.indices.items()
+                if track.index_files[index] == file_number]
+            if min(offsets) < cursor or max(offsets) > frames:
+                raise CueError(
+                    f"Track {track.track} indices are out of order or past "
+                    f"the end of {cue_file.filename}")
+
+            if (previous is not None and
+                    previous.track_type == TrackType.audio and
+                    track.track_type == TrackType.data):
+                insert_silence(
+                    cue_file.filename, min(offsets), SESSION_GAP_FRAMES)
+
+            if track.pregap and previous is not None:
+                insert_silence(
+                    cue_file.filename, track.indices[1], track.pregap)
+            previous = track
+
+        segments.append((cue_file.filename, cursor, frames - cursor))
+        position += frames + sum(length for _, length in insertions[-1])
+
+    def disc_position(file_number: int, offset: int) -> int:
+        # Silence inserted at or before an offset moves it later on the disc.
+        return file_starts[file_number] + offset + sum(
+            length for at, length in insertions[file_number] if at <= offset)
+
+    starts: List[Tuple[CueTrack, int]] = []
+    track_indices: Dict[TrackIndex, int] = {}
+    for track in sheet.tracks:
+        for index, offset in track.indices.items():
+            track_indices[TrackIndex(track.track, index)] = disc_position(
+                track.index_files[index], offset)
+
+        start = track_indices[TrackIndex(track.track, 1)]
+        if track.pregap and starts and 0 not in track.indices:
+            track_indices[TrackIndex(track.track, 0)] = start - track.pregap
+        starts.append((track, start))
+
+    # Make track 1's index 1 frame 0.
+    base = starts[0][1]
+    trimmed: List[Tuple[Optional[str], int, int]] = []
+    skip = base
+    for filename, first, count in segments:
+        drop = min(skip, count)
+        skip -= drop
+        if count > drop:
+            trimmed.append((filename, first + drop, count - drop))
+
+    track_info = [
+        TrackInformation(
+            track=track.track, track_type=track.track_type,
+            flags=track.flags | (
+                TrackFlags.DATA_TRACK if track.track_type == TrackType.data
+                else TrackFlags(0)),
+            start_frame=start - base)
+        for track, start in starts]
+    track_info.append(TrackInformation(
+        track=LEADOUT_TRACK, track_type=TrackType.leadout,
+        flags=TrackFlags(0), start_frame=position - base))
+
+    disc_information = DiscInformation(
+        first_track=starts[0][0].track, last_track=starts[-1][0].track,
+        track_information=tuple(track_info))
+    return CueLayout(
+        disc_information=disc_information,
+        track_indices={
+            track_index: frame - base
+            for track_index, frame in track_indices.items()
+            if frame >= base},
+        segments=trimmed)
@@ -0,0 +1,126 @@
+"""
+Discovery of the optical drives attached to the system.
+
+Drives are found by scanning /sys/block for sr* devices. Each one is opened
+with O_NONBLOCK, so an empty drive or one with its tray open doesn't block
+the open, and its status, capabilities, slot count and identity are probed.
+Probes issue ioctls and SCSI commands that can each take a second or more
+while a drive spins up, so every drive is probed on its own thread; bringing
+up a large farm takes about as long as its slowest drive rather than the sum
+of them all.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+import os
+from os.path import exists, join
+from re import compile as re_compile
+from typing import List, NamedTuple, Optional, Sequence
+
+from .drive import CDROMDrive, DriveCapability, DriveIdentity, DriveStatus
+
+SYS_BLOCK_DIRECTORY = "/sys/block"
+DEV_DIRECTORY = "/dev"
+
+# Drives probed at once; more than any single host is likely to have.
+DEFAULT_PROBE_WORKERS = 64
+
+SR_DEVICE_RE = re_compile(r"^sr(?P<index>[0-9]+)$")
+
+log = getLogger(__name__)
+
+class DiscoveredDrive(NamedTuple):
+    """
+    A drive opened and probed by discover_drives(). identity is None if the
+    drive did not answer an INQUIRY.
+    """
+    filename: str
+    drive: CDROMDrive
+    status: DriveStatus
+    capabilities: DriveCapability
+    slot_count: int
+    identity: Optional[DriveIdentity]
+
+def find_drive_devices(
+        sys_block: str = SYS_BLOCK_DIRECTORY,
+        dev: str = DEV_DIRECTORY) -> List[str]:
+    """
+    Return the device filenames of the optical drives listed in sys_block,
+    in order of their sr index.
+    """
+    try:
+        names = os.listdir(sys_block)
+    except FileNotFoundError:
+        return []
+
+    indices = []
+    for name in names:
+        m = SR_DEVICE_RE.match(name)
+        if m:
+            indices.append(int(m.group("index")))
+
+    return [
+        join(dev, f"sr{index}") for index in sorted(indices)
+        if exists(join(dev, f"sr{index}"))]
+
+def probe_drive(filename: str) -> DiscoveredDrive:
+    """
+    Open a drive without blocking and query its status and features.
+    Raises OSError if the drive cannot be opened or does not respond to the
+    CD-ROM ioctls.
+    """
+    drive = CDROMDrive.from_filename(filename, nonblock=True)
+    status = drive.get_status()
+
+    try:
+        capabilities = drive.get_capabilities()
+    except NotImplementedError:
+        capabilities = DriveCapability(0)
+
+    slot_count = 1
+    if capabilities & DriveCapability.SELECT_DISC:
+        slot_count = drive.slot_count
+
+    try:
+        identity: Optional[DriveIdentity] = drive.get_identity()
+    except (IOError, NotImplementedError):
+        log.debug("Drive %s did not report its identity", filename,
+                  exc_info=True)
+        identity = None
+
+    return DiscoveredDrive(
+        filename=filename, drive=drive, status=status,
+        capabilities=capabilities, slot_count=slot_count, identity=identity)
+
+def discover_drives(
+        filenames: Optional[Sequence[str]] = None,
+        max_workers: int = DEFAULT_PROBE_WORKERS) -> List[DiscoveredDrive]:
+    """
+    Open and probe drives concurrently, returning those that responded in
+    the order given. If filenames is None, every drive found in /sys/block
+    is probed. Drives that cannot be opened or probed are logged and
+    omitted.
+    """
+    if filenames is None:
+        filenames = find_drive_devices()
+
+    if not filenames:
+        return []
+
+    def probe(filename: str) -> Optional[DiscoveredDrive]:
+        try:
+            return probe_drive(filename)
+        except (IOError, NotImplementedError) as e:
+            log.warning("Unable to probe drive %s: %s", filename, e)
+            return None
+
+    with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(filenames)),
+            thread_name_prefix="DriveProbe") as executor:
+        results = list(executor.map(probe, filenames))
+
+    drives = [result for result in results if result is not None]
+    for result in drives:
+        log.info("Found drive %s: %s, %s, %d slot(s)", result.filename,
+                 result.identity or "unknown identity", result.status.name,
+                 result.slot_count)
+    return drives
@@ -3,11 +3,22 @@ Operating system agnotic drive control and CD data.
 """
 # pylint: disable=C0103
 
-from enum import Enum, auto
+from enum import Enum, IntFlag, auto
+from errno import EIO
 import os
 from platform import system
-from typing import TypeVar, Type
-from .cd import DiscInformation, MSF, TrackInformation
+from typing import Dict, NamedTuple, Optional, Tuple, TypeVar, Type
+from .cd import (
+    DiscCodes, DiscInformation, MSF, SubchannelQ, TRACK_MAX, TrackIndex,
+    TrackInformation, TrackType)
+
+# Initial distance before a track start to search for its pregap; doubled
+# until the start of the pregap is found.
+PREGAP_SEARCH_FRAMES = 750
+
+# Number of frames around a probe point to try when the Q subchannel of a
+# frame is unreadable.
+Q_MAX_PROBES = 8
 
 class DriveStatus(Enum):
     """
@@ -19,6 +30,45 @@ class DriveStatus(Enum):
     tray_open = auto()
     not_ready = auto()
 
+class DriveCapability(IntFlag):
+    """
+    Features a drive supports. Values match the CDC_* flags in linux/cdrom.h.
+    """
+    # pylint: disable=C0326
+    CLOSE_TRAY =        0x000001
+    OPEN_TRAY =         0x000002
+    LOCK =              0x000004
+    SELECT_SPEED =      0x000008
+    SELECT_DISC =       0x000010
+    MULTI_SESSION =     0x000020
+    MCN =               0x000040
+    MEDIA_CHANGED =     0x000080
+    PLAY_AUDIO =        0x000100
+    RESET =             0x000200
+    IOCTLS =            0x000400
+    DRIVE_STATUS =      0x000800
+    GENERIC_PACKET =    0x001000
+    CD_R =              0x002000
+    CD_RW =             0x004000
+    DVD =               0x008000
+    DVD_R =             0x010000
+    DVD_RAM =           0x020000
+    MO_DRIVE =          0x040000
+    MRW =               0x080000
+    MRW_W =             0x100000
+    RAM =               0x200000
+
+class DriveIdentity(NamedTuple):
+    """
+    Identification strings reported by a drive.
+    """
+    vendor: str
+    model: str
+    revision: str
+
+    def __str__(self) -> str:
+        return f"{self.vendor} {self.model} {self.revision}"
+
 T = TypeVar("T", bound="CDROMDrive")
 class CDROMDrive:
     """
@@ -46,6 +96,7 @@ class CDROMDrive:
         super(CDROMDrive, self).__init__()
         self._handle: int = handle
         self._owned: bool = owned
+        self._disc_codes: Dict[str, DiscCodes] = {}
 
     def __del__(self) -> None:
         if self._owned and self._handle >= 0:
@@ -126,12 +177,37 @@ class CDROMDrive:
         """
         raise ValueError("Changing slots not supported on this device")
 
+    def set_speed(self, speed: int) -> None:
+        """
+        Set the read speed as a multiple of the audio playback rate (1x is
+        75 frames/second). A speed of 0 selects the drive's maximum speed.
+        """
+        raise NotImplementedError()
+
+    def get_identity(self) -> DriveIdentity:
+        """
+        Return the vendor, model, and firmware revision of the drive.
+        """
+        raise NotImplementedError()
+
     def get_status(self) -> DriveStatus:
         """
         Return the current status of the drive/selected slot.
         """
         raise NotImplementedError()
 
+    def get_capabilities(self) -> DriveCapability:
+        """
+        Return the features the drive supports.
+        """
+        raise NotImplementedError()
+
+    def media_changed(self) -> bool:
+        """
+        Indicates whether the disc has been changed since the last call.
+        """
+        raise NotImplementedError()
+
     def get_disc_information(self) -> DiscInformation:
         """
         Return metadata about the currently inserted disc.
@@ -147,6 +223,196 @@ class CDROMDrive:
         """
         raise NotImplementedError()
 
+    def read_audio(self, start_frame: int, frame_count: int) -> bytes:
+        """
+        Read frame_count raw CD-DA frames (BYTES_PER_FRAME_RAW bytes each)
+        starting at the logical block address start_frame.
+        """
+        raise NotImplementedError()
+
+    def read_audio_c2(
+            self, start_frame: int, frame_count: int) -> Tuple[bytes, bytes]:
+        """
+        Read frame_count raw CD-DA frames starting at the logical block address
+        start_frame along with their C2 error pointers.
+
+        The second element of the result holds C2_BYTES_PER_FRAME bytes for
+        each frame read; each set bit marks a byte of audio data the drive
+        could not correct.
+        """
+        raise NotImplementedError()
+
+    def read_subchannel_q(self, frame: int) -> Optional[SubchannelQ]:
+        """
+        Read the Q subchannel of the specified frame. Returns None if the
+        frame does not carry position data or its Q data is corrupt.
+        """
+        raise NotImplementedError()
+
+    def get_media_catalog_number(self) -> Optional[str]:
+        """
+        Return the media catalog number (UPC/EAN) recorded on the disc, or
+        None if the disc does not have one.
+        """
+        raise NotImplementedError()
+
+    def get_isrc(self, track: int) -> Optional[str]:
+        """
+        Return the International Standard Recording Code recorded for the
+        specified track, or None if the track does not have one.
+        """
+        raise NotImplementedError()
+
+    def get_disc_codes(
+            self, disc_information: Optional[DiscInformation] = None
+    ) -> DiscCodes:
+        """
+        Return the media catalog number and the ISRC of every audio track.
+
+        Tracks are visited in order of their starting frame to minimize
+        seeking. Results are cached per disc (keyed by MusicBrainz disc ID),
+        so repeated calls for the same disc do not touch the drive.
+        """
+        if disc_information is None:
+            disc_information = self.get_disc_information()
+
+        disc_id = disc_information.musicbrainz_id
+        cached = self._disc_codes.get(disc_id)
+        if cached is not None:
+            return cached
+
+        mcn = self.get_media_catalog_number()
+        isrcs: Dict[int, str] = {}
+
+        audio_tracks = sorted(
+            (info for info in disc_information.track_information
+             if info.track_type == TrackType.audio),
+            key=lambda info: info.start_frame)
+        for info in audio_tracks:
+            isrc = self.get_isrc(info.track)
+            if isrc is not None:
+                isrcs[info.track] = isrc
+
+        codes = DiscCodes(mcn=mcn, isrcs=isrcs)
+        self._disc_codes[disc_id] = codes
+        return codes
+
+    def get_track_indices(
+            self, disc_information: Optional[DiscInformation] = None
+    ) -> Dict[TrackIndex, int]:
+        """
+        Return the starting frame of each index on the disc's audio tracks,
+        including pregaps (index 0) and any index points after index 1.
+
+        Rather than scanning the subchannel of every frame, this reads the Q
+        subchannel around track boundaries and binary-searches for each index
+        transition. The pregap of the first track precedes frame 0 and is not
+        reported.
+        """
+        if disc_information is None:
+            disc_information = self.get_disc_information()
+
+        tracks = disc_information.track_information
+        result: Dict[TrackIndex, int] = {}
+
+        # Locate each track's pregap, which lies at the end of the previous
+        # audio track.
+        for i, info in enumerate(tracks[:-1]):
+            if info.track_type != TrackType.audio:
+                continue
+
+            result[TrackIndex(info.track, 1)] = info.start_frame
+            if i > 0 and tracks[i - 1].track_type == TrackType.audio:
+                pregap = self._find_pregap(
+                    info.track, tracks[i - 1].start_frame, info.start_frame)
+                if pregap < info.start_frame:
+                    result[TrackIndex(info.track, 0)] = pregap
+
+        # The last frame of each track (before the next track's pregap) tells
+        # us whether it has indices beyond 1.
+        for info in tracks[:-1]:
+            if info.track_type != TrackType.audio:
+                continue
+
+            start_frame, end_frame = disc_information.get_track_frames(
+                info.track)
+            if info.track < TRACK_MAX:
+                end_frame = result.get(
+                    TrackIndex(info.track + 1, 0), end_frame)
+
+            last_q, _ = self._probe_q(end_frame - 1, start_frame, end_frame)
+            if last_q is None or last_q.track != info.track:
+                continue
+
+            lower = start_frame
+            for index in range(2, last_q.index + 1):
+                lower = self._find_transition(
+                    lower, end_frame, TrackIndex(info.track, index))
+                result[TrackIndex(info.track, index)] = lower
+
+        return result
+
+    def _find_pregap(
+            self, track: int, lower_limit: int, track_start: int) -> int:
+        """
+        Return the first frame of the pregap (index 0) of the specified
+        track, or track_start if it has no pregap.
+        """
+        target = TrackIndex(track, 0)
+        window = PREGAP_SEARCH_FRAMES
+        while True:
+            lower = max(lower_limit, track_start - window)
+            q, at = self._probe_q(lower, lower_limit, track_start)
+            if q is None:
+                raise IOError(EIO, f"Unable to read Q subchannel near {lower}")
+
+            if q.track_index < target or lower == lower_limit:
+                return self._find_transition(at, track_start, target)
+
+            window *= 2
+
+    def _find_transition(
+            self, lower: int, upper: int, target: TrackIndex) -> int:
+        """
+        Return the first frame in (lower, upper] whose Q position is at or
+        after target. lower must be known to be before target; upper is
+        assumed to be at or after it.
+        """
+        while upper - lower > 1:
+            q, at = self._probe_q((lower + upper) // 2, lower + 1, upper)
+            if q is None:
+                # Nothing readable between the bounds; settle for upper.
+                break
+
+            if q.track_index < target:
+                lower = at
+            else:
+                upper = at
+
+        return upper
+
+    def _probe_q(self, frame: int, lower: int, upper: int
+                ) -> Tuple[Optional[SubchannelQ], int]:
+        """
+        Read the Q subchannel position at frame, trying nearby frames in
+        [lower, upper) if it is unreadable.
+        """
+        for delta in range(Q_MAX_PROBES):
+            for candidate in ((frame + delta, frame - delta) if delta
+                              else (frame,)):
+                if not lower <= candidate < upper:
+                    continue
+
+                try:
+                    q = self.read_subchannel_q(candidate)
+                except IOError:
+                    continue
+
+                if q is not None:
+                    return (q, candidate)
+
+        return (None, frame)
+
     @property
     def handle(self) -> int:
         """
@@ -163,11 +429,16 @@ class CDROMDrive:
         return self._owned
 
     @classmethod
-    def from_filename(cls: Type[T], filename: str) -> T:
+    def from_filename(cls: Type[T], filename: str, nonblock: bool = False) -> T:
         """
         Create a CDROMDrive object by opening the specified filename.
+
+        If nonblock is True, the device is opened with O_NONBLOCK so the open
+        succeeds even when the drive is empty or its tray is open, as needed
+        to poll for disc changes.
         """
-        fd = os.open(filename, os.O_RDONLY)
+        flags = os.O_RDONLY | (os.O_NONBLOCK if nonblock else 0)
+        fd = os.open(filename, flags)
         try:
             return cls(fd, True)
         except:
@@ -0,0 +1,101 @@
+"""
+De-emphasis of CD audio mastered with 50/15 µs pre-emphasis.
+
+Tracks flagged with TrackFlags.PREEMPHASIS had their treble boosted by the
+shelving filter (1 + s T2) / (1 + s T1), T1 = 50 µs and T2 = 15 µs, before
+being pressed, and must be cut by its inverse on playback. DeemphasisFilter
+applies that cut to 16-bit PCM as it is extracted, keeping the filter state
+across chunks so the result is identical however the stream is split.
+
+The analog filter is approximated by a first-order digital filter: the pole
+comes from the bilinear transform prewarped to the 50 µs corner, and the
+zero is placed so the gain at Nyquist matches the analog response. This is
+within 0.25 dB of the analog curve across the audio band at 44.1 kHz.
+
+NumPy is an optional dependency; use deemphasis_available() to check for it.
+"""
+# pylint: disable=C0103
+from math import pi, sqrt, tan
+from typing import Tuple
+
+try:
+    import numpy as np
+except ImportError: # pragma: no cover
+    np = None # type: ignore
+
+from .flac import CD_CHANNELS, CD_SAMPLE_RATE
+from .iir import IIRFilter
+
+# Pre-emphasis time constants, in seconds.
+EMPHASIS_T1 = 50e-6
+EMPHASIS_T2 = 15e-6
+
+FULL_SCALE = 32768.0
+
+def deemphasis_available() -> bool:
+    """
+    Indicates whether NumPy is installed so de-emphasis can be applied.
+    """
+    return np is not None
+
+def deemphasis_coefficients(
+        sample_rate: int = CD_SAMPLE_RATE
+) -> Tuple[Tuple[float, float], Tuple[float, float]]:
+    """
+    Return the (b, a) coefficients of the first-order de-emphasis filter for
+    the given sample rate, with unity gain at DC.
+    """
+    # Pole: bilinear transform prewarped so the 50 µs corner is exact.
+    k = 1.0 / (EMPHASIS_T1 * tan(1.0 / (2.0 * sample_rate * EMPHASIS_T1)))
+    pole = (k * EMPHASIS_T1 - 1.0) / (k * EMPHASIS_T1 + 1.0)
+
+    # Zero: match the analog gain at Nyquist, |(1 + jwT2) / (1 + jwT1)|.
+    w = pi * sample_rate
+    nyquist_gain = sqrt(
+        (1.0 + (w * EMPHASIS_T2) ** 2) / (1.0 + (w * EMPHASIS_T1) ** 2))
+    ratio = nyquist_gain * (1.0 + pole) / (1.0 - pole)
+    zero = (ratio - 1.0) / (ratio + 1.0)
+
+    gain = (1.0 - pole) / (1.0 - zero)
+    return ((gain, -gain * zero), (1.0, -pole))
+
+class DeemphasisFilter:
+    """
+    Incrementally de-emphasize 16-bit interleaved PCM. Each call to
+    process() returns the filtered audio for the chunk passed in.
+    """
+    def __init__(self, sample_rate: int = CD_SAMPLE_RATE,
+                 channels: int = CD_CHANNELS) -> None:
+        super(DeemphasisFilter, self).__init__()
+        if np is None:
+            raise RuntimeError("NumPy is required for de-emphasis")
+
+        self.channels = channels
+        self._filter = IIRFilter(
+            *deemphasis_coefficients(sample_rate), channels)
+
+    def process(self, pcm: bytes) -> bytes:
+        """
+        De-emphasize the next chunk of PCM data, which must hold a whole
+        number of sample frames. Output samples are rounded to the nearest
+        16-bit value.
+        """
+        frame_bytes = 2 * self.channels
+        if len(pcm) % frame_bytes:
+            raise ValueError(
+                f"PCM data must be a multiple of {frame_bytes} bytes")
+
+        x = (np.frombuffer(pcm, dtype="<i2").reshape(-1, self.channels).T /
+             FULL_SCALE)
+        y = self._filter.filter(x)
+        samples = np.clip(
+            np.rint(y.T * FULL_SCALE), -FULL_SCALE, FULL_SCALE - 1.0)
+        return samples.astype("<i2").tobytes()
+
+def deemphasize(
+        pcm: bytes, sample_rate: int = CD_SAMPLE_RATE,
+        channels: int = CD_CHANNELS) -> bytes:
+    """
+    De-emphasize a complete track of 16-bit interleaved PCM.
+    """
+    return DeemphasisFilter(sample_rate, channels).process(pcm)
@@ -0,0 +1,359 @@
+"""
+Secure audio extraction guided by C2 error pointers.
+
+Each frame is read once along with the drive's C2 error pointers. Only frames
+the drive flags (plus their neighbours) are re-read, and they are accepted
+once enough identical, unflagged copies have been seen. Clean discs are thus
+read in a single pass at full drive speed.
+"""
+from collections import OrderedDict
+from logging import getLogger
+from time import monotonic
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+from .cd import BYTES_PER_FRAME_RAW
+from .drive import CDROMDrive
+from .speed import SpeedController
+
+# pylint: disable=R0902,R0913
+
+DEFAULT_BATCH_FRAMES = 24
+DEFAULT_CACHE_FRAMES = 4096
+DEFAULT_NEIGHBOUR_FRAMES = 1
+DEFAULT_REQUIRED_MATCHES = 2
+DEFAULT_MAX_REREADS = 16
+
+# How far away to read to push a frame out of the drive's audio cache.
+CACHE_BUST_DISTANCE = 2048
+
+SILENT_FRAME = bytes(BYTES_PER_FRAME_RAW)
+
+log = getLogger(__name__)
+
+class SectorCache:
+    """
+    LRU cache of sector reads keyed by logical block address.
+
+    Each entry records every distinct copy of a frame seen so far along with
+    the number of times it was read without C2 errors, so re-reads can be
+    compared against earlier reads without going back to the drive.
+    """
+    def __init__(self, max_frames: int = DEFAULT_CACHE_FRAMES) -> None:
+        super(SectorCache, self).__init__()
+        if max_frames <= 0:
+            raise ValueError("max_frames must be positive")
+
+        self.max_frames = max_frames
+        self._entries: "OrderedDict[int, Dict[bytes, int]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, frame: int) -> bool:
+        return frame in self._entries
+
+    def add(self, frame: int, data: bytes, clean: bool) -> int:
+        """
+        Record a read of the specified frame. Returns the number of clean
+        reads that have produced this exact data.
+        """
+        copies = self._entries.get(frame)
+        if copies is None:
+            copies = {}
+            self._entries[frame] = copies
+            while len(self._entries) > self.max_frames:
+                self._entries.popitem(last=False)
+        else:
+            self._entries.move_to_end(frame)
+
+        count = copies.get(data, 0) + (1 if clean else 0)
+        copies[data] = count
+        return count
+
+    def verified(self, frame: int, required_matches: int) -> Optional[bytes]:
+        """
+        Return the copy of the frame that has been read cleanly at least
+        required_matches times, or None if there is no such copy.
+        """
+        copies = self._entries.get(frame)
+        if not copies:
+            return None
+
+        self._entries.move_to_end(frame)
+        for data, count in copies.items():
+            if count >= required_matches:
+                return data
+
+        return None
+
+    def best(self, frame: int) -> Optional[bytes]:
+        """
+        Return the copy of the frame with the most clean reads, or None if the
+        frame has never been read.
+        """
+        copies = self._entries.get(frame)
+        if not copies:
+            return None
+
+        return max(copies.items(), key=lambda item: item[1])[0]
+
+    def clean_reads(self, frame: int) -> int:
+        """
+        Return the number of clean reads of the frame, across every copy.
+        """
+        return sum(self._entries.get(frame, {}).values())
+
+    def discard(self, frame: int) -> None:
+        """
+        Forget all reads of the specified frame.
+        """
+        self._entries.pop(frame, None)
+
+class ExtractionStats:
+    """
+    Counters describing the work done by a SecureExtractor.
+    """
+    def __init__(self) -> None:
+        super(ExtractionStats, self).__init__()
+        self.frames_extracted = 0
+        self.frames_flagged = 0
+        self.frames_reread = 0
+        self.reread_mismatches = 0
+        self.read_commands = 0
+        self.unrecovered_frames: List[int] = []
+
+    def __repr__(self) -> str:
+        return (
+            f"ExtractionStats(frames_extracted={self.frames_extracted}, "
+            f"frames_flagged={self.frames_flagged}, "
+            f"frames_reread={self.frames_reread}, "
+            f"reread_mismatches={self.reread_mismatches}, "
+            f"read_commands={self.read_commands}, "
+            f"unrecovered_frames={self.unrecovered_frames})")
+
+class SecureExtractor:
+    """
+    Extract audio frames from a drive, re-reading only the frames the drive
+    reports C2 errors for.
+
+    If a speed_controller is supplied, the outcome of each batch is reported
+    to it so it can adjust the drive's speed: the frames the drive flagged,
+    and the re-reads that came back flagged or disagreed with an earlier
+    clean read. Cache-busting reads and re-reads that merely confirm a frame
+    are not problems. The caller starts the controller once per disc. clock
+    supplies the time used for these reports.
+    """
+    def __init__(
+            self, drive: CDROMDrive,
+            batch_frames: int = DEFAULT_BATCH_FRAMES,
+            neighbour_frames: int = DEFAULT_NEIGHBOUR_FRAMES,
+            required_matches: int = DEFAULT_REQUIRED_MATCHES,
+            max_rereads: int = DEFAULT_MAX_REREADS,
+            cache_frames: int = DEFAULT_CACHE_FRAMES,
+            defeat_drive_cache: bool = True,
+            speed_controller: Optional[SpeedController] = None,
+            clock: Callable[[], float] = monotonic) -> None:
+        super(SecureExtractor, self).__init__()
+        if batch_frames <= 0:
+            raise ValueError("batch_frames must be positive")
+
+        if not 0 <= neighbour_frames <= batch_frames:
+            raise ValueError(
+                "neighbour_frames must be between 0 and batch_frames")
+
+        if required_matches < 1:
+            raise ValueError("required_matches must be at least 1")
+
+        self.drive = drive
+        self.batch_frames = batch_frames
+        self.neighbour_frames = neighbour_frames
+        self.required_matches = required_matches
+        self.max_rereads = max_rereads
+        self.defeat_drive_cache = defeat_drive_cache
+        self.speed_controller = speed_controller
+        self.clock = clock
+        self.cache = SectorCache(max(cache_frames, batch_frames * 2))
+        self.stats = ExtractionStats()
+        self._range = (0, 0)
+
+    def extract(
+            self, start_frame: int, end_frame: int) -> Iterator[Tuple[int, bytes]]:
+        """
+        Extract frames in the range [start_frame, end_frame), yielding
+        (frame, data) pairs in order as soon as each frame is resolved.
+        """
+        self._range = (start_frame, end_frame)
+        accepted: Dict[int, bytes] = {}
+        suspects: Set[int] = set()
+        next_frame = start_frame
+
+        for batch_start in range(start_frame, end_frame, self.batch_frames):
+            batch_end = min(batch_start + self.batch_frames, end_frame)
+            batch_began = self.clock()
+            mismatches_before = self.stats.reread_mismatches
+
+            flagged = self._first_pass(batch_start, batch_end, accepted)
+            for frame in flagged:
+                suspects.update(range(
+                    max(start_frame, frame - self.neighbour_frames),
+                    min(end_frame, frame + self.neighbour_frames + 1)))
+
+            # Frames close to the end of this batch may still become suspect
+            # if the next batch turns up a flagged frame; hold them back.
+            if batch_end == end_frame:
+                ready = end_frame
+            else:
+                ready = max(next_frame, batch_end - self.neighbour_frames)
+
+            resolving = sorted(frame for frame in suspects if frame < ready)
+            if resolving:
+                suspects.difference_update(resolving)
+                self._resolve(resolving, accepted)
+
+            if self.speed_controller is not None:
+                self.speed_controller.record(
+                    frames=batch_end - batch_start, error_frames=len(flagged),
+                    retries=self.stats.reread_mismatches - mismatches_before,
+                    seconds=self.clock() - batch_began)
+
+            for frame in range(next_frame, ready):
+                self.stats.frames_extracted += 1
+                yield (frame, accepted.pop(frame))
+            next_frame = ready
+
+    def extract_bytes(self, start_frame: int, end_frame: int) -> bytes:
+        """
+        Extract frames in the range [start_frame, end_frame), returning the
+        audio data as a single bytes object.
+        """
+        return b"".join(
+            data for _, data in self.extract(start_frame, end_frame))
+
+    def _read(self, start_frame: int, end_frame: int
+             ) -> List[Tuple[Optional[bytes], bool]]:
+        """
+        Read frames with C2 pointers, returning (data, clean) for each frame.
+        A frame that could not be read at all is returned as (None, False).
+        """
+        count = end_frame - start_frame
+        try:
+            self.stats.read_commands += 1
+            audio, c2 = self.drive.read_audio_c2(start_frame, count)
+        except IOError:
+            if count == 1:
+                log.debug("Read of frame %d failed", start_frame, exc_info=True)
+                return [(None, False)]
+
+            # Narrow the failure down to the frames responsible.
+            result: List[Tuple[Optional[bytes], bool]] = []
+            for frame in range(start_frame, end_frame):
+                result.extend(self._read(frame, frame + 1))
+            return result
+
+        c2_len = len(c2) // count
+        return [
+            (audio[i * BYTES_PER_FRAME_RAW:(i + 1) * BYTES_PER_FRAME_RAW],
+             not any(c2[i * c2_len:(i + 1) * c2_len]))
+            for i in range(count)]
+
+    def _first_pass(self, start_frame: int, end_frame: int,
+                    accepted: Dict[int, bytes]) -> List[int]:
+        """
+        Read a batch of frames once, accepting clean frames and returning the
+        frames the drive flagged.
+        """
+        flagged = []
+        reads = self._read(start_frame, end_frame)
+        for frame, (data, clean) in zip(range(start_frame, end_frame), reads):
+            if data is not None:
+                self.cache.add(frame, data, clean)
+                if clean:
+                    accepted[frame] = data
+                    continue
+
+            flagged.append(frame)
+
+        self.stats.frames_flagged += len(flagged)
+        return flagged
+
+    def _resolve(self, frames: List[int], accepted: Dict[int, bytes]) -> None:
+        """
+        Re-read suspect frames until each has been read identically and
+        cleanly required_matches times, or max_rereads is exhausted.
+        """
+        self.stats.frames_reread += len(frames)
+        unresolved = list(frames)
+
+        for _ in range(self.max_rereads):
+            unresolved = [
+                frame for frame in unresolved
+                if self.cache.verified(frame, self.required_matches) is None]
+            if not unresolved:
+                break
+
+            for run_start, run_end in _runs(unresolved):
+                self._bust_drive_cache(run_start)
+                reads = self._read(run_start, run_end)
+                for frame, (data, clean) in zip(
+                        range(run_start, run_end), reads):
+                    if data is None:
+                        self.stats.reread_mismatches += 1
+                        continue
+
+                    # A clean copy unlike every earlier clean read disagrees.
+                    earlier = self.cache.clean_reads(frame)
+                    matches = self.cache.add(frame, data, clean)
+                    if not clean or earlier > matches - 1:
+                        self.stats.reread_mismatches += 1
+
+        for frame in frames:
+            data = self.cache.verified(frame, self.required_matches)
+            if data is None:
+                data = self.cache.best(frame)
+                log.warning("Unable to verify frame %d after %d re-reads",
+                            frame, self.max_rereads)
+                self.stats.unrecovered_frames.append(frame)
+                if data is None:
+                    data = SILENT_FRAME
+
+            accepted[frame] = data
+
+    def _bust_drive_cache(self, frame: int) -> None:
+        """
+        Read a distant frame so the drive cannot satisfy the next read of
+        frame from its internal audio cache.
+        """
+        if not self.defeat_drive_cache:
+            return
+
+        start_frame, end_frame = self._range
+        if frame - CACHE_BUST_DISTANCE >= start_frame:
+            target = frame - CACHE_BUST_DISTANCE
+        elif frame + CACHE_BUST_DISTANCE < end_frame:
+            target = frame + CACHE_BUST_DISTANCE
+        elif frame - start_frame >= end_frame - 1 - frame:
+            target = start_frame
+        else:
+            target = end_frame - 1
+
+        if target == frame:
+            return
+
+        try:
+            self.stats.read_commands += 1
+            self.drive.read_audio(target, 1)
+        except IOError:
+            log.debug("Cache-busting read of frame %d failed", target,
+                      exc_info=True)
+
+def _runs(frames: List[int]) -> Iterator[Tuple[int, int]]:
+    """
+    Group a sorted list of frames into contiguous [start, end) runs.
+    """
+    run_start = run_end = frames[0]
+    for frame in frames:
+        if frame != run_end:
+            yield (run_start, run_end)
+            run_start = frame
+        run_end = frame + 1
+    yield (run_start, run_end)
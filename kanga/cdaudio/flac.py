@@ -0,0 +1,401 @@
+"""
+In-process FLAC encoding using libFLAC via ctypes.
+
+encode_flac() is a plain module-level function so it can be submitted to a
+ProcessPoolExecutor; each worker process loads libFLAC once and encodes PCM
+buffers without spawning the flac binary.
+
+The metadata block functions read and rewrite the header of an existing FLAC
+stream in pure Python, so a file's tags can be replaced without decoding (or
+even reading) its audio.
+"""
+# pylint: disable=C0103,R0903
+from array import array
+from ctypes import (
+    CDLL, POINTER, Structure, c_char_p, c_int, c_int32, c_uint,
+    c_uint32, c_uint64, c_ubyte, c_void_p, cast, create_string_buffer)
+from ctypes.util import find_library
+from logging import getLogger
+from struct import error as StructError, pack, unpack_from
+from sys import byteorder
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple, Union
+import wave
+
+CD_SAMPLE_RATE = 44100
+CD_CHANNELS = 2
+CD_BITS_PER_SAMPLE = 16
+BYTES_PER_SAMPLE_FRAME = CD_CHANNELS * CD_BITS_PER_SAMPLE // 8
+
+DEFAULT_COMPRESSION_LEVEL = 5
+DEFAULT_PADDING = 8192
+
+# Samples (per channel) handed to libFLAC in each process call.
+ENCODE_CHUNK_SAMPLES = 588 * 64
+
+# From FLAC/format.h
+FLAC__STREAM_SYNC_STRING = b"fLaC"
+FLAC__METADATA_TYPE_PADDING = 1
+FLAC__METADATA_TYPE_VORBIS_COMMENT = 4
+FLAC__STREAM_ENCODER_INIT_STATUS_OK = 0
+
+log = getLogger(__name__)
+
+class FLAC__StreamMetadata_VorbisComment_Entry(Structure):
+    """
+    A single NAME=value Vorbis comment.
+    """
+    _fields_ = [
+        ("length", c_uint32),
+        ("entry", POINTER(c_ubyte)),
+    ]
+
+class FLAC__StreamMetadata_Header(Structure):
+    """
+    The leading fields of FLAC__StreamMetadata common to all block types.
+    """
+    _fields_ = [
+        ("type", c_int),
+        ("is_last", c_int),
+        ("length", c_uint),
+    ]
+
+class FLACError(Exception):
+    """
+    An error reported by libFLAC, or a malformed FLAC stream.
+    """
+
+class FLACMetadataBlock(NamedTuple):
+    """
+    A metadata block from the header of a FLAC stream.
+    """
+    block_type: int
+    data: bytes
+
+_libflac: Optional[CDLL] = None
+
+def load_libflac() -> Optional[CDLL]:
+    """
+    Load libFLAC, returning None if it is not installed.
+    """
+    global _libflac # pylint: disable=W0603
+    if _libflac is not None:
+        return _libflac
+
+    name = find_library("FLAC")
+    if name is None:
+        return None
+
+    lib = CDLL(name)
+    lib.FLAC__stream_encoder_new.restype = c_void_p
+    lib.FLAC__stream_encoder_new.argtypes = []
+    for setter, arg_type in (
+            ("channels", c_uint32), ("bits_per_sample", c_uint32),
+            ("sample_rate", c_uint32), ("compression_level", c_uint32),
+            ("total_samples_estimate", c_uint64)):
+        func = getattr(lib, f"FLAC__stream_encoder_set_{setter}")
+        func.restype = c_int
+        func.argtypes = [c_void_p, arg_type]
+    lib.FLAC__stream_encoder_set_metadata.restype = c_int
+    lib.FLAC__stream_encoder_set_metadata.argtypes = [
+        c_void_p, POINTER(c_void_p), c_uint32]
+    lib.FLAC__stream_encoder_init_file.restype = c_int
+    lib.FLAC__stream_encoder_init_file.argtypes = [
+        c_void_p, c_char_p, c_void_p, c_void_p]
+    lib.FLAC__stream_encoder_process_interleaved.restype = c_int
+    lib.FLAC__stream_encoder_process_interleaved.argtypes = [
+        c_void_p, POINTER(c_int32), c_uint32]
+    lib.FLAC__stream_encoder_finish.restype = c_int
+    lib.FLAC__stream_encoder_finish.argtypes = [c_void_p]
+    lib.FLAC__stream_encoder_delete.restype = None
+    lib.FLAC__stream_encoder_delete.argtypes = [c_void_p]
+    lib.FLAC__stream_encoder_get_state.restype = c_int
+    lib.FLAC__stream_encoder_get_state.argtypes = [c_void_p]
+    lib.FLAC__metadata_object_new.restype = c_void_p
+    lib.FLAC__metadata_object_new.argtypes = [c_int]
+    lib.FLAC__metadata_object_delete.restype = None
+    lib.FLAC__metadata_object_delete.argtypes = [c_void_p]
+    lib.FLAC__metadata_object_vorbiscomment_append_comment.restype = c_int
+    lib.FLAC__metadata_object_vorbiscomment_append_comment.argtypes = [
+        c_void_p, FLAC__StreamMetadata_VorbisComment_Entry, c_int]
+
+    _libflac = lib
+    return lib
+
+def libflac_available() -> bool:
+    """
+    Indicates whether libFLAC can be loaded for in-process encoding.
+    """
+    return load_libflac() is not None
+
+class VorbisCommentTemplate:
+    """
+    A set of Vorbis comments shared by every track of a release.
+
+    Entries are encoded to NAME=value bytes once; for_track() adds the
+    per-track entries without re-encoding the release-level ones.
+    """
+    def __init__(self, tags: Iterable[Tuple[str, str]] = ()) -> None:
+        super(VorbisCommentTemplate, self).__init__()
+        self.entries: Tuple[bytes, ...] = tuple(
+            encode_comment(name, value) for name, value in tags)
+
+    def for_track(self, tags: Iterable[Tuple[str, str]]) -> Tuple[bytes, ...]:
+        """
+        Return the release-level entries followed by the given track tags.
+        """
+        return self.entries + tuple(
+            encode_comment(name, value) for name, value in tags)
+
+def encode_comment(name: str, value: str) -> bytes:
+    """
+    Encode a single Vorbis comment. Names are ASCII (excluding '=') and are
+    conventionally upper-case.
+    """
+    if (not name or "=" in name or
+            not all(0x20 <= ord(char) <= 0x7d for char in name)):
+        raise ValueError(f"Invalid Vorbis comment name: {name!r}")
+
+    return f"{name.upper()}={value}".encode("utf-8")
+
+def read_wav_pcm(filename: str) -> bytes:
+    """
+    Read 16-bit stereo 44.1 kHz PCM from a WAV file.
+    """
+    with wave.open(filename, "rb") as wav:
+        if (wav.getnchannels() != CD_CHANNELS or wav.getsampwidth() != 2 or
+                wav.getframerate() != CD_SAMPLE_RATE):
+            raise ValueError(f"{filename} is not CD audio")
+        return wav.readframes(wav.getnframes())
+
+def encode_flac(
+        source: Union[bytes, str], output_filename: str,
+        comments: Sequence[bytes] = (),
+        compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+        padding: int = DEFAULT_PADDING) -> int:
+    """
+    Encode CD audio to a FLAC file using libFLAC.
+
+    source is either a buffer of 16-bit little-endian stereo PCM or the name
+    of a WAV file holding it. comments are encoded NAME=value entries (see
+    VorbisCommentTemplate). Returns the number of samples encoded per channel.
+    """
+    lib = load_libflac()
+    if lib is None:
+        raise FLACError("libFLAC is not available")
+
+    pcm = read_wav_pcm(source) if isinstance(source, str) else source
+    if len(pcm) % BYTES_PER_SAMPLE_FRAME:
+        raise ValueError("PCM data is not a whole number of sample frames")
+    total_samples = len(pcm) // BYTES_PER_SAMPLE_FRAME
+
+    encoder = lib.FLAC__stream_encoder_new()
+    if not encoder:
+        raise MemoryError("Unable to allocate FLAC encoder")
+
+    metadata: List[int] = []
+    try:
+        lib.FLAC__stream_encoder_set_channels(encoder, CD_CHANNELS)
+        lib.FLAC__stream_encoder_set_bits_per_sample(
+            encoder, CD_BITS_PER_SAMPLE)
+        lib.FLAC__stream_encoder_set_sample_rate(encoder, CD_SAMPLE_RATE)
+        lib.FLAC__stream_encoder_set_compression_level(
+            encoder, compression_level)
+        lib.FLAC__stream_encoder_set_total_samples_estimate(
+            encoder, total_samples)
+
+        metadata.append(_make_vorbis_comment(lib, comments))
+        if padding > 0:
+            block = lib.FLAC__metadata_object_new(FLAC__METADATA_TYPE_PADDING)
+            cast(block, POINTER(FLAC__StreamMetadata_Header)).contents.length = (
+                padding)
+            metadata.append(block)
+
+        blocks = (c_void_p * len(metadata))(*metadata)
+        lib.FLAC__stream_encoder_set_metadata(encoder, blocks, len(metadata))
+
+        status = lib.FLAC__stream_encoder_init_file(
+            encoder, output_filename.encode("utf-8"), None, None)
+        if status != FLAC__STREAM_ENCODER_INIT_STATUS_OK:
+            raise FLACError(
+                f"Unable to initialize FLAC encoder for {output_filename}: "
+                f"status {status}")
+
+        chunk_bytes = ENCODE_CHUNK_SAMPLES * BYTES_PER_SAMPLE_FRAME
+        view = memoryview(pcm)
+        for offset in range(0, len(pcm), chunk_bytes):
+            samples = array("h")
+            samples.frombytes(view[offset:offset + chunk_bytes])
+            if byteorder == "big":
+                samples.byteswap()
+
+            wide = array("i", samples)
+            buffer = (c_int32 * len(wide)).from_buffer(wide)
+            if not lib.FLAC__stream_encoder_process_interleaved(
+                    encoder, buffer, len(wide) // CD_CHANNELS):
+                raise FLACError(
+                    f"FLAC encoding of {output_filename} failed: state "
+                    f"{lib.FLAC__stream_encoder_get_state(encoder)}")
+
+        if not lib.FLAC__stream_encoder_finish(encoder):
+            raise FLACError(
+                f"Unable to finish FLAC encoding of {output_filename}: state "
+                f"{lib.FLAC__stream_encoder_get_state(encoder)}")
+    finally:
+        lib.FLAC__stream_encoder_delete(encoder)
+        for block in metadata:
+            lib.FLAC__metadata_object_delete(block)
+
+    return total_samples
+
+def flac_header_length(data: bytes) -> Optional[int]:
+    """
+    Return the length of the stream marker and metadata blocks at the start of
+    a FLAC stream -- the offset of the first audio frame -- or None if data
+    ends before the last metadata block does.
+    """
+    if len(data) < len(FLAC__STREAM_SYNC_STRING):
+        return None
+
+    if not data.startswith(FLAC__STREAM_SYNC_STRING):
+        raise FLACError("Not a FLAC stream")
+
+    offset = len(FLAC__STREAM_SYNC_STRING)
+    while True:
+        if len(data) < offset + 4:
+            return None
+
+        header = unpack_from(">I", data, offset)[0]
+        offset += 4 + (header & 0xffffff)
+        if header & 0x80000000:
+            return offset if len(data) >= offset else None
+
+def parse_flac_header(data: bytes) -> List[FLACMetadataBlock]:
+    """
+    Return the metadata blocks at the start of a FLAC stream.
+    """
+    length = flac_header_length(data)
+    if length is None:
+        raise FLACError("FLAC metadata is truncated")
+
+    blocks = []
+    offset = len(FLAC__STREAM_SYNC_STRING)
+    while offset < length:
+        header = unpack_from(">I", data, offset)[0]
+        block_length = header & 0xffffff
+        blocks.append(FLACMetadataBlock(
+            (header >> 24) & 0x7f, bytes(data[offset + 4:
+                                              offset + 4 + block_length])))
+        offset += 4 + block_length
+    return blocks
+
+def format_flac_header(blocks: Sequence[FLACMetadataBlock]) -> bytes:
+    """
+    Return the stream marker followed by the given metadata blocks.
+    """
+    result = bytearray(FLAC__STREAM_SYNC_STRING)
+    for index, block in enumerate(blocks):
+        if len(block.data) > 0xffffff:
+            raise FLACError(f"Metadata block of {len(block.data)} bytes is "
+                            f"too large")
+        last = 0x80000000 if index == len(blocks) - 1 else 0
+        result += pack(">I", last | (block.block_type << 24) | len(block.data))
+        result += block.data
+    return bytes(result)
+
+def parse_vorbis_comment(data: bytes) -> Tuple[bytes, List[bytes]]:
+    """
+    Return the vendor string and NAME=value entries of a Vorbis comment
+    block.
+    """
+    try:
+        vendor_length = unpack_from("<I", data, 0)[0]
+        vendor = bytes(data[4:4 + vendor_length])
+        offset = 4 + vendor_length
+        count = unpack_from("<I", data, offset)[0]
+        offset += 4
+        comments = []
+        for _ in range(count):
+            length = unpack_from("<I", data, offset)[0]
+            comments.append(bytes(data[offset + 4:offset + 4 + length]))
+            offset += 4 + length
+    except StructError as e:
+        raise FLACError(f"Malformed Vorbis comment block: {e}") from e
+    return vendor, comments
+
+def format_vorbis_comment(vendor: bytes, comments: Sequence[bytes]) -> bytes:
+    """
+    Return a Vorbis comment block holding the given entries.
+    """
+    result = bytearray(pack("<I", len(vendor)))
+    result += vendor
+    result += pack("<I", len(comments))
+    for comment in comments:
+        result += pack("<I", len(comment))
+        result += comment
+    return bytes(result)
+
+def replace_vorbis_comment(
+        data: bytes, comments: Sequence[bytes],
+        keep_prefixes: Sequence[bytes] = ()) -> Tuple[bytes, int]:
+    """
+    Replace the Vorbis comments in the header at the start of a FLAC stream.
+
+    Existing entries whose names start with any of keep_prefixes (such as
+    b"REPLAYGAIN_") are kept after the new comments. Every other block is
+    kept as it is. Padding is resized so the new header is the same length as
+    the old one if it fits, otherwise DEFAULT_PADDING bytes are left for
+    future edits. Returns the new header and the length of the old one; the
+    audio frames that follow it are unchanged.
+    """
+    length = flac_header_length(data)
+    if length is None:
+        raise FLACError("FLAC metadata is truncated")
+
+    blocks = parse_flac_header(data)
+    vendor = b""
+    kept: List[bytes] = []
+    for block in blocks:
+        if block.block_type == FLAC__METADATA_TYPE_VORBIS_COMMENT:
+            vendor, existing = parse_vorbis_comment(block.data)
+            kept.extend(
+                comment for comment in existing
+                if comment.split(b"=", 1)[0].upper().startswith(
+                    tuple(keep_prefixes)))
+
+    others = [
+        block for block in blocks
+        if block.block_type not in (FLAC__METADATA_TYPE_VORBIS_COMMENT,
+                                    FLAC__METADATA_TYPE_PADDING)]
+    if not others:
+        raise FLACError("FLAC stream has no STREAMINFO block")
+
+    # The Vorbis comment block conventionally follows STREAMINFO.
+    new_blocks = others[:1] + [FLACMetadataBlock(
+        FLAC__METADATA_TYPE_VORBIS_COMMENT,
+        format_vorbis_comment(vendor, list(comments) + kept))] + others[1:]
+
+    unpadded = len(format_flac_header(new_blocks))
+    padding = length - unpadded - 4
+    if padding < 0:
+        padding = DEFAULT_PADDING
+    if unpadded != length:
+        new_blocks.append(FLACMetadataBlock(
+            FLAC__METADATA_TYPE_PADDING, bytes(padding)))
+    return format_flac_header(new_blocks), length
+
+def _make_vorbis_comment(lib: CDLL, comments: Sequence[bytes]) -> int:
+    block = lib.FLAC__metadata_object_new(FLAC__METADATA_TYPE_VORBIS_COMMENT)
+    if not block:
+        raise MemoryError("Unable to allocate Vorbis comment block")
+
+    for comment in comments:
+        data = create_string_buffer(comment, len(comment))
+        entry = FLAC__StreamMetadata_VorbisComment_Entry(
+            len(comment), cast(data, POINTER(c_ubyte)))
+        # copy=true: libFLAC takes its own copy of the entry.
+        if not lib.FLAC__metadata_object_vorbiscomment_append_comment(
+                block, entry, 1):
+            lib.FLAC__metadata_object_delete(block)
+            raise MemoryError("Unable to append Vorbis comment")
+
+    return block
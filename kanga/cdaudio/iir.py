@@ -0,0 +1,120 @@
+"""
+Vectorized IIR filtering of streaming audio, used by loudness analysis and
+de-emphasis. Filter state carries across calls, so a stream can be filtered
+in chunks as it is extracted, without a per-sample Python loop.
+
+This requires NumPy.
+"""
+# pylint: disable=C0103
+from functools import lru_cache
+from typing import Sequence, Tuple
+
+try:
+    import numpy as np
+except ImportError: # pragma: no cover
+    np = None # type: ignore
+
+# Samples per filter block; the impulse responses are precomputed to this
+# length.
+FILTER_BLOCK_SAMPLES = 8192
+
+# Impulse responses that decay below RESPONSE_TOLERANCE within this many
+# samples are convolved directly, which is cheaper than an FFT.
+DIRECT_RESPONSE_SAMPLES = 256
+RESPONSE_TOLERANCE = 1e-12
+
+
+@lru_cache(maxsize=8)
+def _all_pole_responses(a: Tuple[float, ...]):
+    """
+    Return the impulse response of 1 / A(z) and its zero-input responses to
+    each initial output y[-1] ... y[-p] = 1, all FILTER_BLOCK_SAMPLES long.
+    This is the only per-sample loop, and runs once per filter.
+    """
+    order = len(a) - 1
+    responses = np.zeros((order + 1, FILTER_BLOCK_SAMPLES))
+    for response in range(order + 1):
+        # history[k] holds y[n - 1 - k].
+        history = [0.0] * order
+        if response:
+            history[response - 1] = 1.0
+        x = 0.0 if response else 1.0
+        row = responses[response]
+        for n in range(FILTER_BLOCK_SAMPLES):
+            y = x - sum(a[k + 1] * history[k] for k in range(order))
+            row[n] = y
+            history = [y] + history[:-1]
+            x = 0.0
+    responses.setflags(write=False)
+    return responses
+
+class IIRFilter:
+    """
+    An IIR filter applied block-wise to (channels, samples) arrays.
+
+    Within a block, the all-pole recursion is the FIR-filtered block
+    convolved with the all-pole impulse response, plus the zero-input
+    response to the outputs carried over from the previous block. Both are
+    exact for blocks up to FILTER_BLOCK_SAMPLES long. Long impulse responses
+    are convolved via FFT; short ones (fast-decaying poles) directly.
+    """
+    def __init__(self, b: Sequence[float], a: Sequence[float],
+                 channels: int) -> None:
+        super(IIRFilter, self).__init__()
+        if a[0] != 1.0:
+            raise ValueError("Filter must be normalized so a[0] == 1")
+
+        self.b = np.array(b, dtype=np.float64)
+        responses = _all_pole_responses(tuple(float(value) for value in a))
+        self.decays = responses[1:]
+        self.fft_size = 2 * FILTER_BLOCK_SAMPLES
+
+        significant = np.nonzero(
+            np.abs(responses).max(axis=0) > RESPONSE_TOLERANCE)[0]
+        length = int(significant[-1]) + 1 if len(significant) else 1
+        if length <= DIRECT_RESPONSE_SAMPLES:
+            self.h = responses[0][:length]
+            self.h_fft = None
+        else:
+            self.h = responses[0]
+            self.h_fft = np.fft.rfft(responses[0], self.fft_size)
+        self.x_history = np.zeros((channels, len(b) - 1))
+        self.y_history = np.zeros((channels, len(a) - 1))
+
+    def filter(self, x):
+        """
+        Filter a (channels, n) array of any length.
+        """
+        return np.concatenate([
+            self.process(x[:, start:start + FILTER_BLOCK_SAMPLES])
+            for start in range(0, x.shape[1], FILTER_BLOCK_SAMPLES)
+        ] or [np.zeros((x.shape[0], 0))], axis=1)
+
+    def process(self, x):
+        """
+        Filter a (channels, n) block, n <= FILTER_BLOCK_SAMPLES.
+        """
+        n = x.shape[1]
+        taps = len(self.b)
+        padded = np.concatenate((self.x_history, x), axis=1)
+        v = self.b[0] * padded[:, taps - 1:]
+        for k in range(1, taps):
+            v += self.b[k] * padded[:, taps - 1 - k:padded.shape[1] - k]
+
+        if self.h_fft is None:
+            y = np.stack([np.convolve(row, self.h)[:n] for row in v])
+        else:
+            y = np.fft.irfft(
+                np.fft.rfft(v, self.fft_size, axis=1) * self.h_fft,
+                self.fft_size, axis=1)[:, :n]
+
+        # y_history[:, -1] is y[-1], y_history[:, -2] is y[-2], ... Summing
+        # outer products is much faster than matmul for these tiny inner
+        # dimensions.
+        for k in range(self.decays.shape[0]):
+            y += self.y_history[:, -1 - k, None] * self.decays[k, :n]
+
+        self.x_history = padded[:, padded.shape[1] - (taps - 1):]
+        self.y_history = np.concatenate(
+            (self.y_history, y), axis=1)[:, -self.y_history.shape[1]:]
+        return y
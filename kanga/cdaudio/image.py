@@ -0,0 +1,206 @@
+"""
+Image-backed drive for exercising extraction code without hardware.
+"""
+# pylint: disable=C0103
+from typing import Callable, Dict, List, Optional, Tuple, Union
+
+from .cd import (
+    BYTES_PER_FRAME_RAW, C2_BYTES_PER_FRAME, DiscInformation,
+    FRAMES_PER_SECOND, GAP_FRAMES, LEADOUT_TRACK, MSF, SubchannelQ,
+    TrackFlags, TrackIndex, TrackInformation, TrackType)
+from .drive import CDROMDrive, DriveCapability, DriveIdentity, DriveStatus
+
+# Speed reported by the simulated drive when set to its maximum (0).
+IMAGE_MAX_SPEED = 48
+
+class ImageCDROMDrive(CDROMDrive):
+    """
+    A CDROMDrive that serves raw CD-DA frames from an in-memory disc image.
+
+    Read errors can be injected on individual frames to simulate scratched
+    discs: a corrupted frame returns damaged audio data and, unless the error
+    is marked as undetected, C2 error pointers flagging the damaged bytes.
+
+    The drive also keeps a simulated clock (elapsed) that advances according
+    to the selected speed. An error_model callable, given a frame and the
+    current speed, can return True to make that read fail with a detected
+    error; this allows speed-dependent error behaviour to be simulated.
+
+    Q subchannel positions are synthesized from track_indices, which maps
+    each TrackIndex to its starting frame and defaults to index 1 of each
+    track. The mcn and isrcs attributes supply the codes returned by
+    get_media_catalog_number() and get_isrc().
+    """
+    def __init__(
+            self, image: Union[bytes, bytearray, memoryview],
+            disc_information: Optional[DiscInformation] = None) -> None:
+        super(ImageCDROMDrive, self).__init__(handle=-1, owned=False)
+        if len(image) % BYTES_PER_FRAME_RAW != 0:
+            raise ValueError(
+                f"Image size must be a multiple of {BYTES_PER_FRAME_RAW} "
+                f"bytes: {len(image)}")
+
+        # Any buffer is served in place; a full disc image is about 800 MB.
+        self._image = memoryview(image)
+        self.frame_count = len(image) // BYTES_PER_FRAME_RAW
+
+        if disc_information is None:
+            disc_information = DiscInformation(
+                first_track=1, last_track=1, track_information=(
+                    TrackInformation(
+                        track=1, track_type=TrackType.audio,
+                        flags=TrackFlags(0), start_frame=0),
+                    TrackInformation(
+                        track=LEADOUT_TRACK, track_type=TrackType.leadout,
+                        flags=TrackFlags(0), start_frame=self.frame_count),
+                ))
+        self._disc_information = disc_information
+        self.track_indices: Dict[TrackIndex, int] = {
+            TrackIndex(info.track, 1): info.start_frame
+            for info in disc_information.track_information
+            if info.track_type != TrackType.leadout}
+        self.mcn: Optional[str] = None
+        self.isrcs: Dict[int, str] = {}
+
+        # frame -> [remaining bad reads, whether C2 pointers are reported]
+        self._errors: Dict[int, List] = {}
+
+        # Optional speed-dependent error model: (frame, speed) -> bool.
+        self.error_model: Optional[Callable[[int, int], bool]] = None
+        self.speed = IMAGE_MAX_SPEED
+        self.identity = DriveIdentity(
+            vendor="KANGA", model="IMAGE", revision="0001")
+
+        # Counters for inspecting drive access patterns.
+        self.read_commands = 0
+        self.frames_read = 0
+        self.subchannel_reads = 0
+        self.elapsed = 0.0
+
+    @classmethod
+    def from_image_file(
+            cls, filename: str,
+            disc_information: Optional[DiscInformation] = None
+    ) -> "ImageCDROMDrive":
+        """
+        Create an ImageCDROMDrive from a raw (BIN) CD-DA image file.
+        """
+        with open(filename, "rb") as fd:
+            return cls(fd.read(), disc_information)
+
+    def inject_error(
+            self, frame: int, reads: int = 1, detected: bool = True) -> None:
+        """
+        Corrupt the next `reads` reads of the specified frame. If detected is
+        False, the corruption is not reported via C2 error pointers.
+        """
+        if not 0 <= frame < self.frame_count:
+            raise ValueError(f"frame {frame} is outside the image")
+
+        self._errors[frame] = [reads, detected]
+
+    def clear_errors(self) -> None:
+        """
+        Remove all injected errors.
+        """
+        self._errors.clear()
+
+    def _read_frame(self, frame: int) -> Tuple[bytes, bytes]:
+        if not 0 <= frame < self.frame_count:
+            raise IOError(f"frame {frame} is outside the image")
+
+        offset = frame * BYTES_PER_FRAME_RAW
+        data = bytes(self._image[offset:offset + BYTES_PER_FRAME_RAW])
+        c2 = bytes(C2_BYTES_PER_FRAME)
+
+        error = self._errors.get(frame)
+        if error is not None and error[0] <= 0:
+            error = None
+
+        if (error is None and self.error_model is not None and
+                self.error_model(frame, self.speed)):
+            error = [1, True]
+
+        if error is not None:
+            error[0] -= 1
+            # Damage differs from read to read, as it does on real media.
+            noise = (self.frames_read * 31 + 17) & 0xff or 1
+            damaged = bytearray(data)
+            for i in range(0, 64):
+                damaged[i] ^= noise
+            data = bytes(damaged)
+
+            if error[1]:
+                c2 = b"\xff" * 8 + bytes(C2_BYTES_PER_FRAME - 8)
+
+        self.frames_read += 1
+        self.elapsed += 1.0 / (FRAMES_PER_SECOND * self.speed)
+        return (data, c2)
+
+    def read_audio(self, start_frame: int, frame_count: int) -> bytes:
+        return self.read_audio_c2(start_frame, frame_count)[0]
+
+    def read_audio_c2(
+            self, start_frame: int, frame_count: int) -> Tuple[bytes, bytes]:
+        self.read_commands += 1
+        frames = [self._read_frame(frame)
+                  for frame in range(start_frame, start_frame + frame_count)]
+        return (b"".join(frame[0] for frame in frames),
+                b"".join(frame[1] for frame in frames))
+
+    def read_subchannel_q(self, frame: int) -> Optional[SubchannelQ]:
+        if not 0 <= frame < self.frame_count:
+            raise IOError(f"frame {frame} is outside the image")
+
+        self.subchannel_reads += 1
+        position = max(
+            (item for item in self.track_indices.items() if item[1] <= frame),
+            key=lambda item: item[1])[0]
+        index_1 = self.track_indices.get(TrackIndex(position.track, 1), 0)
+        info = self.get_track_information(position.track)
+
+        return SubchannelQ(
+            control=int(info.flags),
+            track=position.track,
+            index=position.index,
+            relative=MSF.from_lba(abs(frame - index_1)),
+            absolute=MSF.from_lba(frame + GAP_FRAMES))
+
+    def get_media_catalog_number(self) -> Optional[str]:
+        return self.mcn
+
+    def get_isrc(self, track: int) -> Optional[str]:
+        self.subchannel_reads += 1
+        return self.isrcs.get(track)
+
+    def set_speed(self, speed: int) -> None:
+        if speed < 0:
+            raise ValueError("speed must be non-negative")
+
+        self.speed = min(speed, IMAGE_MAX_SPEED) or IMAGE_MAX_SPEED
+
+    def get_identity(self) -> DriveIdentity:
+        return self.identity
+
+    def _get_slot_count(self) -> int:
+        return 1
+
+    def get_status(self) -> DriveStatus:
+        return DriveStatus.ok
+
+    def get_capabilities(self) -> DriveCapability:
+        return (DriveCapability.SELECT_SPEED | DriveCapability.MCN |
+                DriveCapability.DRIVE_STATUS)
+
+    def media_changed(self) -> bool:
+        return False
+
+    def get_disc_information(self) -> DiscInformation:
+        return self._disc_information
+
+    def get_track_information(self, track: int) -> TrackInformation:
+        for info in self._disc_information.track_information:
+            if info.track == track:
+                return info
+
+        raise IOError(f"Track {track} is not on this disc")
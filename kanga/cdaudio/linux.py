@@ -3,14 +3,16 @@ Linux-specific functionality.
 """
 # pylint: disable=C0103,R0903
 from ctypes import (
-    CDLL, byref, c_int, c_uint8, c_ulong, get_errno, Structure, Union)
+    CDLL, addressof, byref, c_int, c_uint, c_uint8, c_ulong, c_ushort,
+    c_void_p, create_string_buffer, get_errno, Structure, Union)
+from errno import EIO
 from os import strerror
-from typing import Any, List, Optional
+from typing import Any, List, Optional, Tuple
 
 from .cd import (
-    DiscInformation, LEADOUT_TRACK, MSF, TrackFlags, TrackInformation,
-    TrackType)
-from .drive import CDROMDrive, DriveStatus
+    BYTES_PER_FRAME_RAW, C2_BYTES_PER_FRAME, DiscInformation, LEADOUT_TRACK,
+    MSF, SubchannelQ, TrackFlags, TrackInformation, TrackType)
+from .drive import CDROMDrive, DriveCapability, DriveIdentity, DriveStatus
 
 # From linux/cdrom.h
 CDROMPAUSE = 0x5301
@@ -21,9 +23,11 @@ CDROMREADTOCHDR = 0x5305
 CDROMREADTOCENTRY = 0x5306
 CDROMSTOP = 0x5307
 CDROMEJECT = 0x5309
+CDROM_GET_MCN = 0x5311
 CDROMRESET = 0x5312
 CDROMSEEK = 0x5316
 CDROMCLOSETRAY = 0x5319
+CDROM_SELECT_SPEED = 0x5322
 CDROM_SELECT_DISC = 0x5323
 CDROM_MEDIA_CHANGED = 0x5325
 CDROM_DRIVE_STATUS = 0x5326
@@ -32,6 +36,41 @@ CDROM_CHANGER_NSLOTS = 0x5328
 CDROM_LOCKDOOR = 0x5329
 CDROM_GET_CAPABILITY = 0x5331
 
+# From scsi/sg.h
+SG_IO = 0x2285
+SG_DXFER_NONE = -1
+SG_DXFER_FROM_DEV = -3
+SG_INFO_OK_MASK = 0x1
+SG_INFO_OK = 0x0
+SG_DEFAULT_TIMEOUT_MS = 30000
+SENSE_BUFFER_LEN = 32
+
+# MMC command opcodes
+MMC_INQUIRY = 0x12
+MMC_READ_SUB_CHANNEL = 0x42
+MMC_READ_CD = 0xBE
+
+# READ SUB-CHANNEL parameters
+READ_SUB_CHANNEL_SUBQ = 0x40
+READ_SUB_CHANNEL_ISRC = 0x03
+READ_SUB_CHANNEL_ISRC_LENGTH = 24
+
+INQUIRY_LENGTH = 36
+
+# READ CD expected sector type (byte 1) and field selection (byte 9) values.
+READ_CD_SECTOR_CDDA = 0x04
+READ_CD_USER_DATA = 0x10
+READ_CD_C2_ERROR_BITS = 0x02
+
+# READ CD sub-channel selection (byte 10) values.
+READ_CD_SUBCHANNEL_NONE = 0x00
+READ_CD_SUBCHANNEL_RAW = 0x01
+SUBCHANNEL_RAW_BYTES = 96
+
+# Largest number of frames requested in a single READ CD command; keeps each
+# transfer (with C2 data) under 64 KiB, which every host adapter accepts.
+READ_CD_MAX_FRAMES = 24
+
 # CD-ROM address types -- cdrom_tocentry.cdte_format
 CDROM_LBA = 0x01 # Logical block address; first frame is 0.
 CDROM_MSF = 0x02 # Minute/Second/Frame; binary, not BCD.
@@ -86,6 +125,14 @@ class cdrom_tochdr(Structure):
         ("cdth_trk1", c_uint8),
     ]
 
+class cdrom_mcn(Structure):
+    """
+    Structure used by the CDROM_GET_MCN ioctl.
+    """
+    _fields_ = [
+        ("medium_catalog_number", c_uint8 * 14),
+    ]
+
 class cdrom_tocentry(Structure):
     """
     Structure used by the CDROMREADTOCENTRY ioctl.
@@ -100,6 +147,78 @@ class cdrom_tocentry(Structure):
         ("cdte_datamode", c_uint8),
     ]
 
+class sg_io_hdr(Structure):
+    """
+    Structure used by the SG_IO ioctl to pass SCSI commands to a device.
+    """
+    _fields_ = [
+        ("interface_id", c_int),
+        ("dxfer_direction", c_int),
+        ("cmd_len", c_uint8),
+        ("mx_sb_len", c_uint8),
+        ("iovec_count", c_ushort),
+        ("dxfer_len", c_uint),
+        ("dxferp", c_void_p),
+        ("cmdp", c_void_p),
+        ("sbp", c_void_p),
+        ("timeout", c_uint),
+        ("flags", c_uint),
+        ("pack_id", c_int),
+        ("usr_ptr", c_void_p),
+        ("status", c_uint8),
+        ("masked_status", c_uint8),
+        ("msg_status", c_uint8),
+        ("sb_len_wr", c_uint8),
+        ("host_status", c_ushort),
+        ("driver_status", c_ushort),
+        ("resid", c_int),
+        ("duration", c_uint),
+        ("info", c_uint),
+    ]
+
+class SCSICommandError(IOError):
+    """
+    A SCSI command passed through SG_IO completed with an error status.
+    """
+    def __init__(self, opcode: int, sense: bytes) -> None:
+        if len(sense) >= 14:
+            sense_key = sense[2] & 0x0f
+            asc = sense[12]
+            ascq = sense[13]
+        else:
+            sense_key = asc = ascq = 0
+
+        super(SCSICommandError, self).__init__(
+            EIO,
+            f"SCSI command 0x{opcode:02X} failed: sense key 0x{sense_key:X} "
+            f"ASC 0x{asc:02X} ASCQ 0x{ascq:02X}")
+        self.opcode = opcode
+        self.sense_key = sense_key
+        self.asc = asc
+        self.ascq = ascq
+
+def deinterleave_q(raw: bytes) -> bytes:
+    """
+    Extract the 12-byte Q subchannel block from 96 bytes of raw P-W
+    subchannel data, where bit 6 of each byte carries one Q bit.
+    """
+    q = bytearray(12)
+    for i in range(SUBCHANNEL_RAW_BYTES):
+        if raw[i] & 0x40:
+            q[i >> 3] |= 0x80 >> (i & 7)
+    return bytes(q)
+
+def _valid_code(raw: bytes, length: int) -> Optional[str]:
+    """
+    Decode an MCN or ISRC, returning None if it is absent (all zeros) or
+    malformed.
+    """
+    code = raw[:length].decode("ascii", "replace").strip("\x00 ")
+    if len(code) != length or not code.isalnum() or not code.strip("0"):
+        return None
+
+    return code.upper()
+
 class LinuxCDROMDrive(CDROMDrive):
     """
     Linux-specific code for handling CD-ROM drives.
@@ -128,6 +247,112 @@ class LinuxCDROMDrive(CDROMDrive):
 
         return result
 
+    def _scsi_command(
+            self, cdb: bytes, transfer_length: int,
+            timeout_ms: int = SG_DEFAULT_TIMEOUT_MS) -> bytes:
+        """
+        Send a SCSI command via SG_IO, returning the data read from the
+        device.
+        """
+        cmd = create_string_buffer(bytes(cdb), len(cdb))
+        sense = create_string_buffer(SENSE_BUFFER_LEN)
+        data = create_string_buffer(max(transfer_length, 1))
+
+        hdr = sg_io_hdr()
+        hdr.interface_id = ord("S")
+        hdr.dxfer_direction = (
+            SG_DXFER_FROM_DEV if transfer_length else SG_DXFER_NONE)
+        hdr.cmd_len = len(cdb)
+        hdr.mx_sb_len = SENSE_BUFFER_LEN
+        hdr.dxfer_len = transfer_length
+        hdr.dxferp = addressof(data)
+        hdr.cmdp = addressof(cmd)
+        hdr.sbp = addressof(sense)
+        hdr.timeout = timeout_ms
+
+        self._ioctl(SG_IO, hdr)
+
+        if (hdr.info & SG_INFO_OK_MASK) != SG_INFO_OK:
+            raise SCSICommandError(cdb[0], sense.raw[:hdr.sb_len_wr])
+
+        return data.raw[:transfer_length - hdr.resid]
+
+    def _read_cd(
+            self, start_frame: int, frame_count: int, field_selection: int,
+            bytes_per_frame: int,
+            subchannel_selection: int = READ_CD_SUBCHANNEL_NONE) -> bytes:
+        """
+        Issue READ CD commands for CD-DA sectors, splitting the request so no
+        single transfer exceeds READ_CD_MAX_FRAMES frames.
+        """
+        result = []
+        end_frame = start_frame + frame_count
+        for lba in range(start_frame, end_frame, READ_CD_MAX_FRAMES):
+            count = min(READ_CD_MAX_FRAMES, end_frame - lba)
+            cdb = bytes([
+                MMC_READ_CD, READ_CD_SECTOR_CDDA,
+                (lba >> 24) & 0xff, (lba >> 16) & 0xff, (lba >> 8) & 0xff,
+                lba & 0xff,
+                (count >> 16) & 0xff, (count >> 8) & 0xff, count & 0xff,
+                field_selection, subchannel_selection, 0])
+            data = self._scsi_command(cdb, count * bytes_per_frame)
+            if len(data) != count * bytes_per_frame:
+                raise IOError(
+                    EIO, f"Short read at frame {lba}: got {len(data)} bytes, "
+                    f"expected {count * bytes_per_frame}")
+            result.append(data)
+
+        return b"".join(result)
+
+    def read_audio(self, start_frame: int, frame_count: int) -> bytes:
+        return self._read_cd(
+            start_frame, frame_count, READ_CD_USER_DATA, BYTES_PER_FRAME_RAW)
+
+    def read_audio_c2(
+            self, start_frame: int, frame_count: int) -> Tuple[bytes, bytes]:
+        bytes_per_frame = BYTES_PER_FRAME_RAW + C2_BYTES_PER_FRAME
+        raw = self._read_cd(
+            start_frame, frame_count,
+            READ_CD_USER_DATA | READ_CD_C2_ERROR_BITS, bytes_per_frame)
+
+        # The drive interleaves the C2 pointers after each frame's audio data.
+        audio = []
+        c2 = []
+        for offset in range(0, len(raw), bytes_per_frame):
+            audio.append(raw[offset:offset + BYTES_PER_FRAME_RAW])
+            c2.append(raw[offset + BYTES_PER_FRAME_RAW:
+                          offset + bytes_per_frame])
+
+        return (b"".join(audio), b"".join(c2))
+
+    def read_subchannel_q(self, frame: int) -> Optional[SubchannelQ]:
+        # CDROMSUBCHNL only reports the current play position, which is not
+        # tied to a specific frame; read the raw P-W subchannel alongside the
+        # frame instead and extract the Q bits so the CRC can be checked.
+        raw = self._read_cd(
+            frame, 1, READ_CD_USER_DATA,
+            BYTES_PER_FRAME_RAW + SUBCHANNEL_RAW_BYTES,
+            READ_CD_SUBCHANNEL_RAW)
+        return SubchannelQ.from_bytes(
+            deinterleave_q(raw[BYTES_PER_FRAME_RAW:]))
+
+    def get_media_catalog_number(self) -> Optional[str]:
+        mcn = cdrom_mcn()
+        self._ioctl(CDROM_GET_MCN, mcn)
+        return _valid_code(bytes(mcn.medium_catalog_number[:13]), 13)
+
+    def get_isrc(self, track: int) -> Optional[str]:
+        data = self._scsi_command(bytes([
+            MMC_READ_SUB_CHANNEL, 0, READ_SUB_CHANNEL_SUBQ,
+            READ_SUB_CHANNEL_ISRC, 0, 0, track, 0,
+            READ_SUB_CHANNEL_ISRC_LENGTH, 0]), READ_SUB_CHANNEL_ISRC_LENGTH)
+
+        # TCVal (byte 8, bit 7) indicates whether an ISRC was found.
+        if len(data) < 21 or not data[8] & 0x80:
+            return None
+
+        return _valid_code(data[9:21], 12)
+
     def play(self) -> None:
         self._ioctl(CDROMRESUME)
 
@@ -167,6 +392,23 @@ class LinuxCDROMDrive(CDROMDrive):
     def reset(self) -> None:
         self._ioctl(CDROMRESET)
 
+    def set_speed(self, speed: int) -> None:
+        if not isinstance(speed, int):
+            raise TypeError("speed must be an integer")
+
+        if speed < 0:
+            raise ValueError("speed must be non-negative")
+
+        self._ioctl(CDROM_SELECT_SPEED, speed)
+
+    def get_identity(self) -> DriveIdentity:
+        data = self._scsi_command(
+            bytes([MMC_INQUIRY, 0, 0, 0, INQUIRY_LENGTH, 0]), INQUIRY_LENGTH)
+        return DriveIdentity(
+            vendor=data[8:16].decode("ascii", "replace").strip(),
+            model=data[16:32].decode("ascii", "replace").strip(),
+            revision=data[32:36].decode("ascii", "replace").strip())
+
     def _get_slot_count(self) -> int:
         return self._ioctl(CDROM_CHANGER_NSLOTS)
 
@@ -192,6 +434,12 @@ class LinuxCDROMDrive(CDROMDrive):
 
         return DriveStatus.unknown
 
+    def get_capabilities(self) -> DriveCapability:
+        return DriveCapability(self._ioctl(CDROM_GET_CAPABILITY))
+
+    def media_changed(self) -> bool:
+        return self._ioctl(CDROM_MEDIA_CHANGED, CDSL_CURRENT) != 0
+
     def get_disc_information(self) -> DiscInformation:
         # Get the first and last track numbers
         tochdr = cdrom_tochdr()
@@ -0,0 +1,468 @@
+"""
+Digital playback of CD audio by streaming sector reads.
+
+The drive's own play/pause/stop commands only drive its analog output.
+PlaybackEngine instead reads audio sectors on a background thread into a
+read-ahead buffer and hands the PCM (16-bit little-endian stereo) to a
+single consumer. Audio tracks are read back to back, so playback is gapless
+across track boundaries, and data tracks are skipped.
+
+A seek discards the buffer and restarts reading at the requested sample. The
+first read after a seek is kept small so audio is available as soon as the
+drive can deliver a few frames; the time from each seek to its first audio
+is recorded in seek_latencies.
+
+PlaybackHTTPServer and PlaybackUnixServer stream the engine's output to a
+local consumer: the HTTP server serves a WAV stream plus seek and status
+endpoints, and the Unix socket server streams raw PCM.
+"""
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from logging import getLogger
+from socketserver import StreamRequestHandler, ThreadingMixIn, UnixStreamServer
+from struct import pack
+from threading import Condition, Thread
+from time import monotonic
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
+
+from .cd import (
+    BYTES_PER_FRAME_RAW, FRAMES_PER_SECOND, MSF, DiscInformation, TrackType)
+from .drive import CDROMDrive
+from .flac import (
+    BYTES_PER_SAMPLE_FRAME, CD_BITS_PER_SAMPLE, CD_CHANNELS, CD_SAMPLE_RATE)
+
+# pylint: disable=R0902,R0913
+
+SAMPLES_PER_FRAME = BYTES_PER_FRAME_RAW // BYTES_PER_SAMPLE_FRAME
+
+# Frames buffered ahead of the consumer; two seconds.
+DEFAULT_READ_AHEAD_FRAMES = 2 * FRAMES_PER_SECOND
+
+# Frames per read once playback is under way, and for the first read after a
+# seek.
+DEFAULT_BATCH_FRAMES = 24
+SEEK_BATCH_FRAMES = 2
+
+# Attempts at reading a frame before it is played as silence.
+MAX_READ_ATTEMPTS = 3
+
+# Number of recent seek latencies kept.
+SEEK_LATENCY_HISTORY = 100
+
+# Bytes written to a consumer at a time.
+STREAM_CHUNK_BYTES = BYTES_PER_FRAME_RAW * 4
+
+SILENT_FRAME = bytes(BYTES_PER_FRAME_RAW)
+
+log = getLogger(__name__)
+
+def audio_extents(disc_info: DiscInformation) -> List[Tuple[int, int]]:
+    """
+    Return the [start, end) frame ranges holding audio, merging adjacent
+    tracks so they play without a gap.
+    """
+    extents: List[Tuple[int, int]] = []
+    for info in disc_info.track_information:
+        if info.track_type != TrackType.audio:
+            continue
+
+        start, end = disc_info.get_track_frames(info.track)
+        if extents and extents[-1][1] == start:
+            extents[-1] = (extents[-1][0], end)
+        else:
+            extents.append((start, end))
+    return extents
+
+class PlaybackEngine:
+    """
+    Stream a disc's audio to a single consumer with read-ahead and
+    sample-accurate seeking. Call start() to begin reading and read() to
+    consume PCM.
+    """
+    def __init__(
+            self, drive: CDROMDrive,
+            read_ahead_frames: int = DEFAULT_READ_AHEAD_FRAMES,
+            batch_frames: int = DEFAULT_BATCH_FRAMES,
+            clock: Callable[[], float] = monotonic) -> None:
+        super(PlaybackEngine, self).__init__()
+        if batch_frames <= 0:
+            raise ValueError("batch_frames must be positive")
+
+        self.drive = drive
+        self.disc_info = drive.get_disc_information()
+        self.extents = audio_extents(self.disc_info)
+        if not self.extents:
+            raise ValueError("Disc has no audio tracks")
+
+        self.read_ahead_frames = max(read_ahead_frames, batch_frames)
+        self.batch_frames = batch_frames
+        self.clock = clock
+        self.seek_latencies: Deque[float] = deque(maxlen=SEEK_LATENCY_HISTORY)
+
+        self._condition = Condition()
+        self._buffer: Deque[bytes] = deque()
+        self._buffered_bytes = 0
+        self._generation = 0
+        self._next_frame: Optional[int] = self.extents[0][0]
+        self._skip_samples = 0
+        self._consumer_sample = self.extents[0][0] * SAMPLES_PER_FRAME
+        self._seek_started: Optional[float] = None
+        self._closed = False
+        self._thread = Thread(
+            target=self._read_loop, name="PlaybackReader", daemon=True)
+
+    def start(self) -> None:
+        """
+        Start reading ahead from the current position.
+        """
+        self._thread.start()
+
+    def close(self) -> None:
+        """
+        Stop reading and wake any waiting consumer.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def read(self, size: int = STREAM_CHUNK_BYTES,
+             timeout: Optional[float] = None) -> Optional[bytes]:
+        """
+        Return up to size bytes of PCM from the current position, blocking
+        until some is available. Returns b"" at the end of the disc or once
+        closed, and None if the timeout expired first.
+        """
+        size -= size % BYTES_PER_SAMPLE_FRAME
+        with self._condition:
+            if not self._condition.wait_for(
+                    lambda: (self._closed or self._buffer or
+                             self._next_frame is None), timeout):
+                return None
+
+            if self._closed:
+                return b""
+
+            result = bytearray()
+            while self._buffer and len(result) < size:
+                chunk = self._buffer.popleft()
+                wanted = size - len(result)
+                if len(chunk) > wanted:
+                    self._buffer.appendleft(chunk[wanted:])
+                    chunk = chunk[:wanted]
+                result.extend(chunk)
+
+            self._consumer_sample += len(result) // BYTES_PER_SAMPLE_FRAME
+            self._buffered_bytes -= len(result)
+            self._condition.notify_all()
+            return bytes(result)
+
+    def seek(self, position: MSF, sample: int = 0) -> None:
+        """
+        Continue playback from sample (0-587) of the frame at position.
+        """
+        if not isinstance(position, MSF):
+            raise TypeError("position must be an MSF instance")
+
+        if not position.is_valid:
+            raise ValueError("position is invalid")
+
+        if not 0 <= sample < SAMPLES_PER_FRAME:
+            raise ValueError(
+                f"sample must be between 0 and {SAMPLES_PER_FRAME - 1}: "
+                f"{sample}")
+
+        self.seek_sample(position.lba * SAMPLES_PER_FRAME + sample)
+
+    def seek_track(self, track: int) -> None:
+        """
+        Continue playback from the start of a track.
+        """
+        start_frame, _ = self.disc_info.get_track_frames(track)
+        self.seek_sample(start_frame * SAMPLES_PER_FRAME)
+
+    def seek_sample(self, sample: int) -> None:
+        """
+        Continue playback from an absolute sample position on the disc.
+        """
+        frame, offset = divmod(sample, SAMPLES_PER_FRAME)
+        if not any(start <= frame < end for start, end in self.extents):
+            raise ValueError(f"Frame {frame} does not hold audio")
+
+        with self._condition:
+            self._generation += 1
+            self._buffer.clear()
+            self._buffered_bytes = 0
+            self._next_frame = frame
+            self._skip_samples = offset
+            self._consumer_sample = sample
+            self._seek_started = self.clock()
+            self._condition.notify_all()
+
+    @property
+    def position(self) -> Tuple[MSF, int]:
+        """
+        The position of the next sample returned by read(), as the MSF of its
+        frame and the sample within that frame.
+        """
+        with self._condition:
+            frame, offset = divmod(self._consumer_sample, SAMPLES_PER_FRAME)
+        return (MSF.from_lba(frame), offset)
+
+    @property
+    def track(self) -> Optional[int]:
+        """
+        The track holding the next sample returned by read().
+        """
+        with self._condition:
+            frame = self._consumer_sample // SAMPLES_PER_FRAME
+
+        current = None
+        for info in self.disc_info.track_information:
+            if info.track_type == TrackType.leadout:
+                break
+            if info.start_frame <= frame:
+                current = info.track
+        return current
+
+    @property
+    def buffered_frames(self) -> int:
+        """
+        The number of frames read ahead of the consumer.
+        """
+        with self._condition:
+            return self._buffered_bytes // BYTES_PER_FRAME_RAW
+
+    def status(self) -> Dict[str, Any]:
+        """
+        Return the playback position and recent seek latencies as a
+        JSON-serializable dict.
+        """
+        position, sample = self.position
+        latencies = list(self.seek_latencies)
+        return {
+            "position": f"{position.minute:02d}:{position.second:02d}:"
+                        f"{position.frame:02d}",
+            "sample": sample,
+            "track": self.track,
+            "buffered_frames": self.buffered_frames,
+            "last_seek_latency": latencies[-1] if latencies else None,
+            "mean_seek_latency": (
+                sum(latencies) / len(latencies) if latencies else None),
+        }
+
+    def _read_loop(self) -> None:
+        while True:
+            with self._condition:
+                self._condition.wait_for(
+                    lambda: self._closed or (
+                        self._next_frame is not None and
+                        self._buffered_bytes <
+                        self.read_ahead_frames * BYTES_PER_FRAME_RAW))
+                if self._closed:
+                    return
+
+                generation = self._generation
+                frame = self._next_frame
+                assert frame is not None
+                extent_end = self._extent_end(frame)
+                batch = (
+                    SEEK_BATCH_FRAMES if self._seek_started is not None
+                    else self.batch_frames)
+                count = min(batch, extent_end - frame)
+
+            data = self._read_frames(frame, count)
+
+            with self._condition:
+                if generation != self._generation:
+                    # A seek arrived while reading; drop what we read.
+                    continue
+
+                if self._skip_samples:
+                    data = data[self._skip_samples * BYTES_PER_SAMPLE_FRAME:]
+                    self._skip_samples = 0
+
+                self._buffer.append(data)
+                self._buffered_bytes += len(data)
+                self._next_frame = self._following_frame(frame + count)
+
+                if self._seek_started is not None:
+                    latency = self.clock() - self._seek_started
+                    self.seek_latencies.append(latency)
+                    self._seek_started = None
+                    log.debug("Seek to frame %d took %.1f ms", frame,
+                              latency * 1000.0)
+
+                self._condition.notify_all()
+
+    def _extent_end(self, frame: int) -> int:
+        for start, end in self.extents:
+            if start <= frame < end:
+                return end
+        raise ValueError(f"Frame {frame} does not hold audio")
+
+    def _following_frame(self, frame: int) -> Optional[int]:
+        """
+        Return the next audio frame at or after frame, or None at the end of
+        the disc.
+        """
+        for start, end in self.extents:
+            if frame < end:
+                return max(frame, start)
+        return None
+
+    def _read_frames(self, start_frame: int, count: int) -> bytes:
+        """
+        Read frames, retrying failed reads one frame at a time and playing
+        frames that still can't be read as silence.
+        """
+        try:
+            return self.drive.read_audio(start_frame, count)
+        except IOError:
+            if count == 1:
+                for _ in range(MAX_READ_ATTEMPTS - 1):
+                    try:
+                        return self.drive.read_audio(start_frame, 1)
+                    except IOError:
+                        pass
+                log.warning("Unable to read frame %d; playing silence",
+                            start_frame)
+                return SILENT_FRAME
+
+        return b"".join(
+            self._read_frames(frame, 1)
+            for frame in range(start_frame, start_frame + count))
+
+def wav_stream_header() -> bytes:
+    """
+    Return a WAV header for a stream of unknown length.
+    """
+    block_align = CD_CHANNELS * CD_BITS_PER_SAMPLE // 8
+    return b"".join([
+        b"RIFF", pack("<I", 0xFFFFFFFF), b"WAVE",
+        b"fmt ", pack("<IHHIIHH", 16, 1, CD_CHANNELS, CD_SAMPLE_RATE,
+                      CD_SAMPLE_RATE * block_align, block_align,
+                      CD_BITS_PER_SAMPLE),
+        b"data", pack("<I", 0xFFFFFFFF)])
+
+def stream_to(engine: PlaybackEngine, write: Callable[[bytes], Any]) -> None:
+    """
+    Write the engine's output with write() until the end of the disc, the
+    engine is closed, or the consumer disconnects.
+    """
+    try:
+        while True:
+            data = engine.read(STREAM_CHUNK_BYTES)
+            if not data:
+                return
+            write(data)
+    except (BrokenPipeError, ConnectionResetError):
+        log.info("Playback consumer disconnected")
+
+class PlaybackRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serve the playback stream and controls:
+
+    GET /stream             WAV stream from the current position
+    GET /stream?format=raw  Raw 16-bit little-endian stereo PCM
+    GET /seek?msf=MM:SS:FF[&sample=N] | ?track=N | ?sample=N
+    GET /status             Position, buffer level and seek latency
+    """
+    server: "PlaybackHTTPServer"
+
+    def do_GET(self) -> None:
+        # pylint: disable=C0103
+        url = urlsplit(self.path)
+        query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+        engine = self.server.engine
+
+        if url.path == "/stream":
+            raw = query.get("format") == "raw"
+            self.send_response(200)
+            self.send_header(
+                "Content-Type", "application/octet-stream" if raw
+                else "audio/wav")
+            self.send_header("Cache-Control", "no-store")
+            self.end_headers()
+            if not raw:
+                self.wfile.write(wav_stream_header())
+            stream_to(engine, self.wfile.write)
+            return
+
+        if url.path == "/seek":
+            try:
+                if "msf" in query:
+                    minute, second, frame = (
+                        int(part) for part in query["msf"].split(":"))
+                    engine.seek(
+                        MSF(minute, second, frame),
+                        int(query.get("sample", 0)))
+                elif "track" in query:
+                    engine.seek_track(int(query["track"]))
+                elif "sample" in query:
+                    engine.seek_sample(int(query["sample"]))
+                else:
+                    raise ValueError("Expected msf, track or sample")
+            except (TypeError, ValueError) as e:
+                self.send_json(400, {"error": str(e)})
+                return
+
+            self.send_json(200, engine.status())
+            return
+
+        if url.path == "/status":
+            self.send_json(200, engine.status())
+            return
+
+        self.send_json(404, {"error": f"Unknown path {url.path}"})
+
+    def send_json(self, status: int, body: Dict[str, Any]) -> None:
+        """
+        Send a JSON response.
+        """
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args) -> None: # pylint: disable=W0622
+        log.debug("%s " + format, self.address_string(), *args)
+
+class PlaybackHTTPServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server exposing a PlaybackEngine. Only one stream should be open at
+    a time, since streams share the engine's position.
+    """
+    daemon_threads = True
+
+    def __init__(self, address: Tuple[str, int],
+                 engine: PlaybackEngine) -> None:
+        super(PlaybackHTTPServer, self).__init__(
+            address, PlaybackRequestHandler)
+        self.engine = engine
+
+class PlaybackUnixRequestHandler(StreamRequestHandler):
+    """
+    Stream raw 16-bit little-endian stereo PCM to a Unix socket client.
+    """
+    server: "PlaybackUnixServer"
+
+    def handle(self) -> None:
+        stream_to(self.server.engine, self.wfile.write)
+
+class PlaybackUnixServer(ThreadingMixIn, UnixStreamServer):
+    """
+    Unix socket server streaming a PlaybackEngine's output.
+    """
+    daemon_threads = True
+
+    def __init__(self, path: str, engine: PlaybackEngine) -> None:
+        super(PlaybackUnixServer, self).__init__(
+            path, PlaybackUnixRequestHandler)
+        self.engine = engine
@@ -0,0 +1,425 @@
+"""
+Shared-memory ring buffer carrying raw CD frames between processes.
+
+Reading a drive from a thread means competing for the interpreter with
+hashing, loudness analysis and upload threads, and handing audio to another
+process through a pipe or queue copies it twice. FrameRing instead holds a
+fixed number of slots in a multiprocessing.shared_memory segment. A single
+producer -- usually RingReader, which extracts in a process of its own --
+fills slots with runs of frames, and every consumer sees every slot through
+a memoryview of the shared segment without copying it.
+
+Each slot carries a reference count set to the number of consumers when it
+is published. A consumer releases a slot once it is done with the view; the
+producer reuses a slot only after every consumer has released it, so a slow
+consumer applies backpressure to the reader rather than being overrun.
+
+multiprocessing.shared_memory requires Python 3.8; use ring_available() to
+check for it.
+"""
+from logging import getLogger
+import os
+from multiprocessing import Pipe, Process, get_context
+from multiprocessing.connection import Connection
+from time import monotonic
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError: # pragma: no cover
+    SharedMemory = None # type: ignore
+
+from .cd import BYTES_PER_FRAME_RAW
+from .drive import CDROMDrive
+from .extract import SecureExtractor
+from .continuous import read_sequential
+
+# pylint: disable=R0902,R0913
+
+# One second of audio per slot and about six seconds in the ring.
+DEFAULT_SLOT_FRAMES = 75
+DEFAULT_SLOT_COUNT = 80
+
+# Ring header fields, as 64-bit integers: the number of slots published,
+# whether the producer has finished, and whether it failed.
+_PUBLISHED = 0
+_CLOSED = 1
+_FAILED = 2
+_HEADER_FIELDS = 4
+
+# Per-slot fields following the header: first frame, data length in bytes and
+# outstanding consumer references.
+_SLOT_START = 0
+_SLOT_LENGTH = 1
+_SLOT_REFS = 2
+_SLOT_FIELDS = 3
+
+_FIELD_BYTES = 8
+
+log = getLogger(__name__)
+
+def ring_available() -> bool:
+    """
+    Indicates whether multiprocessing.shared_memory is available.
+    """
+    return SharedMemory is not None
+
+class RingSlot:
+    """
+    A published run of frames, viewed in place in the shared segment. Call
+    release() (or use it as a context manager) once the data is no longer
+    needed; data must not be used afterwards.
+    """
+    __slots__ = ("ring", "index", "start_frame", "data")
+
+    def __init__(self, ring: "FrameRing", index: int, start_frame: int,
+                 data: memoryview) -> None:
+        super(RingSlot, self).__init__()
+        self.ring = ring
+        self.index = index
+        self.start_frame = start_frame
+        self.data: Optional[memoryview] = data
+
+    @property
+    def frame_count(self) -> int:
+        """
+        The number of frames in the slot.
+        """
+        return len(self.data) // BYTES_PER_FRAME_RAW if self.data else 0
+
+    def release(self) -> None:
+        """
+        Release this consumer's reference to the slot.
+        """
+        if self.data is None:
+            return
+
+        self.data.release()
+        self.data = None
+        self.ring._release(self.index) # pylint: disable=W0212
+
+    def __enter__(self) -> "RingSlot":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        self.release()
+
+class RingConsumer:
+    """
+    One consumer's position in a FrameRing. Each consumer sees every slot
+    the producer publishes, in order.
+    """
+    def __init__(self, ring: "FrameRing") -> None:
+        super(RingConsumer, self).__init__()
+        self.ring = ring
+        self._next = 0
+
+    def get(self, timeout: Optional[float] = None) -> Optional[RingSlot]:
+        """
+        Return the next slot, waiting for it to be published. Returns None
+        once the producer has finished and every slot has been read. Raises
+        IOError if the producer failed, or TimeoutError if timeout expires.
+        """
+        slot = self.ring._get(self._next, timeout) # pylint: disable=W0212
+        if slot is not None:
+            self._next += 1
+        return slot
+
+    def __iter__(self) -> Iterator[RingSlot]:
+        while True:
+            slot = self.get()
+            if slot is None:
+                return
+            yield slot
+
+class FrameRing:
+    """
+    A single-producer ring of slot_count slots, each holding up to
+    slot_frames raw frames, shared with a fixed number of consumers.
+
+    The process that creates the ring owns the shared segment and must call
+    close() to free it. The ring can be passed to child processes as a
+    Process argument; they attach to the same segment.
+    """
+    def __init__(
+            self, consumers: int = 1,
+            slot_count: int = DEFAULT_SLOT_COUNT,
+            slot_frames: int = DEFAULT_SLOT_FRAMES) -> None:
+        super(FrameRing, self).__init__()
+        if SharedMemory is None:
+            raise RuntimeError(
+                "multiprocessing.shared_memory requires Python 3.8 or later")
+
+        if consumers < 1:
+            raise ValueError("consumers must be at least 1")
+
+        if slot_count < 2 or slot_frames < 1:
+            raise ValueError("A ring needs at least 2 slots of 1 frame")
+
+        self.consumers = consumers
+        self.slot_count = slot_count
+        self.slot_bytes = slot_frames * BYTES_PER_FRAME_RAW
+        self._cond = get_context().Condition()
+        # A forked child inherits this object, so ownership is decided by
+        # process ID rather than a flag.
+        self._owner_pid = os.getpid()
+        self._written = 0
+
+        # New segments are zero-filled: nothing published, no references.
+        self._shm = SharedMemory(create=True, size=self._segment_size())
+        self._attach()
+
+    def _segment_size(self) -> int:
+        """
+        The size of the shared segment: the header fields, then the slots.
+        """
+        return (
+            (_HEADER_FIELDS + _SLOT_FIELDS * self.slot_count) * _FIELD_BYTES +
+            self.slot_count * self.slot_bytes)
+
+    def _attach(self) -> None:
+        """
+        Create the views of the header fields and slot data.
+        """
+        header_bytes = (
+            (_HEADER_FIELDS + _SLOT_FIELDS * self.slot_count) * _FIELD_BYTES)
+        self._fields = self._shm.buf[:header_bytes].cast("q")
+        self._data = self._shm.buf[header_bytes:]
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {
+            "name": self._shm.name, "consumers": self.consumers,
+            "slot_count": self.slot_count, "slot_bytes": self.slot_bytes,
+            "cond": self._cond}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        self.consumers = state["consumers"]
+        self.slot_count = state["slot_count"]
+        self.slot_bytes = state["slot_bytes"]
+        self._cond = state["cond"]
+        self._owner_pid = -1
+        self._written = 0
+        self._shm = SharedMemory(name=state["name"])
+        self._attach()
+
+    @property
+    def slot_frames(self) -> int:
+        """
+        The maximum number of frames held by a slot.
+        """
+        return self.slot_bytes // BYTES_PER_FRAME_RAW
+
+    def consumer(self) -> RingConsumer:
+        """
+        Return a cursor for one of the ring's consumers. Create exactly
+        consumers cursors, one per consuming thread or process.
+        """
+        return RingConsumer(self)
+
+    def write(self, start_frame: int, data: bytes,
+              timeout: Optional[float] = None) -> None:
+        """
+        Publish a run of frames, waiting for the next slot to be released by
+        every consumer. Raises TimeoutError if timeout expires first.
+        """
+        if len(data) > self.slot_bytes or len(data) % BYTES_PER_FRAME_RAW:
+            raise ValueError(
+                f"Slot data must be whole frames, at most {self.slot_bytes} "
+                f"bytes: {len(data)}")
+
+        index = self._written % self.slot_count
+        base = _HEADER_FIELDS + _SLOT_FIELDS * index
+        with self._cond:
+            if not self._cond.wait_for(
+                    lambda: self._fields[base + _SLOT_REFS] == 0, timeout):
+                raise TimeoutError("Timed out waiting for a free ring slot")
+
+        # The slot is unreferenced, so no consumer is viewing it.
+        offset = index * self.slot_bytes
+        self._data[offset:offset + len(data)] = data
+
+        with self._cond:
+            self._fields[base + _SLOT_START] = start_frame
+            self._fields[base + _SLOT_LENGTH] = len(data)
+            self._fields[base + _SLOT_REFS] = self.consumers
+            self._written += 1
+            self._fields[_PUBLISHED] = self._written
+            self._cond.notify_all()
+
+    def write_frames(
+            self, frames: Iterable[Tuple[int, bytes]],
+            timeout: Optional[float] = None) -> int:
+        """
+        Publish (frame, data) pairs in order, such as those yielded by
+        SecureExtractor.extract(), batching consecutive frames into slots.
+        Returns the number of frames written.
+        """
+        pending = bytearray()
+        pending_start = 0
+        written = 0
+
+        for frame, data in frames:
+            if pending and (
+                    frame != pending_start +
+                    len(pending) // BYTES_PER_FRAME_RAW or
+                    len(pending) + len(data) > self.slot_bytes):
+                self.write(pending_start, bytes(pending), timeout)
+                pending.clear()
+
+            if not pending:
+                pending_start = frame
+            pending += data
+            written += len(data) // BYTES_PER_FRAME_RAW
+
+        if pending:
+            self.write(pending_start, bytes(pending), timeout)
+        return written
+
+    def finish(self, failed: bool = False) -> None:
+        """
+        Mark the end of the stream. Consumers receive the remaining slots,
+        then None; if failed is set they raise IOError instead.
+        """
+        with self._cond:
+            self._fields[_CLOSED] = 1
+            if failed:
+                self._fields[_FAILED] = 1
+            self._cond.notify_all()
+
+    def _get(self, sequence: int,
+             timeout: Optional[float]) -> Optional[RingSlot]:
+        """
+        Wait for the slot with the given sequence number to be published.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._fields[_FAILED]:
+                    raise IOError("The ring producer failed")
+                if self._fields[_PUBLISHED] > sequence:
+                    break
+                if self._fields[_CLOSED]:
+                    return None
+
+                remaining = (
+                    None if deadline is None else deadline - monotonic())
+                if remaining is not None and remaining <= 0:
+                    raise TimeoutError("Timed out waiting for ring data")
+                self._cond.wait(remaining)
+
+            index = sequence % self.slot_count
+            base = _HEADER_FIELDS + _SLOT_FIELDS * index
+            start_frame = self._fields[base + _SLOT_START]
+            length = self._fields[base + _SLOT_LENGTH]
+
+        offset = index * self.slot_bytes
+        return RingSlot(
+            self, index, start_frame, self._data[offset:offset + length])
+
+    def _release(self, index: int) -> None:
+        """
+        Drop one consumer reference to a slot, waking the producer when the
+        slot becomes free.
+        """
+        base = _HEADER_FIELDS + _SLOT_FIELDS * index
+        with self._cond:
+            self._fields[base + _SLOT_REFS] -= 1
+            if self._fields[base + _SLOT_REFS] == 0:
+                self._cond.notify_all()
+
+    def close(self) -> None:
+        """
+        Detach from the shared segment, freeing it if this process created
+        the ring. Every slot view must have been released.
+        """
+        self._fields.release()
+        self._data.release()
+        self._shm.close()
+        if self._owner_pid == os.getpid():
+            self._shm.unlink()
+
+def _read_into_ring(
+        ring: FrameRing, filename: str, start_frame: int, end_frame: int,
+        secure: bool, defeat_drive_cache: bool, conn: Connection) -> None:
+    """
+    RingReader process body: extract frames into the ring, then report the
+    frames that could not be read reliably.
+    """
+    unrecovered: List[int] = []
+    try:
+        drive = CDROMDrive.from_filename(filename)
+        if secure:
+            extractor = SecureExtractor(
+                drive, defeat_drive_cache=defeat_drive_cache)
+            ring.write_frames(extractor.extract(start_frame, end_frame))
+            unrecovered = extractor.stats.unrecovered_frames
+        else:
+            frame = start_frame
+            for data in read_sequential(
+                    drive, start_frame, end_frame, ring.slot_frames,
+                    unrecovered):
+                ring.write(frame, data)
+                frame += len(data) // BYTES_PER_FRAME_RAW
+        ring.finish()
+        conn.send(unrecovered)
+    except BaseException:
+        log.error("Reading %s frames %d-%d failed", filename, start_frame,
+                  end_frame, exc_info=True)
+        ring.finish(failed=True)
+        raise
+    finally:
+        conn.close()
+        ring.close()
+
+class RingReader:
+    """
+    Extract frames [start_frame, end_frame) from a drive into a FrameRing in
+    a separate process, so the reads are never held up by Python work in
+    the consuming process. The drive is opened by filename in the child.
+    """
+    def __init__(
+            self, ring: FrameRing, filename: str, start_frame: int,
+            end_frame: int, secure: bool = True,
+            defeat_drive_cache: bool = True) -> None:
+        super(RingReader, self).__init__()
+        self._conn, child_conn = Pipe(duplex=False)
+        self.process = Process(
+            target=_read_into_ring, name=f"RingReader-{filename}",
+            args=(ring, filename, start_frame, end_frame, secure,
+                  defeat_drive_cache, child_conn),
+            daemon=True)
+        self._child_conn = child_conn
+
+    def start(self) -> None:
+        """
+        Start reading.
+        """
+        self.process.start()
+        self._child_conn.close()
+
+    def join(self) -> List[int]:
+        """
+        Wait for the reader to finish, returning the frames it could not read
+        reliably. Raises IOError if it failed.
+        """
+        try:
+            unrecovered = self._conn.recv()
+        except EOFError:
+            unrecovered = None
+        self.process.join()
+        self._conn.close()
+
+        if unrecovered is None or self.process.exitcode != 0:
+            raise IOError(
+                f"Ring reader failed: exit code {self.process.exitcode}")
+        return unrecovered
+
+    def close(self) -> None:
+        """
+        Stop the reader if it is still running, e.g. because the consumer
+        gave up and it is blocked waiting for a free slot.
+        """
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+        self._conn.close()
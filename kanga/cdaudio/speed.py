@@ -0,0 +1,327 @@
+"""
+Adaptive read-speed control.
+
+The SpeedController raises a drive's read speed while reads come back clean
+and backs off when flagged frames or disagreeing re-reads cluster. Outcomes
+at each speed are recorded in a SpeedHistory, which persists across discs so
+each drive starts at the speed that has given it the highest sustained
+error-free throughput.
+"""
+from collections import deque
+import json
+from logging import getLogger
+import os
+from threading import RLock
+from typing import Any, Deque, Dict, Optional, Sequence
+
+from .drive import CDROMDrive
+
+# pylint: disable=R0902,R0913
+
+DEFAULT_SPEEDS = (4, 8, 12, 16, 24, 32, 40, 48)
+DEFAULT_WINDOW = 8
+DEFAULT_MAX_WINDOW_ERRORS = 2
+DEFAULT_PROMOTE_AFTER = 16
+DEFAULT_MAX_ERROR_RATE = 0.001
+
+# Minimum number of frames read at a speed before its history is trusted.
+MIN_HISTORY_FRAMES = 75 * 60
+
+log = getLogger(__name__)
+
+class SpeedRecord:
+    """
+    Accumulated read outcomes for a single drive at a single speed.
+    """
+    __slots__ = ("frames", "error_frames", "retries", "seconds")
+
+    def __init__(self, frames: int = 0, error_frames: int = 0,
+                 retries: int = 0, seconds: float = 0.0) -> None:
+        super(SpeedRecord, self).__init__()
+        self.frames = frames
+        self.error_frames = error_frames
+        self.retries = retries
+        self.seconds = seconds
+
+    @property
+    def error_rate(self) -> float:
+        """
+        The fraction of frames read at this speed that were flagged as bad.
+        """
+        if not self.frames:
+            return 0.0
+
+        return self.error_frames / self.frames
+
+    @property
+    def throughput(self) -> float:
+        """
+        Frames extracted per second at this speed, including time spent on
+        retries.
+        """
+        if self.seconds <= 0.0:
+            return 0.0
+
+        return self.frames / self.seconds
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Return this record as a JSON-serializable dict.
+        """
+        return {
+            "frames": self.frames, "error_frames": self.error_frames,
+            "retries": self.retries, "seconds": self.seconds}
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "SpeedRecord":
+        """
+        Create a SpeedRecord from a dict produced by to_json().
+        """
+        return SpeedRecord(
+            frames=int(data.get("frames", 0)),
+            error_frames=int(data.get("error_frames", 0)),
+            retries=int(data.get("retries", 0)),
+            seconds=float(data.get("seconds", 0.0)))
+
+class SpeedHistory:
+    """
+    Per-drive read outcomes by speed, optionally persisted to a JSON file.
+    A single history may be shared by controllers for several drives.
+    """
+    def __init__(self, filename: Optional[str] = None) -> None:
+        super(SpeedHistory, self).__init__()
+        self.filename = filename
+        self._drives: Dict[str, Dict[int, SpeedRecord]] = {}
+        self._lock = RLock()
+
+        if filename is not None and os.path.exists(filename):
+            self.load()
+
+    def load(self) -> None:
+        """
+        Replace the in-memory history with the contents of the history file.
+        """
+        if self.filename is None:
+            raise ValueError("No history filename specified")
+
+        with open(self.filename, "r") as fd:
+            data = json.load(fd)
+
+        self._drives = {
+            drive_key: {
+                int(speed): SpeedRecord.from_json(record)
+                for speed, record in speeds.items()}
+            for drive_key, speeds in data.items()}
+
+    def save(self) -> None:
+        """
+        Write the history to the history file, replacing it atomically.
+        """
+        if self.filename is None:
+            return
+
+        with self._lock:
+            data = {
+                drive_key: {
+                    str(speed): record.to_json()
+                    for speed, record in speeds.items()}
+                for drive_key, speeds in self._drives.items()}
+
+            temp_filename = f"{self.filename}.tmp"
+            with open(temp_filename, "w") as fd:
+                json.dump(data, fd, indent=2, sort_keys=True)
+            os.replace(temp_filename, self.filename)
+
+    def get(self, drive_key: str, speed: int) -> SpeedRecord:
+        """
+        Return the record for the specified drive and speed, creating it if
+        necessary.
+        """
+        with self._lock:
+            speeds = self._drives.setdefault(drive_key, {})
+            record = speeds.get(speed)
+            if record is None:
+                record = SpeedRecord()
+                speeds[speed] = record
+            return record
+
+    def record(self, drive_key: str, speed: int, frames: int,
+               error_frames: int, retries: int, seconds: float) -> None:
+        """
+        Add a read outcome to the history.
+        """
+        with self._lock:
+            record = self.get(drive_key, speed)
+            record.frames += frames
+            record.error_frames += error_frames
+            record.retries += retries
+            record.seconds += seconds
+
+    def is_reliable(self, drive_key: str, speed: int,
+                    max_error_rate: float = DEFAULT_MAX_ERROR_RATE) -> bool:
+        """
+        Indicates whether the history does not rule out the speed for this
+        drive: either too little has been read to judge it, or its error rate
+        is within max_error_rate.
+        """
+        record = self._drives.get(drive_key, {}).get(speed)
+        if record is None or record.frames < MIN_HISTORY_FRAMES:
+            return True
+
+        return record.error_rate <= max_error_rate
+
+    def best_speed(self, drive_key: str, speeds: Sequence[int],
+                   max_error_rate: float = DEFAULT_MAX_ERROR_RATE
+                  ) -> Optional[int]:
+        """
+        Return the speed with the highest throughput among those with enough
+        history and an acceptable error rate, or None if there is none.
+        """
+        best: Optional[int] = None
+        best_throughput = 0.0
+
+        for speed in speeds:
+            record = self._drives.get(drive_key, {}).get(speed)
+            if record is None or record.frames < MIN_HISTORY_FRAMES:
+                continue
+
+            if record.error_rate > max_error_rate:
+                continue
+
+            if record.throughput > best_throughput:
+                best = speed
+                best_throughput = record.throughput
+
+        return best
+
+class SpeedController:
+    """
+    Adjust a drive's read speed based on the outcome of recent reads.
+
+    Speed is raised one step after promote_after consecutive clean batches,
+    and lowered one step whenever more than max_window_errors flagged frames
+    or disagreeing re-reads occur within the last window batches. Each
+    back-off doubles the number of clean batches needed before the next
+    promotion on this disc; start() is called once per disc to reset this.
+
+    The starting speed is the one with the best sustained throughput in the
+    history. Failing that, it is the fastest speed no higher than
+    initial_speed (e.g. a drive profile's max_reliable_speed) if that is
+    given, or else the middle speed.
+    """
+    def __init__(
+            self, drive: CDROMDrive, drive_key: Optional[str] = None,
+            history: Optional[SpeedHistory] = None,
+            speeds: Sequence[int] = DEFAULT_SPEEDS,
+            window: int = DEFAULT_WINDOW,
+            max_window_errors: int = DEFAULT_MAX_WINDOW_ERRORS,
+            promote_after: int = DEFAULT_PROMOTE_AFTER,
+            max_error_rate: float = DEFAULT_MAX_ERROR_RATE,
+            initial_speed: Optional[int] = None) -> None:
+        super(SpeedController, self).__init__()
+        if not speeds:
+            raise ValueError("speeds must not be empty")
+
+        if drive_key is None:
+            drive_key = str(drive.get_identity())
+
+        self.drive = drive
+        self.drive_key = drive_key
+        self.history = history if history is not None else SpeedHistory()
+        self.speeds = tuple(sorted(speeds))
+        self.max_window_errors = max_window_errors
+        self.promote_after = promote_after
+        self.max_error_rate = max_error_rate
+        self.enabled = True
+
+        self._window: Deque[int] = deque(maxlen=window)
+        self._clean_batches = 0
+        self._required_clean = promote_after
+
+        best = self.history.best_speed(
+            drive_key, self.speeds, max_error_rate)
+        if best is None and initial_speed is not None:
+            best = max(
+                (speed for speed in self.speeds if speed <= initial_speed),
+                default=self.speeds[0])
+        if best is None:
+            self._index = len(self.speeds) // 2
+        else:
+            self._index = self.speeds.index(best)
+
+    @property
+    def speed(self) -> int:
+        """
+        The currently selected speed.
+        """
+        return self.speeds[self._index]
+
+    def start(self) -> None:
+        """
+        Reset per-disc state and apply the starting speed to the drive.
+        """
+        self._window.clear()
+        self._clean_batches = 0
+        self._required_clean = self.promote_after
+        self._apply()
+
+    def record(self, frames: int, error_frames: int, retries: int,
+               seconds: float) -> None:
+        """
+        Record the outcome of a batch of reads at the current speed and adjust
+        the speed if warranted. error_frames counts the frames the drive
+        flagged, and retries the re-reads that were flagged or disagreed with
+        an earlier read.
+        """
+        self.history.record(
+            self.drive_key, self.speed, frames, error_frames, retries, seconds)
+
+        if not self.enabled:
+            return
+
+        problems = error_frames + retries
+        self._window.append(problems)
+
+        if sum(self._window) > self.max_window_errors:
+            self._window.clear()
+            self._clean_batches = 0
+            self._required_clean *= 2
+            if self._index > 0:
+                self._index -= 1
+                log.info("Read errors clustering; lowering speed to %dx",
+                         self.speed)
+                self._apply()
+            return
+
+        if problems:
+            self._clean_batches = 0
+            return
+
+        self._clean_batches += 1
+        if (self._clean_batches >= self._required_clean and
+                self._index + 1 < len(self.speeds) and
+                self.history.is_reliable(
+                    self.drive_key, self.speeds[self._index + 1],
+                    self.max_error_rate)):
+            self._index += 1
+            self._clean_batches = 0
+            log.info("Reads clean; raising speed to %dx", self.speed)
+            self._apply()
+
+    def finish(self) -> None:
+        """
+        Persist the history at the end of a disc.
+        """
+        self.history.save()
+
+    def _apply(self) -> None:
+        if not self.enabled:
+            return
+
+        try:
+            self.drive.set_speed(self.speed)
+        except (IOError, NotImplementedError):
+            log.warning("Drive %s does not support speed selection; "
+                        "disabling speed control", self.drive_key,
+                        exc_info=True)
+            self.enabled = False
@@ -0,0 +1,289 @@
+"""\
+Indexing and caching of MusicBrainz disc lookups.
+
+A lookup by disc ID returns every release containing the disc, with the full
+MB_INCLUDES payload; popular discs return hundreds. ReleaseIndex is built
+once per response: it ranks the releases by country preference and maps
+each disc ID (and, for discs found by MCN or ISRC, each track count) to the
+preferred (release, medium) holding it, so choosing a release is a dict
+lookup rather than a scan of every medium of every release.
+
+MetadataCache keeps responses, and their indexes, in a SQLite database
+(in memory unless a filename is given) so a disc seen again is not looked up
+again. Each release is stored separately, so select() can choose a disc's
+release and medium from the cached index while parsing only that release.
+"""
+
+import json
+from logging import getLogger
+import sqlite3
+from threading import Lock
+from time import time
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Tuple
+
+# pylint: disable=C0103
+
+# Cached responses older than this are looked up again; 7 days.
+DEFAULT_METADATA_MAX_AGE = 7 * 86400.0
+
+log = getLogger(__name__)
+
+def country_ranks(country_preference: Sequence[str]) -> Dict[str, int]:
+    """
+    Return the rank of each preferred country; lower is preferred. Countries
+    not listed rank after all of them.
+    """
+    ranks: Dict[str, int] = {}
+    for rank, country in enumerate(country_preference):
+        ranks.setdefault(country.upper(), rank)
+    return ranks
+
+class ReleaseIndex:
+    """
+    Where each disc ID, and each medium track count, is found among the
+    releases of a MusicBrainz response: the (release position, medium
+    position) in the preferred release, counting from 0 in the order the
+    response lists them.
+    """
+    __slots__ = ("discs", "track_counts")
+
+    def __init__(
+            self, discs: Optional[Dict[str, Tuple[int, int]]] = None,
+            track_counts: Optional[Dict[int, Tuple[int, int]]] = None
+    ) -> None:
+        super(ReleaseIndex, self).__init__()
+        self.discs = discs if discs is not None else {}
+        self.track_counts = track_counts if track_counts is not None else {}
+
+    @staticmethod
+    def build(releases: Sequence[Mapping[str, Any]],
+              country_preference: Sequence[str] = ()) -> "ReleaseIndex":
+        """
+        Index a response's release list, preferring releases from countries
+        earlier in country_preference (and then earlier in the list).
+        """
+        ranks = country_ranks(country_preference)
+        unranked = len(country_preference)
+        order = sorted(
+            range(len(releases)),
+            key=lambda position: ranks.get(
+                (releases[position].get("country") or "").upper(), unranked))
+
+        index = ReleaseIndex()
+        for release_position in order:
+            media = releases[release_position].get("medium-list", [])
+            for medium_position, medium in enumerate(media):
+                location = (release_position, medium_position)
+                for disc in medium.get("disc-list", []):
+                    if disc.get("id"):
+                        index.discs.setdefault(disc["id"], location)
+
+                track_count = medium.get("track-count")
+                if track_count is not None:
+                    index.track_counts.setdefault(int(track_count), location)
+        return index
+
+    def find(self, disc_id: str) -> Optional[Tuple[int, int]]:
+        """
+        Return the location of the preferred medium listing a disc ID.
+        """
+        return self.discs.get(disc_id)
+
+    def find_by_track_count(
+            self, track_count: int) -> Optional[Tuple[int, int]]:
+        """
+        Return the location of the preferred medium with a track count.
+        """
+        return self.track_counts.get(track_count)
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Return this index as a JSON-serializable dict.
+        """
+        return {
+            "discs": {
+                disc_id: list(location)
+                for disc_id, location in self.discs.items()},
+            "track_counts": {
+                str(count): list(location)
+                for count, location in self.track_counts.items()}}
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "ReleaseIndex":
+        """
+        Create a ReleaseIndex from a dict produced by to_json().
+        """
+        return ReleaseIndex(
+            discs={
+                disc_id: (int(location[0]), int(location[1]))
+                for disc_id, location in data.get("discs", {}).items()},
+            track_counts={
+                int(count): (int(location[0]), int(location[1]))
+                for count, location in data.get("track_counts", {}).items()})
+
+class MetadataCache:
+    """
+    MusicBrainz responses by disc ID, each stored with its ReleaseIndex.
+    """
+
+    def __init__(self, filename: Optional[str] = None,
+                 max_age: float = DEFAULT_METADATA_MAX_AGE) -> None:
+        super(MetadataCache, self).__init__()
+        self.max_age = max_age
+        self.lock = Lock()
+        self.db = sqlite3.connect(
+            filename if filename else ":memory:", check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS responses(
+                    disc_id TEXT PRIMARY KEY,
+                    fetched REAL NOT NULL,
+                    header TEXT NOT NULL,
+                    country_preference TEXT NOT NULL,
+                    release_index TEXT NOT NULL)""")
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS releases(
+                    disc_id TEXT NOT NULL,
+                    position INTEGER NOT NULL,
+                    body TEXT NOT NULL,
+                    PRIMARY KEY (disc_id, position))""")
+
+    def put(self, disc_id: str, metadata: Mapping[str, Any],
+            country_preference: Sequence[str] = (),
+            index: Optional[ReleaseIndex] = None) -> ReleaseIndex:
+        """
+        Cache a response, indexing it unless its index is supplied. The
+        response is stored as its release list and everything else (the
+        header), one row per release.
+        """
+        disc = metadata.get("disc", {})
+        releases = disc.get("release-list", [])
+        if index is None:
+            index = ReleaseIndex.build(releases, country_preference)
+
+        header = dict(metadata)
+        header["disc"] = {
+            key: value for key, value in disc.items()
+            if key != "release-list"}
+
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM releases WHERE disc_id=?", (disc_id,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses(disc_id, fetched, header, "
+                "country_preference, release_index) VALUES (?, ?, ?, ?, ?)",
+                (disc_id, time(), json.dumps(header),
+                 ",".join(country_preference), json.dumps(index.to_json())))
+            self.db.executemany(
+                "INSERT INTO releases(disc_id, position, body) "
+                "VALUES (?, ?, ?)",
+                [(disc_id, position, json.dumps(release))
+                 for position, release in enumerate(releases)])
+        return index
+
+    def _response(self, disc_id: str) -> Optional[Tuple[str, str, str]]:
+        """
+        Return the header, country preference and index of a response cached
+        within max_age, if there is one.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT header, country_preference, release_index "
+                "FROM responses WHERE disc_id=? AND fetched>=?",
+                (disc_id, time() - self.max_age)).fetchone()
+        return row
+
+    def _releases(self, disc_id: str) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT body FROM releases WHERE disc_id=? ORDER BY position",
+                (disc_id,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_metadata(self, disc_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Return a cached response in full, or None if it is not cached.
+        """
+        row = self._response(disc_id)
+        if row is None:
+            return None
+
+        metadata = json.loads(row[0])
+        metadata.setdefault("disc", {})["release-list"] = self._releases(
+            disc_id)
+        return metadata
+
+    def get_header(self, disc_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Return a cached response without its release list, or None if it is
+        not cached.
+        """
+        row = self._response(disc_id)
+        return json.loads(row[0]) if row is not None else None
+
+    def get_index(self, disc_id: str,
+                  country_preference: Sequence[str] = ()
+                 ) -> Optional[ReleaseIndex]:
+        """
+        Return the index of a cached response, or None if it is not cached.
+        An index built for another country preference is rebuilt.
+        """
+        row = self._response(disc_id)
+        if row is None:
+            return None
+
+        if row[1] == ",".join(country_preference):
+            return ReleaseIndex.from_json(json.loads(row[2]))
+
+        index = ReleaseIndex.build(
+            self._releases(disc_id), country_preference)
+        with self.lock, self.db:
+            self.db.execute(
+                "UPDATE responses SET country_preference=?, release_index=? "
+                "WHERE disc_id=?",
+                (",".join(country_preference), json.dumps(index.to_json()),
+                 disc_id))
+        return index
+
+    def get_release(self, disc_id: str, position: int) -> Dict[str, Any]:
+        """
+        Return one release of a cached response.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT body FROM releases WHERE disc_id=? AND position=?",
+                (disc_id, position)).fetchone()
+        if row is None:
+            raise KeyError(f"Release {position} of disc {disc_id} is not "
+                           f"cached")
+        return json.loads(row[0])
+
+    def select(
+            self, disc_id: str, country_preference: Sequence[str] = (),
+            track_count: Optional[int] = None
+    ) -> Optional[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        """
+        Return the preferred (release, medium) for a cached disc, parsing only
+        that release. If no medium lists the disc ID, a medium with
+        track_count tracks is chosen if given. Returns None if the disc is not
+        cached or no medium matches.
+        """
+        index = self.get_index(disc_id, country_preference)
+        if index is None:
+            return None
+
+        location = index.find(disc_id)
+        if location is None and track_count is not None:
+            location = index.find_by_track_count(track_count)
+        if location is None:
+            return None
+
+        release = self.get_release(disc_id, location[0])
+        return release, release["medium-list"][location[1]]
+
+    def close(self) -> None:
+        """
+        Close the cache database.
+        """
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""\
+Usage: player.py [options]
+Stream the audio on a CD digitally to local listeners, with instant seeking.
+
+Options:
+    -D <filename> | --drive <filename>
+        Use the specified drive. Defaults to /dev/cdrom.
+
+    -h | --help
+        Show this usage information.
+
+    -l <host:port> | --listen <host:port>
+        Serve HTTP on the specified address. Defaults to 127.0.0.1:8192.
+
+    -u <path> | --unix <path>
+        Also stream raw PCM to clients of a Unix socket at the specified path.
+
+HTTP endpoints:
+    GET /stream             WAV stream from the current position
+    GET /stream?format=raw  Raw 16-bit little-endian stereo PCM
+    GET /seek?msf=MM:SS:FF[&sample=N] | ?track=N | ?sample=N
+    GET /status             Position, read-ahead level and seek latency
+"""
+
+from getopt import getopt, GetoptError
+from logging import getLogger, basicConfig, INFO
+import os
+from sys import argv, exit, stderr, stdout # pylint: disable=W0622
+from threading import Thread
+from typing import List, Optional
+
+from kanga.cdaudio.drive import CDROMDrive
+from kanga.cdaudio.playback import (
+    PlaybackEngine, PlaybackHTTPServer, PlaybackUnixServer)
+
+DEFAULT_LISTEN = "127.0.0.1:8192"
+LOG_FORMAT = (
+    "%(asctime)s %(threadName)s %(name)s [%(levelname)s] "
+    "%(filename)s %(lineno)d: %(message)s")
+
+log = getLogger(__name__)
+
+def main(args: List[str]) -> int:
+    """
+    Main entrypoint for the application.
+    """
+    basicConfig(format=LOG_FORMAT, level=INFO)
+    cdrom_filename = "/dev/cdrom"
+    listen = DEFAULT_LISTEN
+    unix_path: Optional[str] = None
+
+    try:
+        opts, args = getopt(
+            args, "D:hl:u:", ["drive=", "help", "listen=", "unix="])
+        for opt, val in opts:
+            if opt in ("-h", "--help",):
+                usage(stdout)
+                return 0
+            if opt in ("-D", "--drive"):
+                cdrom_filename = val
+            if opt in ("-l", "--listen"):
+                listen = val
+            if opt in ("-u", "--unix"):
+                unix_path = val
+        if args:
+            print(f"Unknown argument {args[0]}", file=stderr)
+            usage()
+            return 1
+    except GetoptError as e:
+        print(str(e), file=stderr)
+        usage()
+        return 1
+
+    host, _, port = listen.rpartition(":")
+    engine = PlaybackEngine(CDROMDrive.from_filename(cdrom_filename))
+    engine.start()
+
+    unix_server: Optional[PlaybackUnixServer] = None
+    if unix_path:
+        if os.path.exists(unix_path):
+            os.unlink(unix_path)
+        unix_server = PlaybackUnixServer(unix_path, engine)
+        Thread(target=unix_server.serve_forever, name="PlaybackUnixServer",
+               daemon=True).start()
+        log.info("Streaming PCM on %s", unix_path)
+
+    http_server = PlaybackHTTPServer((host or "127.0.0.1", int(port)), engine)
+    log.info("Serving %s on http://%s:%d/", cdrom_filename,
+             *http_server.server_address[:2])
+    try:
+        http_server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("Interrupted")
+    finally:
+        http_server.server_close()
+        if unix_server is not None:
+            unix_server.shutdown()
+            unix_server.server_close()
+            os.unlink(unix_path)
+        engine.close()
+
+    return 0
+
+def usage(fd=stderr):
+    """
+    Print usage information to the specified file handle.
+    """
+    fd.write(__doc__)
+
+if __name__ == "__main__":
+    exit(main(argv[1:]))
@@ -0,0 +1,329 @@
+"""\
+Metadata-only retagging of the FLAC files stored in S3.
+
+When MusicBrainz data improves, the tags in stored FLAC files can be brought
+up to date without re-ripping, or downloading and re-uploading, the audio.
+Tags live in the Vorbis comment block at the start of each file, so
+Retagger reads only the header, builds a new one with the refreshed tags,
+and assembles the new object server-side:
+
+  * Part 1 is the new header, followed by just enough of the existing audio
+    to meet S3's 5 MiB minimum part size. This is the only data read or
+    written through the client.
+  * The rest of the audio is copied from the existing object with
+    UploadPartCopy, so it never leaves S3.
+
+Objects smaller than that are rewritten with a single PUT, carrying sha256
+metadata since the whole body is in memory. Every read and copy is
+conditional on the ETag of the header that was read, so an object replaced in
+the meantime is left alone rather than mixed up. ReplayGain tags are computed
+from the audio rather than from MusicBrainz, so they are kept. Objects
+assembled from parts carry no sha256 metadata, since computing it would mean
+reading all of the audio; their ETag changes, so the verifier treats them as
+unrecorded and records their hash on its next read.
+
+Objects are named NN.flac (or NN.<variant>.flac) under <prefix><disc id>/.
+Discs are retagged in parallel on a worker pool; the tags for each disc come
+from a callback, so this module knows nothing of MusicBrainz.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+from logging import getLogger
+from re import compile as re_compile
+from time import monotonic
+from typing import (
+    Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple)
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from kanga.cdaudio.flac import (
+    FLACError, VorbisCommentTemplate, flac_header_length,
+    replace_vorbis_comment)
+from spool import SHA256_METADATA_KEY
+
+# pylint: disable=C0103,R0902,R0913,R0914
+
+DEFAULT_RETAG_WORKERS = 16
+
+# S3's minimum size for every part of a multipart upload except the last.
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# S3's maximum size of a part copied with UploadPartCopy.
+MAX_COPY_PART_SIZE = 5 * 1024 * 1024 * 1024
+
+# Bytes read at first when looking for the end of the FLAC header; this is
+# doubled until the header fits. Headers with embedded pictures can be large.
+HEADER_READ_BYTES = 64 * 1024
+
+# Vorbis comments kept from the existing file rather than replaced.
+KEEP_COMMENT_PREFIXES = (b"REPLAYGAIN_",)
+
+FLAC_NAME_RE = re_compile(r"^(?P<track>[0-9]{2})(?:\.[^./]+)?\.flac$")
+
+# Outcomes of retagging an object.
+STATUS_RETAGGED = "retagged"
+STATUS_UNCHANGED = "unchanged"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+
+log = getLogger(__name__)
+
+class DiscTags(NamedTuple):
+    """
+    The tags for a disc: release_tags are shared by every track, and
+    track_tags holds the tags specific to each track number.
+    """
+    release_tags: List[Tuple[str, str]]
+    track_tags: Dict[int, List[Tuple[str, str]]]
+
+class RetagResult(NamedTuple):
+    """
+    The outcome of retagging one object. bytes_transferred counts the data
+    read and written through the client; bytes_copied the audio copied
+    server-side.
+    """
+    key: str
+    status: str
+    detail: str
+    bytes_transferred: int
+    bytes_copied: int
+
+class RetagReport(NamedTuple):
+    """
+    Totals for a retagging run.
+    """
+    discs: int
+    objects: int
+    retagged: int
+    bytes_transferred: int
+    bytes_copied: int
+    failures: List[RetagResult]
+
+class Retagger:
+    """
+    Replace the tags of the FLAC objects stored under a bucket prefix.
+    get_tags(disc_id, track_numbers) returns the tags for a disc, or None if
+    it should be skipped. The S3 client's connection pool should hold at
+    least max_workers connections.
+    """
+
+    def __init__(
+            self, s3_client: Any, bucket_name: str, prefix: str,
+            get_tags: Callable[[str, List[int]], Optional[DiscTags]],
+            max_workers: int = DEFAULT_RETAG_WORKERS) -> None:
+        super(Retagger, self).__init__()
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.get_tags = get_tags
+        self.max_workers = max_workers
+
+    def list_discs(self) -> Dict[str, List[Tuple[int, str]]]:
+        """
+        List the bucket prefix once, returning the (track, key) of each FLAC
+        object of each disc.
+        """
+        discs: Dict[str, List[Tuple[int, str]]] = {}
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+                Bucket=self.bucket_name, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                disc_id, _, name = obj["Key"][len(self.prefix):].partition("/")
+                m = FLAC_NAME_RE.match(name)
+                if m:
+                    discs.setdefault(disc_id, []).append(
+                        (int(m.group("track")), obj["Key"]))
+        return discs
+
+    def run(self, disc_ids: Optional[Iterable[str]] = None) -> RetagReport:
+        """
+        Retag every disc in the bucket, or only those in disc_ids.
+        """
+        started = monotonic()
+        discs = self.list_discs()
+        if disc_ids is not None:
+            wanted = set(disc_ids)
+            for disc_id in sorted(wanted - set(discs)):
+                log.warning("No FLAC objects found for disc %s", disc_id)
+            discs = {
+                disc_id: objects for disc_id, objects in discs.items()
+                if disc_id in wanted}
+        log.info("Retagging %d discs in s3://%s/%s", len(discs),
+                 self.bucket_name, self.prefix)
+
+        results: List[RetagResult] = []
+        with ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="Retagger") as executor:
+            for disc_results in executor.map(
+                    lambda item: self.retag_disc(*item), sorted(discs.items())):
+                results.extend(disc_results)
+
+        report = RetagReport(
+            discs=len(discs), objects=len(results),
+            retagged=sum(
+                1 for result in results if result.status == STATUS_RETAGGED),
+            bytes_transferred=sum(
+                result.bytes_transferred for result in results),
+            bytes_copied=sum(result.bytes_copied for result in results),
+            failures=[
+                result for result in results
+                if result.status == STATUS_FAILED])
+        log.info("Retagged %d of %d objects on %d discs in %.0f s: %d bytes "
+                 "transferred, %d bytes copied in S3", report.retagged,
+                 report.objects, report.discs, monotonic() - started,
+                 report.bytes_transferred, report.bytes_copied)
+        return report
+
+    def retag_disc(
+            self, disc_id: str,
+            objects: List[Tuple[int, str]]) -> List[RetagResult]:
+        """
+        Retag the FLAC objects of a disc.
+        """
+        try:
+            tags = self.get_tags(
+                disc_id, sorted({track for track, _ in objects}))
+        except Exception as e: # pylint: disable=W0703
+            log.error("Unable to get tags for disc %s", disc_id, exc_info=True)
+            return [
+                RetagResult(key, STATUS_FAILED, f"No tags: {e}", 0, 0)
+                for _, key in objects]
+
+        if tags is None:
+            log.warning("No metadata for disc %s; leaving its tags alone",
+                        disc_id)
+            return [
+                RetagResult(key, STATUS_SKIPPED, "No metadata", 0, 0)
+                for _, key in objects]
+
+        template = VorbisCommentTemplate(tags.release_tags)
+        results = []
+        for track, key in sorted(objects):
+            result = self.retag_object(
+                key, template.for_track(tags.track_tags.get(track, [])))
+            if result.status == STATUS_FAILED:
+                log.error("Unable to retag s3://%s/%s: %s", self.bucket_name,
+                          key, result.detail)
+            results.append(result)
+        return results
+
+    def retag_object(self, key: str, comments: Tuple[bytes, ...]) -> RetagResult:
+        """
+        Replace the Vorbis comments of one FLAC object.
+        """
+        try:
+            head, size, etag, content_type = self._read_header(key)
+            header, header_length = replace_vorbis_comment(
+                head, comments, KEEP_COMMENT_PREFIXES)
+            if header == head[:header_length]:
+                return RetagResult(key, STATUS_UNCHANGED, "", len(head), 0)
+
+            transferred, copied = self._write(
+                key, header, header_length, size, etag, content_type)
+        except (BotoCoreError, ClientError, FLACError, IOError) as e:
+            return RetagResult(key, STATUS_FAILED, str(e), 0, 0)
+
+        log.debug("Retagged s3://%s/%s", self.bucket_name, key)
+        return RetagResult(
+            key, STATUS_RETAGGED, "", len(head) + transferred, copied)
+
+    def _read_header(self, key: str) -> Tuple[bytes, int, str, str]:
+        """
+        Read the start of an object until it holds the whole FLAC header.
+        Returns the data read, the object size, ETag and content type.
+        """
+        read_bytes = HEADER_READ_BYTES
+        etag: Optional[str] = None
+        while True:
+            kw: Dict[str, Any] = {}
+            if etag is not None:
+                kw["IfMatch"] = etag
+            response = self.s3.get_object(
+                Bucket=self.bucket_name, Key=key,
+                Range=f"bytes=0-{read_bytes - 1}", **kw)
+            data = response["Body"].read()
+            etag = response["ETag"]
+            size = int(response["ContentRange"].rpartition("/")[2])
+
+            if flac_header_length(data) is not None:
+                return (data, size, etag,
+                        response.get("ContentType", "audio/flac"))
+            if len(data) >= size:
+                raise FLACError("FLAC metadata is truncated")
+            read_bytes *= 2
+
+    def _read_range(self, key: str, etag: str, start: int, end: int) -> bytes:
+        """
+        Read bytes [start, end) of an object, provided it still has the
+        specified ETag.
+        """
+        if start >= end:
+            return b""
+
+        response = self.s3.get_object(
+            Bucket=self.bucket_name, Key=key, IfMatch=etag,
+            Range=f"bytes={start}-{end - 1}")
+        data = response["Body"].read()
+        if len(data) != end - start:
+            raise IOError(
+                f"Short read at byte {start}: expected {end - start} bytes, "
+                f"got {len(data)}")
+        return data
+
+    def _write(
+            self, key: str, header: bytes, header_length: int, size: int,
+            etag: str, content_type: str) -> Tuple[int, int]:
+        """
+        Replace an object with the new header followed by its existing audio.
+        Returns the bytes transferred through the client and copied in S3.
+        """
+        # Part 1 holds the new header and enough audio to be a valid part.
+        split = header_length + max(0, MIN_PART_SIZE - len(header))
+        if split >= size:
+            body = header + self._read_range(key, etag, header_length, size)
+            self.s3.put_object(
+                Bucket=self.bucket_name, Key=key, Body=body,
+                ContentType=content_type, ChecksumAlgorithm="SHA256",
+                Metadata={SHA256_METADATA_KEY: sha256(body).hexdigest()})
+            return 2 * len(body) - len(header), 0
+
+        first_part = header + self._read_range(key, etag, header_length, split)
+        upload_id = self.s3.create_multipart_upload(
+            Bucket=self.bucket_name, Key=key, ContentType=content_type,
+            ChecksumAlgorithm="SHA256")["UploadId"]
+        try:
+            response = self.s3.upload_part(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                PartNumber=1, Body=first_part, ChecksumAlgorithm="SHA256")
+            parts = [{
+                "PartNumber": 1, "ETag": response["ETag"],
+                "ChecksumSHA256": response["ChecksumSHA256"]}]
+
+            for start in range(split, size, MAX_COPY_PART_SIZE):
+                end = min(start + MAX_COPY_PART_SIZE, size)
+                response = self.s3.upload_part_copy(
+                    Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                    PartNumber=len(parts) + 1,
+                    CopySource={"Bucket": self.bucket_name, "Key": key},
+                    CopySourceIfMatch=etag,
+                    CopySourceRange=f"bytes={start}-{end - 1}")
+                result = response["CopyPartResult"]
+                parts.append({
+                    "PartNumber": len(parts) + 1, "ETag": result["ETag"],
+                    "ChecksumSHA256": result["ChecksumSHA256"]})
+
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={"Parts": parts})
+        except BaseException:
+            try:
+                self.s3.abort_multipart_upload(
+                    Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+            except (BotoCoreError, ClientError):
+                log.warning("Unable to abort upload %s of s3://%s/%s",
+                            upload_id, self.bucket_name, key, exc_info=True)
+            raise
+
+        return 2 * len(first_part) - len(header), size - split
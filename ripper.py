@@ -1,18 +1,59 @@
 #!/usr/bin/env python3
 """\
 Usage: ripper.py [options]
+       ripper.py [options] --import <directory> ...
+       ripper.py [options] --retag [<disc id> ...]
+       ripper.py [options] --transcode [<disc id> ...]
 Rip a CD and upload its contents and metadata to DynamoDB/S3.
 
 Options:
     -c <filename> | --config <filename>
         Read configuration data from the specifed file. Defaults to ripper.conf.
 
+    -d | --daemon
+        Run continuously, watching the configured drives and ripping each disc
+        as it is inserted. Discs are ejected when ripping finishes.
+
+    -D <filename> | --drive <filename>
+        Use the specified drive. May be repeated in daemon mode. Defaults to
+        the drives in the configuration file, or /dev/cdrom. "auto" finds
+        every optical drive attached to the system.
+
+    --import <directory> ...
+        Import existing rips instead of reading a drive. Each directory (or
+        any directory below it) holding a cue sheet, or one WAV or FLAC file
+        per track, is treated as a disc; its table of contents and disc ID
+        are rebuilt from the cue sheet or the file lengths, and several discs
+        are looked up, encoded and uploaded at once ([import] section).
+
+    --import-catalog
+        Bootstrap the local catalog ([catalog] sqlite) from the discs already
+        in the S3 bucket, then exit.
+
     -h | --help
         Show this usage information.
 
+    --verify
+        Check every object in the S3 bucket against its recorded SHA-256
+        ([verify] section), least recently verified discs first, then exit.
+        Exits with status 2 if any object failed.
+
     -p <name> | --profile <name>
         Use the specified profile for AWS credentials.
 
+    --retag [<disc id> ...]
+        Rewrite the tags of the FLAC files in the S3 bucket (or only those of
+        the specified discs) from current MusicBrainz metadata ([retag]
+        section), then exit. Only each file's header is rewritten; the audio
+        is copied within S3. Exits with status 2 if any file failed.
+
+    --transcode [<disc id> ...]
+        Make lossy copies of the FLAC files in the S3 bucket (or only those of
+        the specified discs) in the [transcode] formats, streaming each
+        through ffmpeg without a local copy, then exit. Copies already made
+        from the current FLAC file are skipped, so an interrupted run can be
+        restarted. Exits with status 2 if any file failed.
+
     -r <name> | --region <name>
         Use the specified region.
 
@@ -33,29 +74,251 @@ rate_limit = <float>
 # Country codes to prefer for releases; defaults to US,CA,GB,AU,NZ
 country_preference = <str>,<str>,...
 
+# SQLite database caching each disc's MusicBrainz lookup, indexed by disc ID,
+# so a disc seen again (or retagged with [retag] refresh = false) is not looked
+# up again. Lookups are cached in memory for the session if this is unset.
+cache = <str>
+
+# Cached lookups older than this many days are looked up again; defaults
+# to 7.
+cache_max_age = <float>
+
 [aws]
 s3_bucket = <str> # Defaults to <account-id>-music-collection
 s3_prefix = <str> # Optional; defaults to the empty string
+
+[drive]
+# How to extract audio: "cdparanoia" (the default) runs cdparanoia for each
+# track; "secure" reads each sector once with C2 error pointers and re-reads
+# only the sectors the drive flags; "auto" uses secure extraction on drives
+# whose capability profile shows they return C2 error pointers.
+extraction = cdparanoia|secure|auto
+
+# File recording per-drive read outcomes at each speed. When set, secure
+# extraction adjusts the drive speed to maximize error-free throughput.
+speed_history = <str>
+
+# File caching each drive model's capability profile (C2 support, audio
+# caching, read offset, fastest reliable speed). Drives are probed the first
+# time they are seen and the result reused in later sessions. A read_offset
+# entered in this file is passed to cdparanoia.
+profiles = <str>
+
+# Whether to read each run of adjacent audio tracks in one sequential pass
+# and split it into tracks at the table of contents boundaries, rather than
+# extracting track by track; defaults to false. Secure extraction corrects
+# the profile's read offset across the boundaries; cdparanoia applies it
+# itself.
+continuous = <bool>
+
+# Whether continuous secure extraction reads the drive in a separate process
+# that passes frames back through a shared-memory ring, so Python work in the
+# ripper never delays the reads; defaults to false. The drive speed is not
+# adjusted while reading this way. Requires Python 3.8.
+reader_process = <bool>
+
+[encoder]
+# How to encode FLAC: "libflac" encodes in-process on a process pool,
+# "cli" runs the flac binary for each track, and "auto" (the default) uses
+# libflac when it is installed.
+flac_backend = auto|libflac|cli
+
+# FLAC compression level (0-8); defaults to 5. "auto" measures encode
+# throughput at each level against the rate audio is being extracted and uses
+# the highest level the encoders can sustain without falling behind the drive,
+# adjusting it per track.
+compression_level = auto|<int>
+
+# File recording, per host, the extraction and encode throughput observed and
+# the compression level last chosen. Used with compression_level = auto, so
+# later sessions start at the level this host is known to sustain.
+compression_history = <str>
+
+# Whether to measure each track's loudness (EBU R128) as it is extracted and
+# add ReplayGain track and album gain/peak tags; defaults to false. Requires
+# NumPy.
+replaygain = <bool>
+
+# Whether to store a de-emphasized copy (NN.deemph.flac) of tracks the disc
+# flags as mastered with 50/15 us pre-emphasis, alongside the unaltered
+# master; defaults to false. Requires NumPy.
+deemphasis = <bool>
+
+[dedup]
+# SQLite database mapping offset-normalized PCM content hashes to the FLAC
+# objects already uploaded. When set, a track whose audio has already been
+# stored (e.g. on a compilation) is recorded as a reference instead of being
+# encoded and uploaded again.
+index = <str>
+
+[upload]
+# Maximum number of concurrent S3 requests across all uploads; the S3
+# connection pool is sized to match. Defaults to 10.
+max_concurrency = <int>
+
+# Maximum total upload bandwidth in bytes/second; unlimited by default.
+max_bandwidth = <int>
+
+# Attempts per object before an upload is abandoned; defaults to 5.
+max_attempts = <int>
+
+[spool]
+# Directory where finished artifacts are committed before being uploaded in
+# the background; uploads interrupted by a crash resume from here on the next
+# run. Defaults to ~/.kanga-ripper/spool. Only one ripper process can use a
+# spool directory at a time; give each concurrent process its own.
+directory = <str>
+
+# Pause ripping while the spool holds more than this many bytes awaiting
+# upload; unlimited by default.
+high_water = <int>
+
+# Times an upload that exhausted its [upload] max_attempts is re-queued (every
+# five minutes) before it is left in the spool for the next run, so a
+# permanently failing object can't keep the ripper from exiting; defaults to
+# 2.
+max_retries = <int>
+
+# Pause ripping while the spool's filesystem has fewer than this many bytes
+# available; defaults to 1 GiB. 0 disables the check.
+min_free = <int>
+
+[daemon]
+# Drives to watch in daemon mode; defaults to /dev/cdrom. "auto" watches
+# every optical drive listed in /sys/block.
+drives = auto|<str>,<str>,...
+
+# Seconds between checks for a newly inserted disc; defaults to 2.0.
+poll_interval = <float>
+
+# Whether to eject each disc once it has been ripped; defaults to true.
+eject = <bool>
+
+[catalog]
+# DynamoDB table recording each ripped disc, its release, tracks and S3
+# objects, indexed by release and artist. Created if it does not exist; no
+# catalog is kept if this is unset.
+dynamodb_table = <str>
+
+# Endpoint URL for DynamoDB, e.g. http://localhost:8000 for DynamoDB Local.
+dynamodb_endpoint = <str>
+
+# Local SQLite catalog of ripped discs, with full-text search over titles and
+# artists. No local catalog is kept if this is unset.
+sqlite = <str>
+
+# Whether to skip (and eject) discs the local catalog says have already been
+# ripped; defaults to true.
+skip_duplicates = <bool>
+
+[import]
+# Number of rips imported concurrently; defaults to 4. Each holds its disc's
+# audio in memory while it is processed, up to twice that while its image is
+# assembled (about 1.6 GB for a full CD), so peak memory grows with workers.
+# MusicBrainz lookups stay within [musicbrainz] rate_limit and uploads within
+# the [upload] limits.
+workers = <int>
+
+[verify]
+# SQLite database recording when each disc and object last passed
+# verification; defaults to ~/.kanga-ripper/verify.db.
+state = <str>
+
+# Number of discs verified concurrently; defaults to 64.
+workers = <int>
+
+# Discs that passed within this many days are skipped; defaults to 30.
+max_age = <float>
+
+# Stop starting new discs after this many hours, leaving the rest for the
+# next run; unlimited by default.
+time_limit = <float>
+
+[retag]
+# Number of discs retagged concurrently; defaults to 16. MusicBrainz lookups
+# stay within [musicbrainz] rate_limit.
+workers = <int>
+
+# Whether to look each disc up on MusicBrainz again, updating its stored
+# musicbrainz.json, rather than retagging from the stored metadata; defaults
+# to true.
+refresh = <bool>
+
+[transcode]
+# Formats to make from each FLAC file: "aac" (NN.m4a, 256 kbps) and/or "mp3"
+# (NN.mp3, 320 kbps); defaults to aac,mp3. Requires ffmpeg.
+formats = <str>,<str>,...
+
+# Number of files transcoded concurrently, each by a single-threaded ffmpeg
+# process holding one upload part in memory; defaults to the CPU count.
+workers = <int>
 """
 
-from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import (
+    Future, ProcessPoolExecutor, ThreadPoolExecutor, wait as futures_wait)
 from configparser import ConfigParser
 from getopt import getopt, GetoptError
 import json
 from logging import getLogger, basicConfig, DEBUG, WARNING
-from os import chdir, getcwd
-from os.path import exists
+from multiprocessing import get_context
+from os import cpu_count, makedirs
+from os.path import basename, dirname, exists, expanduser, getsize, join
+import sqlite3
 from re import compile as re_compile
-from subprocess import run, PIPE
-from sys import argv, exit, stderr, stdout # pylint: disable=W0622
-from tempfile import mkdtemp
-from typing import Any, Dict, List, Optional, Sequence, Set
+from shutil import rmtree
+from signal import signal, SIGTERM
+from subprocess import run, DEVNULL, PIPE, Popen
+from sys import (  # pylint: disable=W0622
+    argv, exit, stderr, stdout, version_info)
+from threading import Event, Lock, Thread
+from time import monotonic, time
+from typing import (
+    Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set,
+    Tuple)
+import wave
 
 from boto3.session import Session
+from botocore.config import Config
 import musicbrainzngs as mb
 
-from kanga.cdaudio.drive import CDROMDrive
-from kanga.cdaudio.cd import TrackType
+from kanga.cdaudio.discovery import discover_drives
+from kanga.cdaudio.drive import CDROMDrive, DriveStatus
+from kanga.cdaudio.capability import DriveProfile, DriveProfileCache
+from kanga.cdaudio.cd import (
+    BYTES_PER_FRAME_RAW, FRAMES_PER_SECOND, DiscCodes, TrackFlags, TrackIndex,
+    TrackType)
+from kanga.cdaudio.compression import CompressionHistory, CompressionPolicy
+from kanga.cdaudio.contenthash import PCMContentHasher
+from kanga.cdaudio.continuous import (
+    TrackPiece, TrackSpan, TrackSplitter, contiguous_audio_runs)
+from kanga.cdaudio.cue import format_cue_sheet
+from kanga.cdaudio.emphasis import DeemphasisFilter, deemphasis_available
+from kanga.cdaudio.extract import SecureExtractor
+from kanga.cdaudio.flac import (
+    CD_BITS_PER_SAMPLE, CD_CHANNELS, CD_SAMPLE_RATE, DEFAULT_COMPRESSION_LEVEL,
+    VorbisCommentTemplate, encode_flac, libflac_available, read_wav_pcm)
+from kanga.cdaudio.image import ImageCDROMDrive
+from kanga.cdaudio.loudness import (
+    AlbumLoudness, Loudness, TrackLoudnessAnalyzer, loudness_available,
+    replaygain_tags)
+from kanga.cdaudio.ring import FrameRing, RingReader, ring_available
+from kanga.cdaudio.speed import SpeedController, SpeedHistory
+from catalog import (
+    DEFAULT_IMPORT_WORKERS, METADATA_FILENAME, DynamoDBCatalog, SQLiteCatalog,
+    build_catalog_items)
+from importer import RipImportError, find_rip_directories, load_rip
+from metadata import DEFAULT_METADATA_MAX_AGE, MetadataCache, ReleaseIndex
+from retagger import DEFAULT_RETAG_WORKERS, DiscTags, Retagger
+from transcoder import (
+    DEFAULT_TRANSCODE_WORKERS, DERIVATIVE_FORMATS, Transcoder,
+    transcoder_available)
+from spool import (
+    DEFAULT_MAX_RETRIES, DEFAULT_MIN_FREE_BYTES, Spool, SpoolLockedError)
+from verifier import (
+    DEFAULT_MAX_AGE, DEFAULT_VERIFY_WORKERS, CollectionVerifier,
+    VerificationState)
+from uploader import (
+    DEFAULT_MAX_ATTEMPTS, DEFAULT_MAX_CONCURRENCY, S3Uploader, UploadPriority)
 
 # pylint: disable=C0103,R0902,R0913,R0914,R0915
 
@@ -67,8 +330,27 @@ MB_INCLUDES = [
     "event-rels", "recording-rels", "release-rels", "release-group-rels",
     "series-rels", "url-rels", "work-rels", "instrument-rels"]
 
+# Includes for looking up a single release; discids and media are implied
+# when looking up by disc ID.
+MB_RELEASE_INCLUDES = MB_INCLUDES + ["discids", "media"]
+
 DEFAULT_USER_AGENT = f"kanga-cdlogic-ripper/{VERSION} ( dacut@kanga.org )"
 DEFAULT_COUNTRY_PREFERENCE = ("US", "CA", "GB", "AU", "NZ")
+EXTRACTION_MODES = ("cdparanoia", "secure", "auto")
+FLAC_BACKENDS = ("auto", "libflac", "cli")
+DEFAULT_SPOOL_DIRECTORY = "~/.kanga-ripper/spool"
+DEFAULT_VERIFY_STATE = "~/.kanga-ripper/verify.db"
+DEFAULT_DRIVES = ("/dev/cdrom",)
+DRIVES_AUTO = "auto"
+DEFAULT_POLL_INTERVAL = 2.0
+DEFAULT_IMPORT_RIP_WORKERS = 4
+
+# Bytes read at a time from cdparanoia's output in continuous mode; one
+# second of audio.
+CONTINUOUS_READ_BYTES = 2352 * 75
+
+# Sample frames read at a time when de-emphasizing a WAV file.
+DEEMPHASIS_CHUNK_FRAMES = 588 * 64
 LOG_FORMAT = (
     "%(asctime)s %(threadName)s %(name)s [%(levelname)s] "
     "%(filename)s %(lineno)d: %(message)s")
@@ -95,7 +377,44 @@ class RipperConfig:
                 musicbrainz_password: Optional[str] = None,
                 musicbrainz_rate_limit: float = 1.0,
                 musicbrainz_user_agent: str = DEFAULT_USER_AGENT,
-                musicbrainz_country_preference: Sequence[str] = DEFAULT_COUNTRY_PREFERENCE) -> None:
+                musicbrainz_country_preference: Sequence[str] = DEFAULT_COUNTRY_PREFERENCE,
+                metadata_cache_filename: Optional[str] = None,
+                metadata_cache_max_age: float = DEFAULT_METADATA_MAX_AGE,
+                extraction_mode: str = "cdparanoia",
+                speed_history_filename: Optional[str] = None,
+                drive_profiles_filename: Optional[str] = None,
+                continuous_extraction: bool = False,
+                reader_process: bool = False,
+                import_workers: int = DEFAULT_IMPORT_RIP_WORKERS,
+                flac_backend: str = "auto",
+                flac_compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+                adaptive_compression: bool = False,
+                compression_history_filename: Optional[str] = None,
+                replaygain: bool = False,
+                deemphasis: bool = False,
+                content_index_filename: Optional[str] = None,
+                upload_max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                upload_max_bandwidth: Optional[int] = None,
+                upload_max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+                spool_directory: str = DEFAULT_SPOOL_DIRECTORY,
+                spool_high_water: Optional[int] = None,
+                spool_max_retries: int = DEFAULT_MAX_RETRIES,
+                spool_min_free: Optional[int] = DEFAULT_MIN_FREE_BYTES,
+                drives: Sequence[str] = DEFAULT_DRIVES,
+                poll_interval: float = DEFAULT_POLL_INTERVAL,
+                eject: bool = True,
+                dynamodb_table: Optional[str] = None,
+                dynamodb_endpoint: Optional[str] = None,
+                catalog_filename: Optional[str] = None,
+                skip_duplicates: bool = True,
+                verify_state_filename: str = DEFAULT_VERIFY_STATE,
+                verify_workers: int = DEFAULT_VERIFY_WORKERS,
+                verify_max_age: float = DEFAULT_MAX_AGE,
+                verify_time_limit: Optional[float] = None,
+                retag_workers: int = DEFAULT_RETAG_WORKERS,
+                retag_refresh: bool = True,
+                transcode_formats: Sequence[str] = tuple(DERIVATIVE_FORMATS),
+                transcode_workers: int = DEFAULT_TRANSCODE_WORKERS) -> None:
         super(RipperConfig, self).__init__()
         self.aws_region = aws_region
         self.aws_profile = aws_profile
@@ -106,6 +425,43 @@ class RipperConfig:
         self.musicbrainz_rate_limit = musicbrainz_rate_limit
         self.musicbrainz_user_agent = musicbrainz_user_agent
         self.musicbrainz_country_preference = musicbrainz_country_preference
+        self.metadata_cache_filename = metadata_cache_filename
+        self.metadata_cache_max_age = metadata_cache_max_age
+        self.extraction_mode = extraction_mode
+        self.speed_history_filename = speed_history_filename
+        self.drive_profiles_filename = drive_profiles_filename
+        self.continuous_extraction = continuous_extraction
+        self.reader_process = reader_process
+        self.import_workers = import_workers
+        self.flac_backend = flac_backend
+        self.flac_compression_level = flac_compression_level
+        self.adaptive_compression = adaptive_compression
+        self.compression_history_filename = compression_history_filename
+        self.replaygain = replaygain
+        self.deemphasis = deemphasis
+        self.content_index_filename = content_index_filename
+        self.upload_max_concurrency = upload_max_concurrency
+        self.upload_max_bandwidth = upload_max_bandwidth
+        self.upload_max_attempts = upload_max_attempts
+        self.spool_directory = spool_directory
+        self.spool_high_water = spool_high_water
+        self.spool_max_retries = spool_max_retries
+        self.spool_min_free = spool_min_free
+        self.drives = drives
+        self.poll_interval = poll_interval
+        self.eject = eject
+        self.dynamodb_table = dynamodb_table
+        self.dynamodb_endpoint = dynamodb_endpoint
+        self.catalog_filename = catalog_filename
+        self.skip_duplicates = skip_duplicates
+        self.verify_state_filename = verify_state_filename
+        self.verify_workers = verify_workers
+        self.verify_max_age = verify_max_age
+        self.verify_time_limit = verify_time_limit
+        self.retag_workers = retag_workers
+        self.retag_refresh = retag_refresh
+        self.transcode_formats = transcode_formats
+        self.transcode_workers = transcode_workers
 
     def parse_config(self, filename: str) -> None:
         """
@@ -154,6 +510,184 @@ class RipperConfig:
             self.musicbrainz_country_preference = [
                 country.strip().upper() for country in country_pref.split(",")]
 
+        metadata_cache = cp.get("musicbrainz", "cache", fallback=None) # type: ignore
+        if metadata_cache is not None:
+            self.metadata_cache_filename = metadata_cache
+
+        cache_max_age = cp.get( # type: ignore
+            "musicbrainz", "cache_max_age", fallback=None)
+        if cache_max_age is not None:
+            self.metadata_cache_max_age = float(cache_max_age) * 86400.0
+
+        extraction_mode = cp.get("drive", "extraction", fallback=None) # type: ignore
+        if extraction_mode is not None:
+            extraction_mode = extraction_mode.strip().lower()
+            if extraction_mode not in EXTRACTION_MODES:
+                raise ValueError(
+                    f"Invalid extraction mode: expected one of "
+                    f"{', '.join(EXTRACTION_MODES)}: {extraction_mode!r}")
+            self.extraction_mode = extraction_mode
+
+        speed_history = cp.get("drive", "speed_history", fallback=None) # type: ignore
+        if speed_history is not None:
+            self.speed_history_filename = speed_history
+
+        profiles = cp.get("drive", "profiles", fallback=None) # type: ignore
+        if profiles is not None:
+            self.drive_profiles_filename = profiles
+
+        continuous = cp.getboolean("drive", "continuous", fallback=None) # type: ignore
+        if continuous is not None:
+            self.continuous_extraction = continuous
+
+        reader_process = cp.getboolean( # type: ignore
+            "drive", "reader_process", fallback=None)
+        if reader_process is not None:
+            self.reader_process = reader_process
+
+        flac_backend = cp.get("encoder", "flac_backend", fallback=None) # type: ignore
+        if flac_backend is not None:
+            flac_backend = flac_backend.strip().lower()
+            if flac_backend not in FLAC_BACKENDS:
+                raise ValueError(
+                    f"Invalid FLAC backend: expected one of "
+                    f"{', '.join(FLAC_BACKENDS)}: {flac_backend!r}")
+            self.flac_backend = flac_backend
+
+        compression_level = cp.get( # type: ignore
+            "encoder", "compression_level", fallback=None)
+        if compression_level is not None:
+            if compression_level.strip().lower() == "auto":
+                self.adaptive_compression = True
+            else:
+                self.adaptive_compression = False
+                self.flac_compression_level = int(compression_level)
+                if not 0 <= self.flac_compression_level <= 8:
+                    raise ValueError(
+                        f"Invalid FLAC compression level: expected 0-8 or "
+                        f"auto: {compression_level}")
+
+        compression_history = cp.get( # type: ignore
+            "encoder", "compression_history", fallback=None)
+        if compression_history is not None:
+            self.compression_history_filename = compression_history
+
+        replaygain = cp.getboolean("encoder", "replaygain", fallback=None) # type: ignore
+        if replaygain is not None:
+            self.replaygain = replaygain
+
+        deemphasis = cp.getboolean("encoder", "deemphasis", fallback=None) # type: ignore
+        if deemphasis is not None:
+            self.deemphasis = deemphasis
+
+        content_index = cp.get("dedup", "index", fallback=None) # type: ignore
+        if content_index is not None:
+            self.content_index_filename = content_index
+
+        max_concurrency = cp.get( # type: ignore
+            "upload", "max_concurrency", fallback=None)
+        if max_concurrency is not None:
+            self.upload_max_concurrency = int(max_concurrency)
+
+        max_bandwidth = cp.get("upload", "max_bandwidth", fallback=None) # type: ignore
+        if max_bandwidth is not None:
+            self.upload_max_bandwidth = int(max_bandwidth) or None
+
+        max_attempts = cp.get("upload", "max_attempts", fallback=None) # type: ignore
+        if max_attempts is not None:
+            self.upload_max_attempts = int(max_attempts)
+
+        spool_directory = cp.get("spool", "directory", fallback=None) # type: ignore
+        if spool_directory is not None:
+            self.spool_directory = spool_directory
+
+        high_water = cp.get("spool", "high_water", fallback=None) # type: ignore
+        if high_water is not None:
+            self.spool_high_water = int(high_water) or None
+
+        max_retries = cp.get("spool", "max_retries", fallback=None) # type: ignore
+        if max_retries is not None:
+            self.spool_max_retries = int(max_retries)
+
+        min_free = cp.get("spool", "min_free", fallback=None) # type: ignore
+        if min_free is not None:
+            self.spool_min_free = int(min_free) or None
+
+        drives = cp.get("daemon", "drives", fallback=None) # type: ignore
+        if drives is not None:
+            self.drives = [
+                drive.strip() for drive in drives.split(",") if drive.strip()]
+
+        poll_interval = cp.get("daemon", "poll_interval", fallback=None) # type: ignore
+        if poll_interval is not None:
+            self.poll_interval = float(poll_interval)
+
+        eject = cp.getboolean("daemon", "eject", fallback=None) # type: ignore
+        if eject is not None:
+            self.eject = eject
+
+        dynamodb_table = cp.get("catalog", "dynamodb_table", fallback=None) # type: ignore
+        if dynamodb_table is not None:
+            self.dynamodb_table = dynamodb_table
+
+        dynamodb_endpoint = cp.get( # type: ignore
+            "catalog", "dynamodb_endpoint", fallback=None)
+        if dynamodb_endpoint is not None:
+            self.dynamodb_endpoint = dynamodb_endpoint
+
+        catalog_filename = cp.get("catalog", "sqlite", fallback=None) # type: ignore
+        if catalog_filename is not None:
+            self.catalog_filename = catalog_filename
+
+        skip_duplicates = cp.getboolean( # type: ignore
+            "catalog", "skip_duplicates", fallback=None)
+        if skip_duplicates is not None:
+            self.skip_duplicates = skip_duplicates
+
+        import_workers = cp.get("import", "workers", fallback=None) # type: ignore
+        if import_workers is not None:
+            self.import_workers = int(import_workers)
+
+        verify_state = cp.get("verify", "state", fallback=None) # type: ignore
+        if verify_state is not None:
+            self.verify_state_filename = verify_state
+
+        verify_workers = cp.get("verify", "workers", fallback=None) # type: ignore
+        if verify_workers is not None:
+            self.verify_workers = int(verify_workers)
+
+        max_age = cp.get("verify", "max_age", fallback=None) # type: ignore
+        if max_age is not None:
+            self.verify_max_age = float(max_age) * 86400.0
+
+        time_limit = cp.get("verify", "time_limit", fallback=None) # type: ignore
+        if time_limit is not None:
+            self.verify_time_limit = float(time_limit) * 3600.0 or None
+
+        retag_workers = cp.get("retag", "workers", fallback=None) # type: ignore
+        if retag_workers is not None:
+            self.retag_workers = int(retag_workers)
+
+        refresh = cp.getboolean("retag", "refresh", fallback=None) # type: ignore
+        if refresh is not None:
+            self.retag_refresh = refresh
+
+        formats = cp.get("transcode", "formats", fallback=None) # type: ignore
+        if formats is not None:
+            self.transcode_formats = [
+                fmt.strip().lower() for fmt in formats.split(",")
+                if fmt.strip()]
+            for fmt in self.transcode_formats:
+                if fmt not in DERIVATIVE_FORMATS:
+                    raise ValueError(
+                        f"Invalid transcode format: expected one of "
+                        f"{', '.join(DERIVATIVE_FORMATS)}: {fmt!r}")
+
+        transcode_workers = cp.get( # type: ignore
+            "transcode", "workers", fallback=None)
+        if transcode_workers is not None:
+            self.transcode_workers = int(transcode_workers)
+
     def configure_musicbrainz(self) -> None:
         """
         Configure the MusicBrainz library global settings using the values
@@ -206,41 +740,338 @@ class RipperConfig:
         cid = sts.get_caller_identity()
         return f'{cid["Account"]}-music-collection'
 
-class Ripper:
+def fetch_disc_metadata(
+        disc_id: str, disc_codes: DiscCodes,
+        release_ids: Sequence[str] = ()) -> Dict[str, Any]:
     """
-    Control the CD ripping process.
+    Look up a disc on MusicBrainz. If the disc ID is unknown, fall back to
+    the releases in release_ids (e.g. those found for the disc before), then
+    to searching by the disc's MCN (barcode) and then its ISRCs.
     """
+    try:
+        return mb.get_releases_by_discid(disc_id, includes=MB_INCLUDES)
+    except mb.musicbrainz.ResponseError:
+        log.info("Disc id %s not found on MusicBrainz", disc_id)
+
+    release_ids = list(release_ids)
+    if not release_ids and disc_codes.mcn:
+        result = mb.search_releases(barcode=disc_codes.mcn, strict=True)
+        release_ids = [
+            release["id"] for release in result.get("release-list", [])]
+        log.info("MCN %s matched releases %s", disc_codes.mcn, release_ids)
+
+    if not release_ids:
+        for _, isrc in sorted(disc_codes.isrcs.items()):
+            try:
+                result = mb.get_recordings_by_isrc(isrc, includes=["releases"])
+            except mb.musicbrainz.ResponseError:
+                continue
 
-    def __init__(self, config: RipperConfig, cdrom_filename: str = "/dev/cdrom") -> None:
-        super(Ripper, self).__init__()
+            for recording in result["isrc"].get("recording-list", []):
+                for release in recording.get("release-list", []):
+                    if release["id"] not in release_ids:
+                        release_ids.append(release["id"])
+
+            if release_ids:
+                log.info("ISRC %s matched releases %s", isrc, release_ids)
+                break
+
+    releases = [
+        mb.get_release_by_id(
+            release_id, includes=MB_RELEASE_INCLUDES)["release"]
+        for release_id in release_ids]
+    return {"disc": {"id": disc_id, "release-list": releases}}
+
+def get_release_tags(
+        release: Dict[str, Any], medium: Dict[str, Any], disc_index: int,
+        track_total: int, disc_codes: DiscCodes) -> List[Tuple[str, str]]:
+    """
+    Return the Vorbis comment tags shared by every track on a disc.
+    """
+    tags = []
+    label = ((release.get("label-info-list", []) + [{}])[0]
+             .get("label", {}).get("name"))
+    release_group = release.get("release-group", {})
+
+    tags.append(("DISCNUMBER", str(disc_index)))
+    tags.append(("DISCTOTAL", str(release.get("medium-count", 1))))
+    tags.append(("TRACKTOTAL", str(track_total)))
+
+    album_title = release.get("title")
+    if album_title:
+        tags.append(("ALBUM", album_title))
+
+    if label:
+        tags.append(("LABEL", label))
+
+    disambiguation = release.get("disambiguation")
+    if disambiguation:
+        tags.append(("VERSION", disambiguation))
+
+    date = release.get("date")
+    if date:
+        tags.append(("DATE", date))
+
+    barcode = release.get("barcode") or disc_codes.mcn
+    if barcode:
+        tags.append(("EAN/UPN", barcode))
+
+    asin = release.get("asin")
+    if asin:
+        tags.append(("ASIN", asin))
+
+    for url in release.get("url-relation-list", []):
+        tags.append(
+            (f"URL_{url['type'].replace(' ', '_').upper()}", url["target"]))
+
+    genres = release_group.get("secondary-type-list", [])
+    for genre in genres:
+        tags.append(("GENRE", genre))
+
+    medium_format = medium.get("format")
+    if medium_format:
+        tags.append(("SOURCEMEDIA", medium_format))
+
+    return tags
+
+def get_track_tags(
+        track_index: int, track: Dict[str, Any],
+        disc_codes: DiscCodes) -> List[Tuple[str, str]]:
+    """
+    Return the Vorbis comment tags specific to a single track.
+    """
+    tags = [("TRACKNUMBER", str(track_index))]
+    recording = track.get("recording", {})
+
+    track_title = recording.get("title")
+    if track_title:
+        tags.append(("TITLE", track_title))
+
+    artist = track.get("artist-credit-phrase")
+    if artist:
+        tags.append(("ARTIST", artist))
+
+    performer = recording.get("artist-credit-phrase")
+    if performer:
+        tags.append(("PERFORMER", performer))
+
+    isrc = (disc_codes.isrcs.get(track_index) or
+            (recording.get("isrc-list", []) + [None])[0])
+    if isrc:
+        tags.append(("ISRC", isrc))
+
+    return tags
+
+class ContentIndex:
+    """
+    Local index of audio content already uploaded, keyed by offset-normalized
+    PCM content hash.
+    """
+
+    def __init__(self, filename: str) -> None:
+        super(ContentIndex, self).__init__()
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS content(
+                    content_hash TEXT PRIMARY KEY,
+                    s3_key TEXT NOT NULL,
+                    disc_id TEXT NOT NULL,
+                    track INTEGER NOT NULL,
+                    created REAL NOT NULL)""")
+
+    def lookup(self, content_hash: str) -> Optional[str]:
+        """
+        Return the S3 key of the FLAC object holding this audio, if any.
+        """
+        with self.lock:
+            row = self.db.execute(
+                "SELECT s3_key FROM content WHERE content_hash=?",
+                (content_hash,)).fetchone()
+        return row[0] if row else None
+
+    def add(self, content_hash: str, s3_key: str, disc_id: str,
+            track: int) -> None:
+        """
+        Record that the audio with this hash has been uploaded to s3_key.
+        """
+        with self.lock, self.db:
+            self.db.execute(
+                "INSERT OR IGNORE INTO content VALUES (?, ?, ?, ?, ?)",
+                (content_hash, s3_key, disc_id, track, time()))
+
+def write_wav(filename: str, pcm: bytes) -> None:
+    """
+    Write CD audio PCM data to a WAV file.
+    """
+    with wave.open(filename, "wb") as wav:
+        wav.setnchannels(CD_CHANNELS)
+        wav.setsampwidth(CD_BITS_PER_SAMPLE // 8)
+        wav.setframerate(CD_SAMPLE_RATE)
+        wav.writeframes(pcm)
+
+class DeemphasisWriter:
+    """
+    Write a de-emphasized copy of a track to a WAV file as it is extracted.
+    """
+
+    def __init__(self, filename: str) -> None:
+        super(DeemphasisWriter, self).__init__()
+        self.filename = filename
+        self.filter = DeemphasisFilter()
+        self.wav = wave.open(filename, "wb")
+        self.wav.setnchannels(CD_CHANNELS)
+        self.wav.setsampwidth(CD_BITS_PER_SAMPLE // 8)
+        self.wav.setframerate(CD_SAMPLE_RATE)
+
+    def update(self, pcm: bytes) -> None:
+        """
+        De-emphasize the next chunk of PCM data and append it to the file.
+        """
+        self.wav.writeframes(self.filter.process(pcm))
+
+    def update_from_wav(self, filename: str) -> None:
+        """
+        De-emphasize the audio in a WAV file and append it to the file.
+        """
+        with wave.open(filename, "rb") as wav:
+            while True:
+                frames = wav.readframes(DEEMPHASIS_CHUNK_FRAMES)
+                if not frames:
+                    break
+                self.update(frames)
+
+    def close(self) -> None:
+        """
+        Finish writing the WAV file.
+        """
+        self.wav.close()
+
+class RipperSession:
+    """
+    Long-lived state shared by every disc ripped in this process: the AWS
+    session and clients, the uploader and spool, worker pools, and caches.
+    Creating this is the expensive part of starting up, so a daemon creates
+    it once and reuses it for every disc.
+    """
+
+    def __init__(self, config: RipperConfig) -> None:
+        super(RipperSession, self).__init__()
         self.config = config
         self.config.configure_musicbrainz()
         self.boto = config.get_boto_session()
         self.s3 = self.boto.resource("s3")
 
-        self.cdrom_filename = cdrom_filename
-        self.drive = CDROMDrive.from_filename(cdrom_filename)
-        self.disc_info = self.drive.get_disc_information()
-        self.disc_id = self.disc_info.musicbrainz_id
-        self.disc_metadata: Dict[str, Any] = {}
-
         if self.config.s3_bucket_name is None:
             self.config.s3_bucket_name = RipperConfig.get_default_bucket_name(
                 self.boto)
         self.bucket = self.s3.Bucket(self.config.s3_bucket_name)
-
-        self.executor = ThreadPoolExecutor()
-
-        # Set defaults for the release, medium, etc.
-        self.release: Dict[str, Any] = {}
-        self.medium: Dict[str, Any] = {}
-        self.disc_index = 1
-        self.tracks: Dict[int, Dict[str, Any]] = {}
+        self._bucket_checked = False
+
+        # All S3 writes go through a single uploader with a shared concurrency
+        # and bandwidth budget. The executor only runs encodes and art
+        # downloads, so it is sized to the CPU count.
+        self.uploader = S3Uploader(
+            self.boto, self.config.s3_bucket_name,
+            max_concurrency=self.config.upload_max_concurrency,
+            max_bandwidth=self.config.upload_max_bandwidth,
+            max_attempts=self.config.upload_max_attempts)
+
+        # Artifacts are committed to the spool and drained to S3 in the
+        # background, so ripping never waits on the network. Opening the
+        # spool resumes any uploads left over from a previous run.
+        try:
+            self.spool = Spool(
+                expanduser(self.config.spool_directory), self.uploader,
+                high_water_bytes=self.config.spool_high_water,
+                max_retries=self.config.spool_max_retries,
+                min_free_bytes=self.config.spool_min_free)
+        except SpoolLockedError:
+            self.uploader.shutdown(wait=False)
+            raise
+        self.executor = ThreadPoolExecutor(max_workers=cpu_count())
+
+        # Encode FLAC in worker processes when libFLAC is available so a
+        # burst of short tracks keeps every core busy.
+        self.encode_pool: Optional[ProcessPoolExecutor] = None
+        if self.config.flac_backend == "libflac" or (
+                self.config.flac_backend == "auto" and libflac_available()):
+            if not libflac_available():
+                raise RuntimeError("libFLAC is not installed")
+
+            # By now the uploader and spool threads are running, and forking
+            # this process could copy a lock one of them holds. Start the
+            # workers from a fork server instead, which is a fresh
+            # interpreter. (Python 3.6 can't choose the start method.)
+            if version_info >= (3, 7):
+                self.encode_pool = ProcessPoolExecutor(
+                    mp_context=get_context("forkserver"))
+            else:
+                self.encode_pool = ProcessPoolExecutor()
+
+        # Both encoder backends run one encode per CPU at a time.
+        self.compression_policy: Optional[CompressionPolicy] = None
+        if self.config.adaptive_compression:
+            self.compression_policy = CompressionPolicy(
+                CompressionHistory(self.config.compression_history_filename),
+                workers=cpu_count() or 1,
+                initial_level=self.config.flac_compression_level)
+
+        if self.config.replaygain and not loudness_available():
+            raise RuntimeError("NumPy is required for ReplayGain analysis")
+
+        if self.config.deemphasis and not deemphasis_available():
+            raise RuntimeError("NumPy is required for de-emphasis")
+
+        self.content_index: Optional[ContentIndex] = None
+        if self.config.content_index_filename:
+            self.content_index = ContentIndex(
+                self.config.content_index_filename)
+
+        self.catalog: Optional[DynamoDBCatalog] = None
+        if self.config.dynamodb_table:
+            self.catalog = DynamoDBCatalog(
+                self.boto, self.config.dynamodb_table,
+                endpoint_url=self.config.dynamodb_endpoint)
+
+        self.local_catalog: Optional[SQLiteCatalog] = None
+        if self.config.catalog_filename:
+            self.local_catalog = SQLiteCatalog(self.config.catalog_filename)
+
+        self.metadata_cache = MetadataCache(
+            self.config.metadata_cache_filename,
+            max_age=self.config.metadata_cache_max_age)
+
+        self.speed_history: Optional[SpeedHistory] = None
+        if self.config.speed_history_filename:
+            self.speed_history = SpeedHistory(
+                self.config.speed_history_filename)
+        self._speed_controllers: Dict[str, SpeedController] = {}
+        self._lock = Lock()
+
+        # Without a profile file, drives are still profiled (once per
+        # session) when extraction is "auto".
+        self.drive_profiles: Optional[DriveProfileCache] = None
+        if (self.config.drive_profiles_filename or
+                self.config.extraction_mode == "auto"):
+            self.drive_profiles = DriveProfileCache(
+                self.config.drive_profiles_filename)
 
     def ensure_bucket_exists(self) -> None:
         """
-        Ensure the S3 bucket exists, creating it if necessary.
+        Ensure the S3 bucket (and the catalog table, if configured) exists,
+        creating it if necessary. This is only checked once per session.
         """
+        with self._lock:
+            if self._bucket_checked:
+                return
+            self._create_bucket_if_missing()
+            if self.catalog is not None:
+                self.catalog.ensure_table_exists()
+            self._bucket_checked = True
+
+    def _create_bucket_if_missing(self) -> None:
         if self.bucket.creation_date is not None:
             log.info("S3 bucket %s exists", self.bucket.name)
             return
@@ -270,74 +1101,247 @@ class Ripper:
             }
         )
 
-    def rank_release_by_country(self, release: Dict[str, Any]) -> int:
+    def get_speed_controller(
+            self, drive: CDROMDrive, cdrom_filename: str,
+            profile: Optional[DriveProfile] = None
+    ) -> Optional[SpeedController]:
+        """
+        Return the speed controller for a drive, creating it on first use, or
+        None if speed control is not configured. Without speed history for
+        the drive, it starts from the profile's maximum reliable speed.
+        """
+        if self.speed_history is None:
+            return None
+
+        with self._lock:
+            controller = self._speed_controllers.get(cdrom_filename)
+            if controller is not None and controller.drive is drive:
+                return controller
+
+            try:
+                drive_key = str(drive.get_identity())
+            except IOError:
+                log.warning("Unable to identify drive %s", cdrom_filename,
+                            exc_info=True)
+                drive_key = cdrom_filename
+
+            controller = SpeedController(
+                drive, drive_key=drive_key, history=self.speed_history,
+                initial_speed=(
+                    profile.max_reliable_speed if profile is not None
+                    else None))
+            self._speed_controllers[cdrom_filename] = controller
+            return controller
+
+    def get_drive_profile(
+            self, drive: CDROMDrive, cdrom_filename: str
+    ) -> Optional[DriveProfile]:
+        """
+        Return the capability profile for a drive, probing it if its model
+        has not been seen before, or None if profiling is not configured or
+        the drive can't be identified.
+        """
+        if self.drive_profiles is None:
+            return None
+
+        try:
+            return self.drive_profiles.get_profile(drive)
+        except (IOError, NotImplementedError):
+            log.warning("Unable to profile drive %s", cdrom_filename,
+                        exc_info=True)
+            return None
+
+    def close(self, drain: bool = True) -> None:
+        """
+        Release the session's pools and uploader. If drain is True, wait for
+        the spool to be uploaded first; otherwise uploads in progress are
+        abandoned and resume from the spool on the next run.
+        """
+        if drain:
+            log.info("Waiting for %d spooled uploads (%d bytes) to complete",
+                     self.spool.pending_count, self.spool.pending_bytes)
+            self.spool.drain()
+        self.spool.close()
+        self.executor.shutdown()
+        self.metadata_cache.close()
+        if self.encode_pool is not None:
+            self.encode_pool.shutdown()
+        self.uploader.shutdown(wait=drain)
+
+class Ripper:
+    """
+    Control the CD ripping process for a single disc.
+    """
+
+    def __init__(
+            self, config: RipperConfig, cdrom_filename: str = "/dev/cdrom",
+            session: Optional[RipperSession] = None,
+            drive: Optional[CDROMDrive] = None) -> None:
+        super(Ripper, self).__init__()
+        self._owns_session = session is None
+        self.session = session if session is not None else RipperSession(
+            config)
+        self.config = config
+        self.boto = self.session.boto
+        self.s3 = self.session.s3
+        self.bucket = self.session.bucket
+        self.spool = self.session.spool
+        self.executor = self.session.executor
+        self.encode_pool = self.session.encode_pool
+        self.compression_policy = self.session.compression_policy
+        self.content_index = self.session.content_index
+        self.catalog = self.session.catalog
+        self.local_catalog = self.session.local_catalog
+        self.metadata_cache = self.session.metadata_cache
+
+        self.cdrom_filename = cdrom_filename
+        self.drive = drive if drive is not None else (
+            CDROMDrive.from_filename(cdrom_filename))
+        self.disc_info = self.drive.get_disc_information()
+        self.disc_id = self.disc_info.musicbrainz_id
+        self.disc_metadata: Dict[str, Any] = {}
+        self.release_index: Optional[ReleaseIndex] = None
+        self.disc_codes = DiscCodes(mcn=None, isrcs={})
+
+        # An imported rip is served from memory: there is no speed to tune,
+        # no drive to profile, and nothing for cdparanoia to open.
+        self.imported = isinstance(self.drive, ImageCDROMDrive)
+        self.speed_controller: Optional[SpeedController] = None
+        self.drive_profile: Optional[DriveProfile] = None
+        if not self.imported:
+            self.drive_profile = self.session.get_drive_profile(
+                self.drive, cdrom_filename)
+            self.speed_controller = self.session.get_speed_controller(
+                self.drive, cdrom_filename, self.drive_profile)
+
+        self.extraction_mode = config.extraction_mode
+        if self.imported:
+            self.extraction_mode = "secure"
+        elif self.extraction_mode == "auto":
+            self.extraction_mode = (
+                self.drive_profile.extraction_mode
+                if self.drive_profile is not None else "cdparanoia")
+            log.info("Using %s extraction on %s", self.extraction_mode,
+                     cdrom_filename)
+
+        # Working directory for this disc, and the executor tasks that must
+        # finish before it can be removed.
+        self.work_directory = ""
+        self._tasks: List["Future[Any]"] = []
+
+        # S3 keys and content types of every object stored for this disc.
+        self.artifacts: Dict[str, str] = {}
+        self._comment_template: Optional[VorbisCommentTemplate] = None
+
+        # Loudness of each track as it is extracted. Album gain is only known
+        # once every track has been read, so tagging waits on this future.
+        self.album_loudness: Optional[AlbumLoudness] = (
+            AlbumLoudness() if self.config.replaygain else None)
+        self.track_loudness: Dict[int, Loudness] = {}
+        self._album_loudness_future: "Future[Loudness]" = Future()
+
+        # Set defaults for the release, medium, etc.
+        self.release: Dict[str, Any] = {}
+        self.medium: Dict[str, Any] = {}
+        self.disc_index = 1
+        self.tracks: Dict[int, Dict[str, Any]] = {}
+        self.track_indices: Dict[TrackIndex, int] = {}
+
+    def ensure_bucket_exists(self) -> None:
         """
-        Given a MusicBrainz release structure, examine its country and return
-        an integer indicating the user's preference for using these details.
+        Ensure the S3 bucket exists, creating it if necessary.
         """
-        country = release.get("country", "").upper()
-        if country not in self.config.musicbrainz_country_preference:
-            return len(self.config.musicbrainz_country_preference)
+        self.session.ensure_bucket_exists()
 
-        return self.config.musicbrainz_country_preference.index(country)
+    def work_path(self, filename: str) -> str:
+        """
+        Return the path of a file in this disc's working directory.
+        """
+        return join(self.work_directory, filename)
 
     def get_preferred_names(self) -> None:
         """
         Set the release, medium, disc_index, and tracks members using the
         preferred release.
         """
-        # Order releases by preferred country
-        releases_by_country = sorted(
-            self.disc_metadata["disc"]["release-list"],
-            key=self.rank_release_by_country)
-
-        for release in releases_by_country:
-            country = release["country"]
-            # Which medium do we have?
-            for medium in release["medium-list"]:
-                disc_index = int(medium["position"])
-                disc_ids = [disc["id"] for disc in medium["disc-list"]]
+        releases = self.disc_metadata["disc"]["release-list"]
+        if self.release_index is None:
+            self.release_index = ReleaseIndex.build(
+                releases, self.config.musicbrainz_country_preference)
+
+        location = self.release_index.find(self.disc_id)
+        if location is None:
+            # The disc ID is unknown, but the release may have been found via
+            # the disc's MCN or ISRCs; pick a medium with a matching track
+            # count.
+            n_audio_tracks = sum(
+                1 for track in self.disc_info.track_information
+                if track.track_type == TrackType.audio)
+            location = self.release_index.find_by_track_count(n_audio_tracks)
+            if location is not None:
+                release = releases[location[0]]
+                log.info("Using %s release %s medium %s by track count",
+                         release.get("country"), release["id"],
+                         release["medium-list"][location[1]]["position"])
+
+        if location is None:
+            # Nothing found. <sigh>
+            log.error("Did not find disc id %s in any release/medium",
+                      self.disc_id)
+            return
 
-                log.debug("Searching for disc id %s in %s release, medium %d, "
-                          "containing disc ids %s", self.disc_id, country,
-                          disc_index, disc_ids)
+        self.release = releases[location[0]]
+        self.medium = self.release["medium-list"][location[1]]
+        self.disc_index = int(self.medium["position"])
+        self.tracks = {
+            int(track["number"]): track
+            for track in self.medium["track-list"]
+        }
+        log.debug("Disc id %s found in %s release %s, medium %d",
+                  self.disc_id, self.release.get("country"),
+                  self.release["id"], self.disc_index)
+
+    def read_disc_codes(self) -> None:
+        """
+        Read the media catalog number and track ISRCs from the disc.
+        """
+        try:
+            self.disc_codes = self.drive.get_disc_codes(self.disc_info)
+        except (IOError, NotImplementedError):
+            log.warning("Unable to read MCN/ISRCs from disc", exc_info=True)
+            return
 
-                if self.disc_id not in disc_ids:
-                    log.debug("Disc id not found")
-                    continue
+        log.info("Disc MCN=%s; %d of %d tracks have ISRCs",
+                 self.disc_codes.mcn, len(self.disc_codes.isrcs),
+                 len(self.disc_info.track_information) - 1)
 
-                # Found it
-                log.debug("Disc id found")
-                self.release = release
-                self.medium = medium
-                self.disc_index = disc_index
-                self.tracks = {
-                    int(track["number"]): track
-                    for track in medium["track-list"]
-                }
-                return
+    def get_disc_metadata(self) -> None:
+        """
+        Look up the disc on MusicBrainz. If the disc ID is unknown, fall back
+        to searching by the disc's MCN (barcode) and then its ISRCs.
+        """
+        cached = self.metadata_cache.get_metadata(self.disc_id)
+        if cached is not None:
+            log.info("Using cached MusicBrainz metadata for disc %s",
+                     self.disc_id)
+            self.disc_metadata = cached
+            self.release_index = self.metadata_cache.get_index(
+                self.disc_id, self.config.musicbrainz_country_preference)
+            return
 
-        # Nothing found. <sigh>
-        log.error("Did not find disc id %s in any release/medium", self.disc_id)
+        self.disc_metadata = fetch_disc_metadata(self.disc_id, self.disc_codes)
 
-    def put_object(self, Key: str, **kw):
+    def put_object(
+            self, Key: str, Body: bytes, ContentType: str,
+            ACL: str = "private",
+            priority: UploadPriority = UploadPriority.metadata
+    ) -> "Future[str]":
         """
-        Asynchronously write an object to S3.
+        Commit an object to the spool for asynchronous upload to S3.
         """
-        def task():
-            try:
-                self.log.debug("Writing s3://%s/%s", self.bucket.name, Key)
-                result = self.bucket.put_object(Key=Key, **kw)
-                self.log.debug(
-                    "Write of s3://%s/%s succeeded", self.bucket.name, Key)
-                return result
-            except:
-                self.log.error(
-                    "Write of s3://%s/%s failed", self.bucket.name, Key,
-                    exc_info=True)
-                raise
-
-        self.executor.submit(task)
+        self.artifacts[Key] = ContentType
+        return self.spool.add_bytes(
+            Key, Body, content_type=ContentType, acl=ACL, priority=priority)
 
     def get_album_art(self) -> None:
         """
@@ -397,25 +1401,124 @@ class Ripper:
                     def copy_art_to_s3(image_id, rel_id, key):
                         nonlocal self
                         image = mb.get_image(rel_id, image_id)
-                        self.bucket.put_object(
+                        self.put_object(
                             ACL="private", Body=image, ContentType="image/jpeg",
-                            Key=key)
-                    self.executor.submit(copy_art_to_s3, image_id, rel_id, key)
+                            Key=key, priority=UploadPriority.art)
+                    self._tasks.append(self.executor.submit(
+                        copy_art_to_s3, image_id, rel_id, key))
                 release["images"] = image_list
             except mb.musicbrainz.ResponseError:
                 release["images"] = []
 
+    def detect_track_indices(self) -> None:
+        """
+        Locate pregaps and index points on the disc and upload a cue sheet
+        describing them.
+        """
+        try:
+            self.track_indices = self.drive.get_track_indices(self.disc_info)
+        except (IOError, NotImplementedError):
+            log.warning("Unable to detect track indices; cue sheet will not "
+                        "include pregaps", exc_info=True)
+            self.track_indices = {}
+
+        for track_index, frame in sorted(self.track_indices.items()):
+            log.debug("Track %d index %d starts at frame %d",
+                      track_index.track, track_index.index, frame)
+
+        cue_sheet = format_cue_sheet(
+            self.disc_info, self.track_indices,
+            rem={"MUSICBRAINZ_DISCID": self.disc_id}, codes=self.disc_codes)
+        self.put_object(
+            ACL="private", Body=cue_sheet.encode("utf-8"),
+            ContentType="text/plain",
+            Key=f"{self.config.s3_prefix}{self.disc_id}/disc.cue")
+
     def rip_convert_track(self, track_index: int) -> None:
         """
-        Rip a track using cdparanoia. Convert it to FLAC, AAC, and MP3 formats.
-        Upload it to S3.
+        Rip a track using the configured extraction mode. Convert it to FLAC,
+        AAC, and MP3 formats. Upload it to S3.
+        """
+        if self.extraction_mode == "secure":
+            self.rip_track_secure(track_index)
+        else:
+            self.rip_track_cdparanoia(track_index)
+
+    def rip_track_secure(self, track_index: int) -> None:
+        """
+        Rip a track using C2-guided secure extraction, then convert and upload
+        it.
+        """
+        log_filename = f"extract-{track_index:02d}.log"
+        log_path = self.work_path(log_filename)
+        start_frame, end_frame = self.disc_info.get_track_frames(track_index)
+        extractor = SecureExtractor(
+            self.drive, speed_controller=self.speed_controller,
+            defeat_drive_cache=(
+                self.drive_profile is None or
+                self.drive_profile.defeat_drive_cache))
+
+        # Apply the read offset as the continuous path does: samples shifted
+        # across a track boundary come from the adjacent track in the run.
+        read_offset = (
+            self.drive_profile.read_offset or 0
+            if self.drive_profile is not None else 0)
+        read_limits = next(
+            ((run[0].start_frame, run[-1].end_frame)
+             for run in contiguous_audio_runs(self.disc_info)
+             if any(span.track == track_index for span in run)), None)
+        splitter = TrackSplitter(
+            [TrackSpan(track_index, start_frame, end_frame)], read_offset,
+            read_limits)
+
+        log.info("Extracting track %d (frames %d-%d)", track_index,
+                 start_frame, end_frame)
+        chunks = (
+            data for _, data in extractor.extract(
+                splitter.read_start, splitter.read_end))
+        (extracted,) = self.analyze_extracted_tracks(
+            splitter.split_pieces(chunks))
+
+        if self.speed_controller is not None:
+            self.speed_controller.finish()
+
+        stats = extractor.stats
+        with open(log_path, "w") as fd:
+            fd.write(f"track={track_index} start_frame={start_frame} "
+                     f"end_frame={end_frame} read_offset={read_offset}\n"
+                     f"{stats!r}\n")
+
+        if stats.unrecovered_frames:
+            log.warning("Track %d has %d unverified frames", track_index,
+                        len(stats.unrecovered_frames))
+        elif (self.drive_profile is not None and
+              self.speed_controller is not None and
+              self.speed_controller.enabled):
+            self.session.drive_profiles.record_speed(
+                self.drive_profile, self.speed_controller.speed)
+
+        with open(log_path, "rb") as bfd:
+            self.put_object(
+                ACL="private", Body=bfd.read(), ContentType="text/plain",
+                Key=f"{self.config.s3_prefix}{self.disc_id}/{log_filename}",
+                priority=UploadPriority.log)
+
+        self.store_track(*extracted)
+
+    def rip_track_cdparanoia(self, track_index: int) -> None:
+        """
+        Rip a track using cdparanoia, then convert and upload it.
         """
         cdparanoia_log_filename = f"cdparanoia-{track_index:02d}.log"
-        wav_filename = f"track-{track_index:02d}.wav"
+        cdparanoia_log_path = self.work_path(cdparanoia_log_filename)
+        wav_filename = self.work_path(f"track-{track_index:02d}.wav")
         cmd = [
             "cdparanoia", "--force-cdrom-device", self.cdrom_filename,
-            f"--log-debug={cdparanoia_log_filename}", str(track_index),
-            wav_filename]
+            f"--log-debug={cdparanoia_log_path}"]
+        if (self.drive_profile is not None and
+                self.drive_profile.read_offset):
+            cmd.append(f"--sample-offset={self.drive_profile.read_offset}")
+        cmd.extend([str(track_index), wav_filename])
         log.debug("Executing %s", " ".join(cmd))
         cp = run(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
 
@@ -424,127 +1527,552 @@ class Ripper:
             log.error("cdparanoia on track %d failed: exit code %d",
                       track_index, cp.returncode)
 
-            with open(cdparanoia_log_filename, "r") as fd:
+            with open(cdparanoia_log_path, "r") as fd:
                 for line in fd:
                     log.error("%s", line)
-            return
+            # A disc with a missing track must not be cataloged.
+            raise RuntimeError(f"cdparanoia failed on track {track_index}")
 
-        with open(cdparanoia_log_filename, "rb") as bfd:
+        with open(cdparanoia_log_path, "rb") as bfd:
             self.put_object(
                 ACL="private", Body=bfd.read(), ContentType="text/plain",
                 Key=(f"{self.config.s3_prefix}{self.disc_id}/"
-                     f"{cdparanoia_log_filename}"))
+                     f"{cdparanoia_log_filename}"),
+                priority=UploadPriority.log)
+
+        deemphasis = self.start_deemphasis(track_index)
+        if deemphasis is not None:
+            deemphasis.update_from_wav(wav_filename)
+            self.finish_deemphasis(track_index, deemphasis)
 
-        self.convert_upload_flac(track_index)
+        if self.content_index is None and self.album_loudness is None:
+            self.convert_upload_flac(track_index)
+            return
+
+        pcm = read_wav_pcm(wav_filename)
+        analyzer = self.start_loudness()
+        if analyzer is not None:
+            analyzer.update(pcm)
+        self.finish_loudness(track_index, analyzer)
+
+        if self.content_index is None:
+            # Already on disk as a WAV file; no need to hold the audio.
+            self.convert_upload_flac(track_index)
+            return
+
+        hasher = PCMContentHasher()
+        hasher.update(pcm)
+        self.store_track(track_index, pcm, hasher.hexdigest())
 
-    def convert_upload_flac(self, track_index: int) -> None:
+    def rip_run_continuous(self, tracks: List[TrackSpan]) -> None:
         """
-        Convert a WAV file to FLAC, adding tags, and upload it to S3.
+        Extract a run of adjacent audio tracks in one sequential pass,
+        storing each track as soon as its last sector has been read.
         """
-        output_filename = f"track-{track_index:02d}.flac"
-        cmd = ["flac", "-5", f"--output-name={output_filename}"]
-        track = self.tracks.get(track_index, {})
-        track_total = (
-            len(self.tracks) if self.tracks
-            else len(self.disc_info.track_information) - 1)
-        recording = track.get("recording", {})
-        label = ((self.release.get("label-info-list", []) + [{}])[0]
-                 .get("label", {}).get("name"))
-        release_group = self.release.get("release-group", {})
+        first, last = tracks[0].track, tracks[-1].track
+        log.info("Extracting tracks %d-%d (frames %d-%d) continuously",
+                 first, last, tracks[0].start_frame, tracks[-1].end_frame)
 
-        cmd.append(f"--tag=DISCNUMBER={self.disc_index}")
-        cmd.append(f"--tag=DISCTOTAL={self.release['medium-count']}")
-        cmd.append(f"--tag=TRACKNUMBER={track_index}")
-        cmd.append(f"--tag=TRACKTOTAL={track_total}")
+        if self.extraction_mode != "secure":
+            self.rip_run_cdparanoia(tracks)
+            return
 
-        album_title = self.release.get("title")
-        if album_title:
-            cmd.append(f"--tag=ALBUM={album_title}")
+        read_offset = (
+            self.drive_profile.read_offset or 0
+            if self.drive_profile is not None else 0)
+        splitter = TrackSplitter(tracks, read_offset)
+        defeat_drive_cache = (
+            self.drive_profile is None or
+            self.drive_profile.defeat_drive_cache)
+
+        if (self.config.reader_process and ring_available() and
+                not self.imported):
+            unrecovered = self.extract_run_in_process(
+                splitter, defeat_drive_cache)
+            details = f"unrecovered_frames={unrecovered!r}"
+        else:
+            extractor = SecureExtractor(
+                self.drive, speed_controller=self.speed_controller,
+                defeat_drive_cache=defeat_drive_cache)
+            chunks = (
+                data for _, data in extractor.extract(
+                    splitter.read_start, splitter.read_end))
+            for extracted in self.analyze_extracted_tracks(
+                    splitter.split_pieces(chunks)):
+                self.store_track(*extracted)
+
+            if self.speed_controller is not None:
+                self.speed_controller.finish()
+            unrecovered = extractor.stats.unrecovered_frames
+            details = repr(extractor.stats)
+
+        log_filename = f"extract-{first:02d}-{last:02d}.log"
+        log_body = (
+            f"tracks={first}-{last} start_frame={splitter.read_start} "
+            f"end_frame={splitter.read_end} read_offset={read_offset}\n"
+            f"{details}\n")
+        with open(self.work_path(log_filename), "w") as fd:
+            fd.write(log_body)
+
+        if unrecovered:
+            log.warning("Tracks %d-%d have %d unverified frames", first, last,
+                        len(unrecovered))
+        elif (self.drive_profile is not None and
+              self.speed_controller is not None and
+              self.speed_controller.enabled):
+            self.session.drive_profiles.record_speed(
+                self.drive_profile, self.speed_controller.speed)
 
-        if label:
-            cmd.append(f"--tag=LABEL={label}")
+        self.put_object(
+            ACL="private", Body=log_body.encode("utf-8"),
+            ContentType="text/plain",
+            Key=f"{self.config.s3_prefix}{self.disc_id}/{log_filename}",
+            priority=UploadPriority.log)
+
+    def extract_run_in_process(
+            self, splitter: TrackSplitter,
+            defeat_drive_cache: bool) -> List[int]:
+        """
+        Securely extract the frames a splitter needs in a reader process,
+        which hands them over through a shared-memory ring, and store each
+        track as it completes. Returns the frames that could not be verified.
+        """
+        ring = FrameRing()
+        reader = RingReader(
+            ring, self.cdrom_filename, splitter.read_start, splitter.read_end,
+            defeat_drive_cache=defeat_drive_cache)
+
+        def chunks() -> Iterator[memoryview]:
+            for slot in ring.consumer():
+                with slot:
+                    yield slot.data
+
+        stream = chunks()
+        reader.start()
+        try:
+            for extracted in self.analyze_extracted_tracks(
+                    splitter.split_pieces(stream)):
+                self.store_track(*extracted)
+            return reader.join()
+        finally:
+            # Release the slot being viewed (if any) before detaching.
+            stream.close()
+            reader.close()
+            ring.close()
 
-        disambiguation = self.release.get("disambiguation")
-        if disambiguation:
-            cmd.append(f"--tag=VERSION={disambiguation}")
+    def rip_run_cdparanoia(self, tracks: List[TrackSpan]) -> None:
+        """
+        Extract a run of adjacent audio tracks with a single cdparanoia
+        invocation, splitting its raw output into tracks as it arrives.
+        """
+        first, last = tracks[0].track, tracks[-1].track
+        cdparanoia_log_filename = f"cdparanoia-{first:02d}-{last:02d}.log"
+        cdparanoia_log_path = self.work_path(cdparanoia_log_filename)
+        cmd = [
+            "cdparanoia", "--force-cdrom-device", self.cdrom_filename,
+            "--output-raw-little-endian", f"--log-debug={cdparanoia_log_path}"]
+        if (self.drive_profile is not None and
+                self.drive_profile.read_offset):
+            cmd.append(f"--sample-offset={self.drive_profile.read_offset}")
+        cmd.extend([f"{first}-{last}", "-"])
+        log.debug("Executing %s", " ".join(cmd))
 
-        date = self.release.get("date")
-        if date:
-            cmd.append(f"--tag=DATE={date}")
+        def chunks() -> Iterator[bytes]:
+            with Popen(
+                    cmd, stdin=DEVNULL, stdout=PIPE, stderr=DEVNULL) as proc:
+                yield from iter(
+                    lambda: proc.stdout.read(CONTINUOUS_READ_BYTES), b"")
+                returncode = proc.wait()
+
+            if returncode != 0:
+                # Tracks already stored were read in full; the rest are lost.
+                log.error("cdparanoia on tracks %d-%d failed: exit code %d",
+                          first, last, returncode)
+                with open(cdparanoia_log_path, "r") as fd:
+                    for line in fd:
+                        log.error("%s", line)
+                raise RuntimeError(
+                    f"cdparanoia failed on tracks {first}-{last}")
+
+        # cdparanoia has already applied the read offset to its output.
+        splitter = TrackSplitter(tracks)
+        for extracted in self.analyze_extracted_tracks(
+                splitter.split_pieces(chunks())):
+            self.store_track(*extracted)
+
+        with open(cdparanoia_log_path, "rb") as bfd:
+            self.put_object(
+                ACL="private", Body=bfd.read(), ContentType="text/plain",
+                Key=(f"{self.config.s3_prefix}{self.disc_id}/"
+                     f"{cdparanoia_log_filename}"),
+                priority=UploadPriority.log)
 
-        barcode = self.release.get("barcode")
-        if barcode:
-            cmd.append(f"--tag=EAN/UPN={barcode}")
+    def analyze_extracted_tracks(
+            self, pieces: Iterable[TrackPiece]
+    ) -> Iterator[Tuple[int, bytes, Optional[str]]]:
+        """
+        Analyze extracted tracks a piece at a time as they are read, yielding
+        (track, pcm, content hash) for each, ready for store_track(), once it
+        is complete.
+        """
+        parts: List[bytes] = []
+        started = False
+        hasher: Optional[PCMContentHasher] = None
+        analyzer: Optional[TrackLoudnessAnalyzer] = None
+        deemphasis: Optional[DeemphasisWriter] = None
+        for track_index, pcm, complete in pieces:
+            if not started:
+                started = True
+                hasher = self.start_content_hash()
+                analyzer = self.start_loudness()
+                deemphasis = self.start_deemphasis(track_index)
+
+            for consumer in (hasher, analyzer, deemphasis):
+                if consumer is not None:
+                    consumer.update(pcm)
+            parts.append(pcm)
+            if not complete:
+                continue
 
-        asin = self.release.get("asin")
-        if asin:
-            cmd.append(f"--tag=ASIN={asin}")
+            self.finish_loudness(track_index, analyzer)
+            self.finish_deemphasis(track_index, deemphasis)
+            pcm = b"".join(parts)
+            parts = []
+            started = False
+            yield (track_index, pcm,
+                   hasher.hexdigest() if hasher is not None else None)
 
-        for url in self.release.get("url-relation-list", []):
-            tag = f"URL_{url['type'].replace(' ', '_').upper()}"
-            cmd.append(f"--tag={tag}={url['target']}")
+    def start_content_hash(self) -> Optional[PCMContentHasher]:
+        """
+        Return a content hasher for the next track, or None if there is no
+        content index to deduplicate against.
+        """
+        if self.content_index is None:
+            return None
+        return PCMContentHasher()
 
-        genres = release_group.get("secondary-type-list", [])
-        for genre in genres:
-            cmd.append(f"--tag=GENRE={genre}")
+    def store_track(
+            self, track_index: int, pcm: bytes,
+            content_hash: Optional[str]) -> None:
+        """
+        Store an extracted track: if its audio is already in the content
+        index, upload a reference to the existing FLAC object; otherwise
+        convert and upload it.
+        """
+        existing = (
+            self.content_index.lookup(content_hash)
+            if self.content_index is not None and content_hash is not None
+            else None)
+        if existing is None:
+            self.convert_upload_flac(track_index, pcm, content_hash)
+            return
 
-        medium_format = self.medium.get("format")
-        if medium_format:
-            cmd.append(f"--tag=SOURCEMEDIA={medium_format}")
+        log.info("Track %d duplicates s3://%s/%s; storing a reference",
+                 track_index, self.bucket.name, existing)
+        tags = get_release_tags(
+            self.release, self.medium, self.disc_index,
+            self.get_track_total(), self.disc_codes) + get_track_tags(
+                track_index, self.tracks.get(track_index, {}), self.disc_codes)
+        reference = {
+            "content_sha256": content_hash,
+            "target": existing,
+            "tags": [[name, value] for name, value in tags],
+        }
+        self.put_object(
+            ACL="private", Body=json.dumps(reference).encode("utf-8"),
+            ContentType="application/json",
+            Key=(f"{self.config.s3_prefix}{self.disc_id}/"
+                 f"{track_index:02d}.ref.json"))
 
-        track_title = recording.get("title")
-        if track_title:
-            cmd.append(f"--tag=TITLE={track_title}")
+    def start_loudness(self) -> Optional[TrackLoudnessAnalyzer]:
+        """
+        Return a loudness analyzer for the next track, or None if ReplayGain
+        tagging is disabled.
+        """
+        if self.album_loudness is None:
+            return None
+        return TrackLoudnessAnalyzer()
 
-        artist = track.get("artist-credit-phrase")
-        if artist:
-            cmd.append(f"--tag=ARTIST={artist}")
+    def finish_loudness(
+            self, track_index: int,
+            analyzer: Optional[TrackLoudnessAnalyzer]) -> None:
+        """
+        Record a track's loudness and add it to the album's.
+        """
+        if analyzer is None or self.album_loudness is None:
+            return
 
-        performer = recording.get("artist-credit-phrase")
-        if performer:
-            cmd.append(f"--tag=PERFORMER={performer}")
-        
-        cmd.append(f"track-{track_index:02d}.wav")
+        loudness = self.album_loudness.add(analyzer)
+        self.track_loudness[track_index] = loudness
+        log.info("Track %d: integrated loudness %s LUFS, true peak %.4f",
+                 track_index, loudness.integrated, loudness.true_peak)
 
-        s3_key = f"{self.config.s3_prefix}{self.disc_id}/{track_index:02d}.flac"
+    def is_preemphasized(self, track_index: int) -> bool:
+        """
+        Indicates whether the disc flags a track as mastered with
+        pre-emphasis.
+        """
+        for track in self.disc_info.track_information:
+            if track.track == track_index:
+                return (track.track_type == TrackType.audio and
+                        bool(track.flags & TrackFlags.PREEMPHASIS))
+        return False
 
-        def task():
-            nonlocal cmd, output_filename, self, s3_key
-            log.info("Converting track %d to FLAC: %s", track_index,
-                     " ".join(cmd))
-            cp = run(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
-            if cp.returncode != 0:
-                log.error("FLAC conversion of track %d failed: exit code %d",
-                          track_index, cp.returncode)
-
-                for line in cp.stderr.split("\n"):
-                    log.error("%s", line)
+    def start_deemphasis(
+            self, track_index: int) -> Optional[DeemphasisWriter]:
+        """
+        Return a writer for the de-emphasized copy of a track, or None if the
+        track is not pre-emphasized or de-emphasis is disabled.
+        """
+        if not self.config.deemphasis or not self.is_preemphasized(
+                track_index):
+            return None
+        return DeemphasisWriter(
+            self.work_path(f"track-{track_index:02d}.deemph.wav"))
+
+    def finish_deemphasis(
+            self, track_index: int,
+            writer: Optional[DeemphasisWriter]) -> None:
+        """
+        Convert and upload the de-emphasized copy of a track.
+        """
+        if writer is None:
+            return
 
-                raise RuntimeError("FLAC conversion failed")
+        writer.close()
+        log.info("Track %d is pre-emphasized; storing a de-emphasized copy",
+                 track_index)
+        self.convert_upload_flac(
+            track_index, wav_filename=writer.filename, variant="deemph")
 
-            log.info("Uploading %s to s3://%s/%s", output_filename,
-                     self.bucket.name, s3_key)
-            self.bucket.upload_file(output_filename, s3_key)
-            log.info("Upload of %s done", output_filename)
+    def get_loudness_tags(self, track_index: int) -> List[Tuple[str, str]]:
+        """
+        Return the ReplayGain tags for a track. This blocks until every track
+        on the disc has been read and the album loudness is known.
+        """
+        if self.album_loudness is None:
+            return []
 
-        self.executor.submit(task)
+        album = self._album_loudness_future.result()
+        track = self.track_loudness.get(track_index)
+        if track is None:
+            return []
+        return replaygain_tags(track, album)
+
+    @property
+    def comment_template(self) -> VorbisCommentTemplate:
+        """
+        The Vorbis comments shared by every track on this disc. This is built
+        once per release, after get_preferred_names() has run.
+        """
+        if self._comment_template is None:
+            self._comment_template = VorbisCommentTemplate(
+                get_release_tags(
+                    self.release, self.medium, self.disc_index,
+                    self.get_track_total(), self.disc_codes))
+        return self._comment_template
+
+    def get_track_total(self) -> int:
+        """
+        Return the number of tracks on this disc.
+        """
+        return (
+            len(self.tracks) if self.tracks
+            else len(self.disc_info.track_information) - 1)
+
+    def convert_upload_flac(
+            self, track_index: int, pcm: Optional[bytes] = None,
+            content_hash: Optional[str] = None,
+            wav_filename: Optional[str] = None,
+            variant: Optional[str] = None) -> None:
+        """
+        Convert a track to FLAC, adding tags, and upload it to S3.
+
+        The audio is taken from pcm if supplied, otherwise from the track's
+        WAV file (or wav_filename). A variant, such as "deemph", is stored
+        alongside the master as NN.<variant>.flac. Encoding runs on the
+        encoder pool's worker processes when libFLAC is available, falling
+        back to the flac binary. If content_hash is supplied, it is added to
+        the content index once the upload succeeds.
+
+        Supplied audio is written to the track's WAV file first, and the
+        encoder reads it from there: the pool's workers get a filename rather
+        than a pickled copy of the PCM, and with ReplayGain enabled a disc's
+        worth of PCM is not held in memory while encoding waits for the album
+        loudness.
+        """
+        suffix = f".{variant}.flac" if variant else ".flac"
+        if wav_filename is None:
+            wav_filename = self.work_path(f"track-{track_index:02d}.wav")
+        output_filename = self.work_path(f"track-{track_index:02d}{suffix}")
+        s3_key = (
+            f"{self.config.s3_prefix}{self.disc_id}/{track_index:02d}{suffix}")
+        track_tags = get_track_tags(
+            track_index, self.tracks.get(track_index, {}), self.disc_codes)
+
+        if pcm is not None:
+            write_wav(wav_filename, pcm)
+            pcm = None
+
+        if self.encode_pool is not None:
+            def encode(tags: List[Tuple[str, str]], level: int) -> None:
+                comments = self.comment_template.for_track(tags)
+                log.info("Converting track %d to FLAC in-process", track_index)
+                self.encode_pool.submit(
+                    encode_flac, wav_filename, output_filename, comments,
+                    level).result()
+        else:
+            def encode(tags: List[Tuple[str, str]], level: int) -> None:
+                cmd = ["flac", f"-{level}", f"--output-name={output_filename}"]
+                cmd.extend(
+                    f"--tag={name}={value}" for name, value in
+                    get_release_tags(
+                        self.release, self.medium, self.disc_index,
+                        self.get_track_total(), self.disc_codes) + tags)
+                cmd.append(wav_filename)
+
+                log.info("Converting track %d to FLAC: %s", track_index,
+                         " ".join(cmd))
+                cp = run(cmd, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+                if cp.returncode != 0:
+                    log.error("FLAC conversion of track %d failed: exit code %d",
+                              track_index, cp.returncode)
+
+                    for line in cp.stderr.decode("utf-8", "replace").split("\n"):
+                        log.error("%s", line)
+
+                    raise RuntimeError("FLAC conversion failed")
+
+        # The level is chosen when encoding starts (after any wait for the
+        # album loudness), so it reflects the encoder backlog at that point.
+        # A task waiting on the album loudness can't start encoding, so it
+        # only joins the policy's queue once the loudness is known.
+        policy = self.compression_policy
+        counted = policy is not None and self.album_loudness is None
+        audio_seconds = getsize(wav_filename) / (
+            BYTES_PER_FRAME_RAW * FRAMES_PER_SECOND)
+
+        def task():
+            nonlocal output_filename, self, s3_key, counted
+            try:
+                tags = track_tags + self.get_loudness_tags(track_index)
+                if policy is None:
+                    encode(tags, self.config.flac_compression_level)
+                else:
+                    if not counted:
+                        policy.submitted()
+                        counted = True
+                    level = policy.choose_level()
+                    started = monotonic()
+                    encode(tags, level)
+                    policy.record_encode(
+                        level, audio_seconds, monotonic() - started)
+            finally:
+                if policy is not None and counted:
+                    policy.finished()
+
+            log.info("Spooling %s for upload to s3://%s/%s", output_filename,
+                     self.bucket.name, s3_key)
+            future = self.spool.add_file(
+                s3_key, output_filename, content_type="audio/flac",
+                priority=UploadPriority.audio)
+            self.artifacts[s3_key] = "audio/flac"
+
+            if self.content_index is not None and content_hash is not None:
+                def index(done: "Future[str]") -> None:
+                    if done.exception() is None:
+                        self.content_index.add(
+                            content_hash, s3_key, self.disc_id, track_index)
+                future.add_done_callback(index)
+
+        if policy is not None and counted:
+            policy.submitted()
+        self._tasks.append(self.executor.submit(task))
+
+    def record_extraction(self, frames: int, seconds: float) -> None:
+        """
+        Report the time taken to extract (and hand off for encoding) frames
+        of audio to the compression policy. Imported rips are read from
+        memory, so their rate says nothing about keeping up with a drive.
+        """
+        if self.compression_policy is not None and not self.imported:
+            self.compression_policy.record_extraction(
+                frames / FRAMES_PER_SECOND, seconds)
 
     def rip_cd(self) -> None:
         """
-        Rip a CD, uploading it to S3.
+        Rip a CD, spooling its contents for upload to S3. This returns once
+        reading and encoding have finished; uploads continue in the
+        background.
+
+        If the local catalog shows the disc has already been ripped, nothing
+        is done. A disc with a track that could not be read or encoded is not
+        cataloged, so it is ripped again when next inserted.
         """
+        if (self.config.skip_duplicates and self.local_catalog is not None
+                and self.local_catalog.has_disc(self.disc_id)):
+            log.warning("Disc %s has already been ripped; skipping it",
+                        self.disc_id)
+            return
+
         self.ensure_bucket_exists()
 
-        tempdir = mkdtemp(prefix="cdrip-")
-        log.info("Executing in %s", tempdir)
-        old_wd = getcwd()
-        chdir(tempdir)
+        self.work_directory = self.spool.make_work_directory()
+        log.info("Executing in %s", self.work_directory)
+        failed = False
         try:
             self._rip_cd_in_tmpdir()
         finally:
-            log.info("Waiting for tasks to complete")
-            self.executor.shutdown()
-            chdir(old_wd)
+            # Release encodes waiting on the album loudness if ripping stopped
+            # early.
+            if not self._album_loudness_future.done():
+                self._album_loudness_future.set_exception(
+                    RuntimeError(f"Disc {self.disc_id} was not fully read"))
+
+            log.info("Waiting for encoding to complete")
+            for task in futures_wait(self._tasks).done:
+                if task.exception() is not None:
+                    failed = True
+                    log.error("Task for disc %s failed", self.disc_id,
+                              exc_info=task.exception())
+            self._tasks = []
+            rmtree(self.work_directory, ignore_errors=True)
+            if self.compression_policy is not None:
+                self.compression_policy.finish()
+
+        if failed:
+            log.error("Disc %s was not fully ripped; not cataloging it",
+                      self.disc_id)
+            return
+
+        self.update_catalog()
+
+    def update_catalog(self) -> None:
+        """
+        Record the disc, its release, tracks and stored objects in the
+        configured catalogs.
+        """
+        if self.catalog is None and self.local_catalog is None:
+            return
+
+        items = build_catalog_items(
+            self.disc_id, self.release, self.medium, self.disc_index,
+            self.tracks, self.disc_codes, self.artifacts)
+        log.info("Writing %d catalog items for disc %s", len(items),
+                 self.disc_id)
+        if self.local_catalog is not None:
+            self.local_catalog.put_items(items)
+        if self.catalog is not None:
+            self.catalog.put_items(items)
+
+    def close(self) -> None:
+        """
+        Release the session if this ripper created it, waiting for the spool
+        to drain to S3. If this is interrupted, the remaining uploads resume
+        on the next run.
+        """
+        if self._owns_session:
+            self.session.close()
 
     def _rip_cd_in_tmpdir(self) -> None:
         """
@@ -552,8 +2080,8 @@ class Ripper:
         directory be clean for our use.
         """
         # Get the MusicBrainz metadata
-        self.disc_metadata = mb.get_releases_by_discid(
-            self.disc_id, includes=MB_INCLUDES)
+        self.read_disc_codes()
+        self.get_disc_metadata()
         self.get_preferred_names()
 
         # Get album art for each release found. This modifies the release
@@ -561,11 +2089,39 @@ class Ripper:
         # before uploading that.
         self.get_album_art()
 
-        # Now upload the MusicBrainz metadata.
+        # Now upload the MusicBrainz metadata, along with the codes read from
+        # the disc itself.
+        self.disc_metadata["disc-codes"] = {
+            "mcn": self.disc_codes.mcn,
+            "isrcs": {
+                str(track): isrc
+                for track, isrc in self.disc_codes.isrcs.items()},
+        }
         self.put_object(
             ACL="private", Body=json.dumps(self.disc_metadata).encode("utf-8"),
             ContentType="application/json",
             Key=f"{self.config.s3_prefix}{self.disc_id}/musicbrainz.json")
+        self.metadata_cache.put(
+            self.disc_id, self.disc_metadata,
+            self.config.musicbrainz_country_preference, self.release_index)
+
+        # Record pregaps and index points before the drive is busy ripping.
+        self.detect_track_indices()
+
+        # Speed control state (and its back-off) lasts for the whole disc.
+        if self.speed_controller is not None:
+            self.speed_controller.start()
+
+        if self.config.continuous_extraction:
+            for tracks in contiguous_audio_runs(self.disc_info):
+                self.spool.wait_for_space()
+                started = monotonic()
+                self.rip_run_continuous(tracks)
+                self.record_extraction(
+                    tracks[-1].end_frame - tracks[0].start_frame,
+                    monotonic() - started)
+            self.finish_album_loudness()
+            return
 
         # Start ripping each track. Don't execute cdparanoia in parallel,
         # though.
@@ -573,7 +2129,171 @@ class Ripper:
             if track.track_type != TrackType.audio:
                 continue
 
+            self.spool.wait_for_space()
+            start_frame, end_frame = self.disc_info.get_track_frames(
+                track.track)
+            started = monotonic()
             self.rip_convert_track(track.track)
+            self.record_extraction(
+                end_frame - start_frame, monotonic() - started)
+
+        self.finish_album_loudness()
+
+    def finish_album_loudness(self) -> None:
+        """
+        Compute the album loudness once every track has been read, releasing
+        the encoders waiting for ReplayGain tags.
+        """
+        if self.album_loudness is not None:
+            album = self.album_loudness.finish()
+            log.info("Album integrated loudness %s LUFS, true peak %.4f",
+                     album.integrated, album.true_peak)
+            self._album_loudness_future.set_result(album)
+
+class DriveWatcher(Thread):
+    """
+    Watch a single drive, ripping each disc inserted into it.
+
+    The drive is opened non-blocking so it can be polled while empty. A disc
+    is ripped when the drive reports a disc present after having been empty,
+    open, or changed; it is then ejected so the operator only has to swap
+    discs.
+    """
+
+    def __init__(
+            self, session: RipperSession, cdrom_filename: str,
+            stop_event: Event, drive: Optional[CDROMDrive] = None) -> None:
+        super(DriveWatcher, self).__init__(
+            name=f"DriveWatcher-{basename(cdrom_filename)}", daemon=True)
+        self.session = session
+        self.cdrom_filename = cdrom_filename
+        self.stop_event = stop_event
+        self.drive = drive
+
+    def run(self) -> None:
+        poll_interval = self.session.config.poll_interval
+        armed = True
+        while not self.stop_event.is_set():
+            if self.drive is None:
+                try:
+                    self.drive = CDROMDrive.from_filename(
+                        self.cdrom_filename, nonblock=True)
+                except OSError as e:
+                    log.warning("Unable to open drive %s: %s",
+                                self.cdrom_filename, e)
+                    self.stop_event.wait(poll_interval * 10)
+                    continue
+
+                log.info("Watching drive %s", self.cdrom_filename)
+
+            try:
+                status = self.drive.get_status()
+                if self._media_changed():
+                    armed = True
+            except IOError:
+                log.warning("Lost drive %s", self.cdrom_filename,
+                            exc_info=True)
+                self.drive = None
+                self.stop_event.wait(poll_interval)
+                continue
+
+            if status != DriveStatus.ok:
+                armed = True
+            elif armed:
+                armed = False
+                self.rip_disc()
+
+            self.stop_event.wait(poll_interval)
+
+    def rip_disc(self) -> None:
+        """
+        Rip the disc in the drive, then eject it.
+        """
+        assert self.drive is not None
+        log.info("Disc inserted in %s", self.cdrom_filename)
+        try:
+            ripper = Ripper(
+                self.session.config, self.cdrom_filename,
+                session=self.session, drive=self.drive)
+            ripper.rip_cd()
+            log.info("Finished ripping disc %s in %s", ripper.disc_id,
+                     self.cdrom_filename)
+        except Exception: # pylint: disable=W0703
+            log.error("Ripping disc in %s failed", self.cdrom_filename,
+                      exc_info=True)
+
+        if self.session.config.eject:
+            try:
+                self.drive.eject()
+            except IOError:
+                log.warning("Unable to eject %s", self.cdrom_filename,
+                            exc_info=True)
+
+        # Our own eject registers as a media change; clear it so a disc that
+        # failed to eject isn't ripped again.
+        self._media_changed()
+
+    def _media_changed(self) -> bool:
+        assert self.drive is not None
+        try:
+            return self.drive.media_changed()
+        except NotImplementedError:
+            return False
+
+class RipperDaemon:
+    """
+    Rip discs from one or more drives until stopped, sharing a single
+    RipperSession so per-disc overhead is limited to extraction.
+    """
+
+    def __init__(self, session: RipperSession) -> None:
+        super(RipperDaemon, self).__init__()
+        self.session = session
+        self.stop_event = Event()
+
+        # Open and probe every drive at once rather than one at a time.
+        # Configured drives that can't be opened yet still get a watcher,
+        # which keeps retrying.
+        auto = list(session.config.drives) == [DRIVES_AUTO]
+        discovered = discover_drives(None if auto else session.config.drives)
+        drives = {result.filename: result.drive for result in discovered}
+        filenames = (
+            [result.filename for result in discovered] if auto
+            else session.config.drives)
+        if not filenames:
+            log.warning("No drives found")
+
+        self.watchers = [
+            DriveWatcher(
+                session, cdrom_filename, self.stop_event,
+                drive=drives.get(cdrom_filename))
+            for cdrom_filename in filenames]
+
+    def run(self) -> None:
+        """
+        Watch the drives until stop() is called or the process is
+        interrupted. Rips in progress are allowed to finish.
+        """
+        self.session.ensure_bucket_exists()
+        for watcher in self.watchers:
+            watcher.start()
+
+        try:
+            while not self.stop_event.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            log.info("Interrupted")
+            self.stop()
+
+        log.info("Waiting for rips in progress to finish")
+        for watcher in self.watchers:
+            watcher.join()
+
+    def stop(self) -> None:
+        """
+        Ask the daemon to stop.
+        """
+        self.stop_event.set()
 
 
 def main(args: List[str]) -> int:
@@ -588,23 +2308,51 @@ def main(args: List[str]) -> int:
     getLogger("s3transfer").setLevel(WARNING)
     config = RipperConfig()
     config_filename = None
+    daemon = False
+    import_catalog = False
+    import_rips = False
+    retag = False
+    transcode = False
+    verify = False
+    drives: List[str] = []
 
     try:
-        opts, args = getopt(args, "c:hp:r:", ["help"])
+        opts, args = getopt(
+            args, "c:dD:hp:r:",
+            ["config=", "daemon", "drive=", "help", "import", "import-catalog",
+             "profile=", "region=", "retag", "transcode", "verify"])
         for opt, val in opts:
             if opt in ("-h", "--help",):
                 usage(stdout)
                 return 0
             if opt in ("-c", "--config"):
                 config_filename = val
+            if opt in ("-d", "--daemon"):
+                daemon = True
+            if opt in ("-D", "--drive"):
+                drives.append(val)
+            if opt == "--import":
+                import_rips = True
+            if opt == "--import-catalog":
+                import_catalog = True
             if opt in ("-p", "--profile"):
                 config.aws_profile = val
             if opt in ("-r", "--region"):
                 config.aws_region = val
-        if args:
+            if opt == "--retag":
+                retag = True
+            if opt == "--transcode":
+                transcode = True
+            if opt == "--verify":
+                verify = True
+        if args and not (import_rips or retag or transcode):
             print(f"Unknown argument {args[0]}", file=stderr)
             usage()
             return 1
+        if import_rips and not args:
+            print("--import requires at least one directory", file=stderr)
+            usage()
+            return 1
     except GetoptError as e:
         print(str(e), file=stderr)
         usage()
@@ -615,11 +2363,301 @@ def main(args: List[str]) -> int:
     elif exists("ripper.conf"):
         config.parse_config("ripper.conf")
 
-    ripper = Ripper(config)
-    ripper.rip_cd()
+    if drives:
+        config.drives = drives
+
+    if import_catalog:
+        return import_local_catalog(config)
+
+    if verify:
+        return verify_collection(config)
+
+    if import_rips:
+        return import_rip_directories(config, args)
+
+    if retag:
+        return retag_collection(config, args)
+
+    if transcode:
+        return transcode_collection(config, args)
+
+    if daemon:
+        try:
+            session = RipperSession(config)
+        except SpoolLockedError as e:
+            print(str(e), file=stderr)
+            return 1
+        ripper_daemon = RipperDaemon(session)
+        signal(SIGTERM, lambda *_: ripper_daemon.stop())
+        try:
+            ripper_daemon.run()
+        finally:
+            # Anything not yet uploaded stays in the spool for the next run.
+            session.close(drain=False)
+        return 0
+
+    cdrom_filename = config.drives[0]
+    if cdrom_filename == DRIVES_AUTO:
+        ready = [
+            result.filename for result in discover_drives()
+            if result.status == DriveStatus.ok]
+        if not ready:
+            print("No drive with a disc found", file=stderr)
+            return 1
+        cdrom_filename = ready[0]
+
+    try:
+        ripper = Ripper(config, cdrom_filename)
+    except SpoolLockedError as e:
+        print(str(e), file=stderr)
+        return 1
+
+    try:
+        ripper.rip_cd()
+    finally:
+        ripper.close()
+
+    return 0
+
+def import_local_catalog(config: RipperConfig) -> int:
+    """
+    Bootstrap the local catalog from the discs already in the S3 bucket.
+    """
+    if not config.catalog_filename:
+        print("No local catalog configured ([catalog] sqlite)", file=stderr)
+        return 1
 
+    boto = config.get_boto_session()
+    if config.s3_bucket_name is None:
+        config.s3_bucket_name = RipperConfig.get_default_bucket_name(boto)
+
+    # One pooled connection per parallel GET.
+    s3_client = boto.client("s3", config=Config(
+        max_pool_connections=DEFAULT_IMPORT_WORKERS))
+    local_catalog = SQLiteCatalog(config.catalog_filename)
+    imported = local_catalog.import_bucket(
+        s3_client, config.s3_bucket_name, config.s3_prefix,
+        config.musicbrainz_country_preference,
+        max_workers=DEFAULT_IMPORT_WORKERS)
+    log.info("Imported %d discs into %s", imported, config.catalog_filename)
     return 0
 
+def import_rip_directories(config: RipperConfig, roots: List[str]) -> int:
+    """
+    Push existing rips through the ripping pipeline, several at a time.
+    """
+    try:
+        directories = find_rip_directories(roots)
+    except RipImportError as e:
+        print(str(e), file=stderr)
+        return 1
+
+    log.info("Importing %d rips with %d workers", len(directories),
+             config.import_workers)
+    try:
+        session = RipperSession(config)
+    except SpoolLockedError as e:
+        print(str(e), file=stderr)
+        return 1
+
+    def import_rip(directory: str) -> bool:
+        try:
+            ripper = Ripper(config, directory, session, load_rip(directory))
+            log.info("Importing %s as disc %s", directory, ripper.disc_id)
+            ripper.rip_cd()
+        except Exception: # pylint: disable=W0703
+            log.error("Unable to import %s", directory, exc_info=True)
+            return False
+        return True
+
+    try:
+        with ThreadPoolExecutor(
+                max_workers=config.import_workers,
+                thread_name_prefix="Import") as executor:
+            results = list(executor.map(import_rip, directories))
+    finally:
+        session.close()
+
+    failed = results.count(False)
+    log.info("Imported %d of %d rips", len(directories) - failed,
+             len(directories))
+    return 1 if failed else 0
+
+def verify_collection(config: RipperConfig) -> int:
+    """
+    Verify the objects in the S3 bucket against their recorded checksums.
+    """
+    boto = config.get_boto_session()
+    if config.s3_bucket_name is None:
+        config.s3_bucket_name = RipperConfig.get_default_bucket_name(boto)
+
+    # One pooled connection per worker.
+    s3_client = boto.client("s3", config=Config(
+        max_pool_connections=config.verify_workers))
+    state_filename = expanduser(config.verify_state_filename)
+    if dirname(state_filename):
+        makedirs(dirname(state_filename), exist_ok=True)
+    state = VerificationState(state_filename)
+    try:
+        verifier = CollectionVerifier(
+            s3_client, config.s3_bucket_name, config.s3_prefix, state,
+            max_workers=config.verify_workers)
+        report = verifier.run(
+            config.verify_max_age, config.verify_time_limit)
+    finally:
+        state.close()
+
+    for failure in report.failures:
+        print(f"{'ERROR' if failure.ok is None else 'FAILED'} "
+              f"s3://{config.s3_bucket_name}/{failure.key}: {failure.detail}",
+              file=stderr)
+    return 2 if report.failures else 0
+
+def retag_collection(config: RipperConfig, disc_ids: List[str]) -> int:
+    """
+    Rewrite the tags of the FLAC files in the S3 bucket (or those of the
+    specified discs) using the same tag mapping as ripping.
+    """
+    config.configure_musicbrainz()
+    boto = config.get_boto_session()
+    if config.s3_bucket_name is None:
+        config.s3_bucket_name = RipperConfig.get_default_bucket_name(boto)
+
+    # One pooled connection per worker.
+    s3_client = boto.client("s3", config=Config(
+        max_pool_connections=config.retag_workers))
+    metadata_cache: Optional[MetadataCache] = None
+    if config.metadata_cache_filename:
+        metadata_cache = MetadataCache(
+            config.metadata_cache_filename,
+            max_age=config.metadata_cache_max_age)
+
+    def get_disc_codes(metadata: Dict[str, Any]) -> DiscCodes:
+        codes = metadata.get("disc-codes", {})
+        return DiscCodes(
+            mcn=codes.get("mcn"),
+            isrcs={
+                int(track): isrc
+                for track, isrc in codes.get("isrcs", {}).items()})
+
+    def make_tags(
+            release: Mapping[str, Any], medium: Mapping[str, Any],
+            disc_codes: DiscCodes, track_numbers: List[int]) -> DiscTags:
+        tracks = {
+            int(track["number"]): track
+            for track in medium.get("track-list", [])
+            if str(track.get("number", "")).isdigit()}
+        return DiscTags(
+            release_tags=get_release_tags(
+                release, medium, int(medium.get("position", 1)),
+                len(tracks) or len(track_numbers), disc_codes),
+            track_tags={
+                track: get_track_tags(track, tracks.get(track, {}), disc_codes)
+                for track in track_numbers})
+
+    def get_tags(disc_id: str, track_numbers: List[int]) -> Optional[DiscTags]:
+        # Without a refresh, the cached index picks the release without
+        # fetching or parsing the whole response.
+        if metadata_cache is not None and not config.retag_refresh:
+            header = metadata_cache.get_header(disc_id)
+            selected = metadata_cache.select(
+                disc_id, config.musicbrainz_country_preference,
+                len(track_numbers))
+            if header is not None and selected is not None:
+                return make_tags(
+                    selected[0], selected[1], get_disc_codes(header),
+                    track_numbers)
+
+        key = f"{config.s3_prefix}{disc_id}/{METADATA_FILENAME}"
+        try:
+            stored = json.loads(s3_client.get_object(
+                Bucket=config.s3_bucket_name, Key=key)["Body"].read())
+        except s3_client.exceptions.NoSuchKey:
+            stored = {}
+
+        codes = stored.get("disc-codes", {})
+        disc_codes = get_disc_codes(stored)
+        metadata = stored
+
+        if config.retag_refresh:
+            stored_releases = {
+                release["id"]: release
+                for release in stored.get("disc", {}).get("release-list", [])}
+            metadata = fetch_disc_metadata(
+                disc_id, disc_codes, list(stored_releases))
+            metadata["disc-codes"] = codes
+
+            # Keep the album art found when the disc was ripped.
+            for release in metadata["disc"]["release-list"]:
+                images = stored_releases.get(release["id"], {}).get("images")
+                if images is not None:
+                    release["images"] = images
+
+            if metadata != stored:
+                s3_client.put_object(
+                    Bucket=config.s3_bucket_name, Key=key,
+                    Body=json.dumps(metadata).encode("utf-8"),
+                    ContentType="application/json")
+
+        releases = metadata.get("disc", {}).get("release-list", [])
+        index = ReleaseIndex.build(
+            releases, config.musicbrainz_country_preference)
+        if metadata_cache is not None and metadata:
+            metadata_cache.put(
+                disc_id, metadata, config.musicbrainz_country_preference,
+                index)
+
+        location = index.find(disc_id) or index.find_by_track_count(
+            len(track_numbers))
+        if location is None:
+            return None
+
+        release = releases[location[0]]
+        return make_tags(
+            release, release["medium-list"][location[1]], disc_codes,
+            track_numbers)
+
+    retagger = Retagger(
+        s3_client, config.s3_bucket_name, config.s3_prefix, get_tags,
+        max_workers=config.retag_workers)
+    try:
+        report = retagger.run(disc_ids or None)
+    finally:
+        if metadata_cache is not None:
+            metadata_cache.close()
+
+    for failure in report.failures:
+        print(f"FAILED s3://{config.s3_bucket_name}/{failure.key}: "
+              f"{failure.detail}", file=stderr)
+    return 2 if report.failures else 0
+
+def transcode_collection(config: RipperConfig, disc_ids: List[str]) -> int:
+    """
+    Make lossy derivatives of the FLAC files in the S3 bucket (or those of the
+    specified discs).
+    """
+    if not transcoder_available():
+        print("ffmpeg is required for transcoding", file=stderr)
+        return 1
+
+    boto = config.get_boto_session()
+    if config.s3_bucket_name is None:
+        config.s3_bucket_name = RipperConfig.get_default_bucket_name(boto)
+
+    # One pooled connection per worker, plus one for its input stream.
+    s3_client = boto.client("s3", config=Config(
+        max_pool_connections=2 * config.transcode_workers))
+    transcoder = Transcoder(
+        s3_client, config.s3_bucket_name, config.s3_prefix,
+        [DERIVATIVE_FORMATS[fmt] for fmt in config.transcode_formats],
+        max_workers=config.transcode_workers)
+    report = transcoder.run(disc_ids or None)
+
+    for failure in report.failures:
+        print(f"FAILED s3://{config.s3_bucket_name}/{failure.key}: "
+              f"{failure.detail}", file=stderr)
+    return 2 if report.failures else 0
+
 def usage(fd=stderr):
     """
     Print usage information to the specified file handle.
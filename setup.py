@@ -30,6 +30,7 @@ setup(
     packages=['kanga.cdaudio'],
     python_requires='>=3.6',
     install_requires=["musicbrainzngs", "requests"],
+    extras_require={"loudness": ["numpy"]},
     setup_requires=["nose>=1.0"],
     tests_require=["coverage>=4.0", "nose>=1.0"],
 )
\ No newline at end of file
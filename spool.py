@@ -0,0 +1,497 @@
+"""\
+Crash-safe local spool for ripped artifacts awaiting upload.
+
+Finished artifacts (FLAC files, metadata, logs, art) are committed to the
+spool directory before being handed to the S3Uploader, so ripping never waits
+on the network. A commit writes the data to a temporary file, fsyncs it,
+renames it into place and then appends an "add" record to the journal; the
+journal record is the commit point. Once S3 confirms the upload a "done"
+record is appended and the spooled file is deleted.
+
+On startup the journal is replayed: anything added but not done is queued for
+upload again, and stale working directories and uncommitted files left by a
+crash are removed. Only one process may use a spool directory at a time; it
+holds an exclusive lock on the directory's lock file while the spool is open,
+so a second process fails rather than treating the first one's files as
+debris.
+
+The spool also enforces a high-water mark on the bytes it holds and a floor on
+the free space left on its filesystem, which it shares with the ripper's
+temporary files and anything else on the host. Rippers call wait_for_space()
+before reading a track; it blocks while the spool is above the mark or the
+filesystem below the floor, pausing extraction until uploads catch up.
+"""
+
+from concurrent.futures import Future
+from fcntl import LOCK_EX, LOCK_NB, flock
+from hashlib import sha256
+import json
+from logging import getLogger
+import os
+from os.path import basename, exists, isdir, join
+from shutil import move, rmtree
+from tempfile import mkdtemp
+from threading import Condition, Lock, Timer
+from time import monotonic
+from typing import Any, Dict, List, Optional, Set
+from uuid import uuid4
+
+from uploader import S3Uploader, UploadPriority
+
+# pylint: disable=C0103,R0902,R0913
+
+JOURNAL_FILENAME = "journal"
+LOCK_FILENAME = "lock"
+DATA_DIRECTORY = "data"
+WORK_DIRECTORY = "work"
+TEMP_SUFFIX = ".tmp"
+
+# Bytes read at a time when hashing a spooled file.
+HASH_BLOCK_BYTES = 1024 * 1024
+
+# Object metadata key holding the SHA-256 of the object's contents, checked
+# by the collection verifier.
+SHA256_METADATA_KEY = "sha256"
+
+# How long to wait before re-queueing an upload that exhausted its attempts.
+DEFAULT_RETRY_INTERVAL = 300.0
+
+# Times an upload is re-queued before it is left for the next run.
+DEFAULT_MAX_RETRIES = 2
+
+# Free space to keep on the spool's filesystem, and how often to re-check it
+# while waiting; other processes can free (or use) space without notifying us.
+DEFAULT_MIN_FREE_BYTES = 1 << 30
+FREE_SPACE_POLL_INTERVAL = 5.0
+
+log = getLogger(__name__)
+
+class SpoolLockedError(Exception):
+    """
+    The spool directory is in use by another process.
+    """
+
+class SpoolEntry:
+    """
+    A committed artifact awaiting upload.
+    """
+    __slots__ = (
+        "entry_id", "key", "content_type", "acl", "priority", "size",
+        "sha256")
+
+    def __init__(
+            self, entry_id: str, key: str, content_type: Optional[str],
+            acl: Optional[str], priority: UploadPriority, size: int,
+            sha256: Optional[str] = None) -> None:
+        super(SpoolEntry, self).__init__()
+        self.entry_id = entry_id
+        self.key = key
+        self.content_type = content_type
+        self.acl = acl
+        self.priority = priority
+        self.size = size
+        self.sha256 = sha256
+
+    def to_json(self) -> Dict[str, Any]:
+        """
+        Return the journal "add" record for this entry.
+        """
+        return {
+            "op": "add", "id": self.entry_id, "key": self.key,
+            "content_type": self.content_type, "acl": self.acl,
+            "priority": int(self.priority), "size": self.size,
+            "sha256": self.sha256}
+
+    @staticmethod
+    def from_json(data: Dict[str, Any]) -> "SpoolEntry":
+        """
+        Create a SpoolEntry from a journal "add" record.
+        """
+        return SpoolEntry(
+            entry_id=data["id"], key=data["key"],
+            content_type=data.get("content_type"), acl=data.get("acl"),
+            priority=UploadPriority(data.get("priority", 0)),
+            size=int(data.get("size", 0)), sha256=data.get("sha256"))
+
+class Spool:
+    """
+    A journaled directory of artifacts drained to S3 in the background.
+
+    An upload that exhausts the uploader's attempts is re-queued every
+    retry_interval seconds, up to max_retries times. After that it is left in
+    the spool, and its future fails, so drain() can return; it is retried
+    when the spool is next opened.
+    """
+    def __init__(
+            self, directory: str, uploader: S3Uploader,
+            high_water_bytes: Optional[int] = None,
+            retry_interval: float = DEFAULT_RETRY_INTERVAL,
+            max_retries: int = DEFAULT_MAX_RETRIES,
+            min_free_bytes: Optional[int] = DEFAULT_MIN_FREE_BYTES) -> None:
+        super(Spool, self).__init__()
+        self.directory = directory
+        self.data_directory = join(directory, DATA_DIRECTORY)
+        self.work_directory = join(directory, WORK_DIRECTORY)
+        self.journal_filename = join(directory, JOURNAL_FILENAME)
+        self.uploader = uploader
+        self.high_water_bytes = high_water_bytes
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+        self.min_free_bytes = min_free_bytes
+
+        self._journal_lock = Lock()
+        self._condition = Condition()
+        self._entries: Dict[str, SpoolEntry] = {}
+        self._futures: Dict[str, "Future[str]"] = {}
+        self._timers: Set[Timer] = set()
+        self._retries: Dict[str, int] = {}
+        self._deferred: Set[str] = set()
+        self._bytes = 0
+        self._deferred_bytes = 0
+        self._closed = False
+
+        os.makedirs(self.data_directory, exist_ok=True)
+        os.makedirs(self.work_directory, exist_ok=True)
+
+        # Held until close(); the lock is released if the process dies.
+        self._lock_fd = os.open(
+            join(directory, LOCK_FILENAME), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            flock(self._lock_fd, LOCK_EX | LOCK_NB)
+        except BlockingIOError:
+            os.close(self._lock_fd)
+            raise SpoolLockedError(
+                f"Spool {directory} is in use by another process; configure "
+                f"a separate [spool] directory for each ripper") from None
+
+        self._recover()
+
+    @property
+    def pending_bytes(self) -> int:
+        """
+        The number of bytes held in the spool awaiting upload.
+        """
+        with self._condition:
+            return self._bytes
+
+    @property
+    def pending_count(self) -> int:
+        """
+        The number of artifacts awaiting upload.
+        """
+        with self._condition:
+            return len(self._entries)
+
+    def make_work_directory(self, prefix: str = "cdrip-") -> str:
+        """
+        Create a working directory on the spool's filesystem, so artifacts
+        written there can be committed with a rename. Working directories
+        left behind by a crash are removed the next time the spool is opened.
+        """
+        return mkdtemp(prefix=prefix, dir=self.work_directory)
+
+    def add_bytes(
+            self, key: str, body: bytes, content_type: Optional[str] = None,
+            acl: Optional[str] = "private",
+            priority: UploadPriority = UploadPriority.metadata
+    ) -> "Future[str]":
+        """
+        Commit an in-memory object to the spool and queue it for upload.
+        """
+        entry_id = uuid4().hex
+        temp_filename = self._data_filename(entry_id) + TEMP_SUFFIX
+        with open(temp_filename, "wb") as fd:
+            fd.write(body)
+            fd.flush()
+            os.fsync(fd.fileno())
+
+        return self._commit(
+            temp_filename, SpoolEntry(
+                entry_id, key, content_type, acl, priority, len(body),
+                sha256(body).hexdigest()))
+
+    def add_file(
+            self, key: str, filename: str, content_type: Optional[str] = None,
+            acl: Optional[str] = "private",
+            priority: UploadPriority = UploadPriority.audio
+    ) -> "Future[str]":
+        """
+        Move a finished file into the spool and queue it for upload. The file
+        should be in a directory from make_work_directory() so the move is a
+        rename.
+        """
+        entry_id = uuid4().hex
+        temp_filename = self._data_filename(entry_id) + TEMP_SUFFIX
+        move(filename, temp_filename)
+        hasher = sha256()
+        with open(temp_filename, "rb") as fd:
+            # The file was just written, so this reads from the page cache.
+            for block in iter(lambda: fd.read(HASH_BLOCK_BYTES), b""):
+                hasher.update(block)
+            os.fsync(fd.fileno())
+
+        return self._commit(
+            temp_filename, SpoolEntry(
+                entry_id, key, content_type, acl, priority,
+                os.stat(temp_filename).st_size, hasher.hexdigest()))
+
+    def wait_for_space(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block while the spool holds more than the high-water mark in uploads
+        still being attempted, or its filesystem has less than min_free_bytes
+        available. Returns False if the timeout expired first.
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._condition:
+            shortage = self._space_shortage()
+            if shortage is None:
+                return True
+
+            log.warning("%s; pausing until uploads catch up", shortage)
+            while not self._closed and self._space_shortage() is not None:
+                interval = FREE_SPACE_POLL_INTERVAL
+                if deadline is not None:
+                    interval = min(interval, deadline - monotonic())
+                    if interval <= 0:
+                        return False
+                self._condition.wait(interval)
+
+            return True
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Block until every spooled artifact has been uploaded or left for the
+        next run after exhausting its retries. Returns False if the timeout
+        expired first.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self._closed or self._deferred.issuperset(
+                    self._entries), timeout)
+
+    def close(self) -> None:
+        """
+        Stop re-queueing failed uploads and release the spool directory.
+        Anything not yet uploaded stays in the spool and is picked up when it
+        is next opened.
+        """
+        with self._condition:
+            if self._closed:
+                return
+            self._closed = True
+            timers = list(self._timers)
+            self._timers.clear()
+            self._condition.notify_all()
+
+        for timer in timers:
+            timer.cancel()
+        os.close(self._lock_fd)
+
+    def _space_shortage(self) -> Optional[str]:
+        """
+        Describe why the spool is out of space, or return None if it isn't.
+        Must be called with the condition held.
+        """
+        uploading = self._bytes - self._deferred_bytes
+        if (self.high_water_bytes is not None and
+                uploading > self.high_water_bytes):
+            return "Spool holds %d bytes (high-water mark %d)" % (
+                uploading, self.high_water_bytes)
+
+        if self.min_free_bytes is not None:
+            stat = os.statvfs(self.directory)
+            free = stat.f_bavail * stat.f_frsize
+            if free < self.min_free_bytes:
+                return "Spool filesystem has %d bytes free (minimum %d)" % (
+                    free, self.min_free_bytes)
+
+        return None
+
+    def _data_filename(self, entry_id: str) -> str:
+        return join(self.data_directory, entry_id)
+
+    def _commit(self, temp_filename: str, entry: SpoolEntry) -> "Future[str]":
+        os.replace(temp_filename, self._data_filename(entry.entry_id))
+        _fsync_directory(self.data_directory)
+
+        # Register the entry under the journal lock so a concurrent upload
+        # completion can't truncate the journal between the two.
+        future: "Future[str]" = Future()
+        with self._journal_lock:
+            self._write_journal(entry.to_json())
+            with self._condition:
+                self._entries[entry.entry_id] = entry
+                self._futures[entry.entry_id] = future
+                self._bytes += entry.size
+
+        log.debug("Spooled %s for s3://%s/%s (%d bytes)", entry.entry_id,
+                  self.uploader.bucket_name, entry.key, entry.size)
+        self._submit(entry)
+        return future
+
+    def _submit(self, entry: SpoolEntry) -> None:
+        with self._condition:
+            if self._closed:
+                return
+
+        upload = self.uploader.upload(
+            entry.key, self._data_filename(entry.entry_id),
+            priority=entry.priority, content_type=entry.content_type,
+            acl=entry.acl, metadata=(
+                {SHA256_METADATA_KEY: entry.sha256} if entry.sha256 else None))
+        upload.add_done_callback(
+            lambda done: self._upload_done(entry, done))
+
+    def _upload_done(self, entry: SpoolEntry, done: "Future[str]") -> None:
+        if done.exception() is not None:
+            with self._condition:
+                if self._closed:
+                    return
+
+                retries = self._retries.get(entry.entry_id, 0)
+                timer: Optional[Timer] = None
+                future = None
+                if retries < self.max_retries:
+                    log.warning("Upload of spooled s3://%s/%s failed; "
+                                "retrying in %.0fs", self.uploader.bucket_name,
+                                entry.key, self.retry_interval)
+                    self._retries[entry.entry_id] = retries + 1
+                    timer = Timer(self.retry_interval, self._retry, (entry,))
+                    timer.daemon = True
+                    self._timers.add(timer)
+                else:
+                    log.error("Upload of spooled s3://%s/%s failed %d times; "
+                              "leaving it for the next run",
+                              self.uploader.bucket_name, entry.key,
+                              retries + 1)
+                    self._deferred.add(entry.entry_id)
+                    self._deferred_bytes += entry.size
+                    future = self._futures.pop(entry.entry_id, None)
+                    self._condition.notify_all()
+
+            if timer is not None:
+                timer.start()
+            if future is not None:
+                future.set_exception(done.exception())
+            return
+
+        with self._journal_lock:
+            self._write_journal({"op": "done", "id": entry.entry_id})
+            try:
+                os.unlink(self._data_filename(entry.entry_id))
+            except FileNotFoundError:
+                pass
+
+            with self._condition:
+                self._entries.pop(entry.entry_id, None)
+                self._retries.pop(entry.entry_id, None)
+                future = self._futures.pop(entry.entry_id, None)
+                self._bytes -= entry.size
+                empty = not self._entries
+                self._condition.notify_all()
+
+            if empty:
+                # Keep the journal from growing without bound.
+                with open(self.journal_filename, "w") as fd:
+                    fd.flush()
+                    os.fsync(fd.fileno())
+
+        if future is not None:
+            future.set_result(entry.key)
+
+    def _retry(self, entry: SpoolEntry) -> None:
+        with self._condition:
+            self._timers = {
+                timer for timer in self._timers if timer.is_alive()}
+        self._submit(entry)
+
+    def _write_journal(self, record: Dict[str, Any]) -> None:
+        """
+        Append a record to the journal. The caller must hold the journal lock.
+        """
+        with open(self.journal_filename, "a") as fd:
+            fd.write(json.dumps(record, sort_keys=True) + "\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+
+    def _read_journal(self) -> Dict[str, SpoolEntry]:
+        entries: Dict[str, SpoolEntry] = {}
+        if not exists(self.journal_filename):
+            return entries
+
+        with open(self.journal_filename, "r") as fd:
+            for line_number, line in enumerate(fd, 1):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # A torn write at the end of the journal from a crash.
+                    log.warning("Ignoring corrupt journal record at %s:%d",
+                                self.journal_filename, line_number)
+                    continue
+
+                if record.get("op") == "add":
+                    entry = SpoolEntry.from_json(record)
+                    entries[entry.entry_id] = entry
+                elif record.get("op") == "done":
+                    entries.pop(record.get("id"), None)
+
+        return entries
+
+    def _recover(self) -> None:
+        """
+        Replay the journal, compact it, remove crash debris and re-queue
+        pending uploads.
+        """
+        for name in os.listdir(self.work_directory):
+            path = join(self.work_directory, name)
+            log.info("Removing stale working directory %s", path)
+            if isdir(path):
+                rmtree(path, ignore_errors=True)
+            else:
+                os.unlink(path)
+
+        entries = self._read_journal()
+        for entry_id in list(entries):
+            if not exists(self._data_filename(entry_id)):
+                log.warning("Spooled file for s3://%s/%s is missing; dropping",
+                            self.uploader.bucket_name, entries[entry_id].key)
+                del entries[entry_id]
+
+        # Anything in the data directory without a journal record was never
+        # committed.
+        for name in os.listdir(self.data_directory):
+            if basename(name) not in entries:
+                log.info("Removing uncommitted spool file %s", name)
+                os.unlink(join(self.data_directory, name))
+
+        records: List[Dict[str, Any]] = [
+            entry.to_json() for entry in entries.values()]
+        temp_filename = self.journal_filename + TEMP_SUFFIX
+        with open(temp_filename, "w") as fd:
+            for record in records:
+                fd.write(json.dumps(record, sort_keys=True) + "\n")
+            fd.flush()
+            os.fsync(fd.fileno())
+        os.replace(temp_filename, self.journal_filename)
+        _fsync_directory(self.directory)
+
+        if entries:
+            log.info("Resuming %d spooled uploads from a previous run",
+                     len(entries))
+
+        for entry in entries.values():
+            with self._condition:
+                self._entries[entry.entry_id] = entry
+                self._futures[entry.entry_id] = Future()
+                self._bytes += entry.size
+            self._submit(entry)
+
+def _fsync_directory(directory: str) -> None:
+    """
+    Flush a directory so a rename within it survives a crash.
+    """
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
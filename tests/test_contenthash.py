@@ -0,0 +1,59 @@
+"""
+Tests for offset-normalized content hashing.
+"""
+from random import Random
+from unittest import TestCase
+
+from kanga.cdaudio.contenthash import MAX_OFFSET_SAMPLES, PCMContentHasher
+from kanga.cdaudio.flac import BYTES_PER_SAMPLE_FRAME
+
+SAMPLE_RATE = 44100
+SECOND = SAMPLE_RATE * BYTES_PER_SAMPLE_FRAME
+
+def noise(seconds: float, seed: int) -> bytes:
+    size = int(seconds * SAMPLE_RATE) * BYTES_PER_SAMPLE_FRAME
+    return Random(seed).getrandbits(size * 8).to_bytes(size, "little")
+
+def content_hash(pcm: bytes, chunk_size: int = 65536) -> str:
+    hasher = PCMContentHasher()
+    for start in range(0, len(pcm), chunk_size):
+        hasher.update(pcm[start:start + chunk_size])
+    return hasher.hexdigest()
+
+class TestPCMContentHasher(TestCase):
+    """
+    Shifted rips of a track match; edited versions of it do not.
+    """
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.previous = noise(1, 1)
+        cls.track = noise(40, 2)
+        cls.following = noise(1, 3)
+        cls.original = content_hash(cls.track)
+
+    def test_read_offset(self) -> None:
+        # A rip shifted by a drive's read offset, with audio from the
+        # neighbouring track at one end.
+        for shift in (-700, -6, 30, 667, MAX_OFFSET_SAMPLES // 2):
+            shift_bytes = shift * BYTES_PER_SAMPLE_FRAME
+            disc = self.previous + self.track + self.following
+            start = len(self.previous) + shift_bytes
+            shifted = disc[start:start + len(self.track)]
+            self.assertEqual(content_hash(shifted), self.original, shift)
+
+    def test_chunking(self) -> None:
+        self.assertEqual(
+            content_hash(self.track, 2352 * 27), self.original)
+
+    def test_silenced_ending(self) -> None:
+        edited = self.track[:-10 * SECOND] + bytes(10 * SECOND)
+        self.assertNotEqual(content_hash(edited), self.original)
+
+    def test_different_intro(self) -> None:
+        edited = noise(5, 4) + self.track[5 * SECOND:]
+        self.assertNotEqual(content_hash(edited), self.original)
+
+    def test_zeroed_section(self) -> None:
+        edited = (self.track[:SECOND] + bytes(14 * SECOND) +
+                  self.track[15 * SECOND:])
+        self.assertNotEqual(content_hash(edited), self.original)
@@ -0,0 +1,64 @@
+"""
+Tests for splitting a continuous read into tracks.
+"""
+from random import Random
+from typing import Dict, List
+from unittest import TestCase
+
+from kanga.cdaudio.cd import BYTES_PER_FRAME_RAW
+from kanga.cdaudio.continuous import TrackSpan, TrackSplitter
+from kanga.cdaudio.flac import BYTES_PER_SAMPLE_FRAME
+
+TRACKS = [TrackSpan(1, 10, 40), TrackSpan(2, 40, 45), TrackSpan(3, 45, 90)]
+
+def read(splitter: TrackSplitter, seed: int) -> bytes:
+    size = (splitter.read_end - splitter.read_start) * BYTES_PER_FRAME_RAW
+    return Random(seed).getrandbits(size * 8).to_bytes(size, "little")
+
+def chunked(data: bytes, frames: int) -> List[bytes]:
+    size = frames * BYTES_PER_FRAME_RAW
+    return [data[start:start + size] for start in range(0, len(data), size)]
+
+class TestTrackSplitter(TestCase):
+    """
+    Tracks are cut at the offset-shifted boundaries, whole or in pieces.
+    """
+    def test_split(self) -> None:
+        for offset in (-700, 0, 30):
+            splitter = TrackSplitter(TRACKS, offset)
+            data = read(splitter, offset)
+            tracks = list(splitter.split(chunked(data, 7)))
+
+            origin = (splitter.read_start * BYTES_PER_FRAME_RAW -
+                      offset * BYTES_PER_SAMPLE_FRAME)
+            self.assertEqual([track for track, _ in tracks], [1, 2, 3])
+            for (_, pcm), span in zip(tracks, TRACKS):
+                begin = span.start_frame * BYTES_PER_FRAME_RAW - origin
+                end = span.end_frame * BYTES_PER_FRAME_RAW - origin
+                expected = data[max(0, begin):end]
+                if begin < 0:
+                    # Before the first frame read; filled with silence.
+                    expected = bytes(-begin) + expected
+                expected += bytes(end - begin - len(expected))
+                self.assertEqual(pcm, expected)
+
+    def test_split_pieces(self) -> None:
+        for offset in (-700, 0, 30):
+            for frames in (1, 7, 100):
+                splitter = TrackSplitter(TRACKS, offset)
+                data = read(splitter, offset)
+                chunks = chunked(data, frames)
+
+                pieces: Dict[int, List[bytes]] = {}
+                completed = []
+                for track, pcm, complete in TrackSplitter(
+                        TRACKS, offset).split_pieces(chunks):
+                    self.assertNotIn(track, completed)
+                    pieces.setdefault(track, []).append(pcm)
+                    if complete:
+                        completed.append(track)
+
+                self.assertEqual(completed, [1, 2, 3])
+                self.assertEqual(
+                    [(track, b"".join(pcm)) for track, pcm in pieces.items()],
+                    list(splitter.split(chunks)))
@@ -0,0 +1,67 @@
+"""
+Tests for cue sheet parsing and layout.
+"""
+from unittest import TestCase
+
+from kanga.cdaudio.cd import (
+    LEADOUT_TRACK, DiscInformation, TrackFlags, TrackIndex, TrackInformation,
+    TrackType)
+from kanga.cdaudio.cue import (
+    CueError, cue_layout, format_cue_sheet, parse_cue_sheet)
+
+def audio_track(track: int, start_frame: int) -> TrackInformation:
+    return TrackInformation(
+        track=track, track_type=TrackType.audio, flags=TrackFlags(0),
+        start_frame=start_frame)
+
+class TestCueRoundTrip(TestCase):
+    """
+    A sheet written by format_cue_sheet() lays out as the disc it describes.
+    """
+    def setUp(self) -> None:
+        self.disc_information = DiscInformation(
+            first_track=1, last_track=3, track_information=(
+                audio_track(1, 0), audio_track(2, 1000),
+                audio_track(3, 2500),
+                TrackInformation(
+                    track=LEADOUT_TRACK, track_type=TrackType.leadout,
+                    flags=TrackFlags(0), start_frame=4000)))
+        # Track 2 has a 150-frame pregap and track 3 an index 2.
+        self.track_indices = {
+            TrackIndex(1, 1): 0,
+            TrackIndex(2, 0): 850,
+            TrackIndex(2, 1): 1000,
+            TrackIndex(3, 1): 2500,
+            TrackIndex(3, 2): 3000,
+        }
+        # Each file runs from its track's index 1 to the next track's.
+        self.file_frames = {"01.flac": 1000, "02.flac": 1500, "03.flac": 1500}
+
+    def test_round_trip(self) -> None:
+        text = format_cue_sheet(self.disc_information, self.track_indices)
+        sheet = parse_cue_sheet(text)
+
+        # Track 2's index 0 is at the end of 01.flac.
+        self.assertEqual([track.track for track in sheet.tracks], [1, 2, 3])
+        track_2 = sheet.tracks[1]
+        self.assertEqual(track_2.indices, {0: 850, 1: 0})
+        self.assertEqual(track_2.index_files, {0: 0, 1: 1})
+
+        layout = cue_layout(sheet, self.file_frames)
+        self.assertEqual(layout.disc_information, self.disc_information)
+        self.assertEqual(layout.track_indices, self.track_indices)
+        self.assertEqual(
+            layout.segments,
+            [("01.flac", 0, 1000), ("02.flac", 0, 1500),
+             ("03.flac", 0, 1500)])
+
+    def test_missing_index_1(self) -> None:
+        text = (
+            'FILE "01.wav" WAVE\n'
+            "  TRACK 01 AUDIO\n"
+            "    INDEX 01 00:00:00\n"
+            "  TRACK 02 AUDIO\n"
+            "    INDEX 00 00:10:00\n"
+            'FILE "02.wav" WAVE\n')
+        with self.assertRaises(CueError):
+            parse_cue_sheet(text)
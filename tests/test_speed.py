@@ -0,0 +1,94 @@
+"""
+Tests for adaptive read-speed control against a simulated drive.
+"""
+from random import Random
+from typing import Set
+from unittest import TestCase
+
+from kanga.cdaudio.cd import BYTES_PER_FRAME_RAW, FRAMES_PER_SECOND
+from kanga.cdaudio.extract import SecureExtractor
+from kanga.cdaudio.image import ImageCDROMDrive
+from kanga.cdaudio.speed import (
+    MIN_HISTORY_FRAMES, SpeedController, SpeedHistory)
+
+FRAMES = 1200
+
+# The simulated drive misreads every 20th frame above this speed, the first
+# time it reads it.
+RELIABLE_SPEED = 16
+
+class MarginalDisc:
+    """
+    An error model for a disc that reads cleanly only at lower speeds.
+    """
+    def __init__(self) -> None:
+        super(MarginalDisc, self).__init__()
+        self.misread: Set[int] = set()
+
+    def __call__(self, frame: int, speed: int) -> bool:
+        if speed <= RELIABLE_SPEED or frame % 20 or frame in self.misread:
+            return False
+        self.misread.add(frame)
+        return True
+
+class TestSpeedController(TestCase):
+    """
+    The controller backs off when errors cluster and speeds up when reads
+    are clean, driving the image drive's speed and clock.
+    """
+    def setUp(self) -> None:
+        size = FRAMES * BYTES_PER_FRAME_RAW
+        self.image = Random(1).getrandbits(size * 8).to_bytes(size, "little")
+        self.drive = ImageCDROMDrive(self.image)
+
+    def extract(self, controller: SpeedController) -> SecureExtractor:
+        extractor = SecureExtractor(
+            self.drive, defeat_drive_cache=False,
+            speed_controller=controller, clock=lambda: self.drive.elapsed)
+        controller.start()
+        self.assertEqual(extractor.extract_bytes(0, FRAMES), self.image)
+        return extractor
+
+    def test_backs_off_on_errors(self) -> None:
+        self.drive.error_model = MarginalDisc()
+        controller = SpeedController(self.drive, promote_after=1000)
+        self.assertGreater(controller.speed, RELIABLE_SPEED)
+
+        extractor = self.extract(controller)
+        self.assertEqual(controller.speed, RELIABLE_SPEED)
+        self.assertEqual(self.drive.speed, RELIABLE_SPEED)
+        self.assertFalse(extractor.stats.unrecovered_frames)
+
+        # Errors were recorded at the faster speeds, and the time spent at
+        # each speed comes from the drive's clock.
+        history = controller.history
+        fast = history.get(controller.drive_key, 24)
+        self.assertGreater(fast.error_frames, 0)
+        reliable = history.get(controller.drive_key, RELIABLE_SPEED)
+        self.assertEqual(reliable.error_frames, 0)
+        self.assertAlmostEqual(
+            reliable.seconds,
+            reliable.frames / (FRAMES_PER_SECOND * RELIABLE_SPEED))
+
+    def test_isolated_error_keeps_speed(self) -> None:
+        self.drive.inject_error(600, reads=1)
+        controller = SpeedController(
+            self.drive, promote_after=1000, initial_speed=24)
+        self.extract(controller)
+        self.assertEqual(controller.speed, 24)
+        self.assertEqual(self.drive.speed, 24)
+
+    def test_promotes_up_to_unreliable_speed(self) -> None:
+        # Clean reads raise the speed, but not to one the history shows
+        # misreading this drive.
+        history = SpeedHistory()
+        history.record(
+            str(self.drive.get_identity()), 32, MIN_HISTORY_FRAMES, 100, 0,
+            MIN_HISTORY_FRAMES / (FRAMES_PER_SECOND * 32))
+        controller = SpeedController(
+            self.drive, history=history, promote_after=4, initial_speed=16)
+        self.assertEqual(controller.speed, 16)
+
+        self.extract(controller)
+        self.assertEqual(controller.speed, 24)
+        self.assertEqual(self.drive.speed, 24)
@@ -0,0 +1,361 @@
+"""\
+Batch transcoding of the FLAC masters stored in S3 into lossy derivatives.
+
+Transcoder turns each NN.flac under <prefix><disc id>/ into NN.m4a (AAC)
+and/or NN.mp3 alongside it, without re-ripping the disc or keeping a local
+copy of either file. For each master, a worker streams the GET response into
+an ffmpeg process, which decodes and encodes it, and uploads ffmpeg's output
+as a multipart upload part by part as it is produced. Each worker holds at
+most one part of output in memory, and each ffmpeg process is limited to one
+thread, so running one worker per core uses every core with bounded memory.
+
+Each derivative records the ETag of the master it was made from in its
+source-etag metadata. This is its completion marker: multipart uploads only
+become visible once complete, so a derivative whose marker matches its
+master's current ETag is skipped, and an interrupted run can simply be
+started again. Derivatives of masters that have since changed (e.g. been
+retagged) are made again.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+from os import cpu_count
+from re import compile as re_compile
+from shutil import which
+from subprocess import Popen, PIPE
+from tempfile import TemporaryFile
+from threading import Thread
+from time import monotonic
+from typing import (
+    IO, Any, Callable, Dict, Iterable, List, NamedTuple, Optional, Sequence,
+    Set, Tuple)
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from uploader import DEFAULT_MULTIPART_CHUNKSIZE
+
+# pylint: disable=C0103,R0902,R0913,R0914
+
+DEFAULT_TRANSCODE_WORKERS = cpu_count() or 1
+
+# Bytes read from a GET response or ffmpeg's output at a time.
+STREAM_BLOCK_BYTES = 1024 * 1024
+
+# Metadata key recording the ETag of the master a derivative was made from.
+SOURCE_ETAG_METADATA_KEY = "source-etag"
+
+MASTER_NAME_RE = re_compile(r"^(?P<track>[0-9]{2})\.flac$")
+
+# Outcomes of transcoding a master to one format.
+STATUS_TRANSCODED = "transcoded"
+STATUS_SKIPPED = "skipped"
+STATUS_FAILED = "failed"
+
+log = getLogger(__name__)
+
+class DerivativeFormat(NamedTuple):
+    """
+    A lossy format masters can be transcoded to, and the ffmpeg output
+    options that produce it. The output must not need seeking, since it is
+    uploaded as it is written.
+    """
+    name: str
+    extension: str
+    content_type: str
+    ffmpeg_options: Tuple[str, ...]
+
+DERIVATIVE_FORMATS = {
+    "aac": DerivativeFormat(
+        "aac", "m4a", "audio/mp4", (
+            "-c:a", "aac", "-b:a", "256k",
+            "-movflags", "+frag_keyframe+empty_moov", "-f", "ipod")),
+    # CBR, since the VBR header can't be written without seeking back.
+    "mp3": DerivativeFormat(
+        "mp3", "mp3", "audio/mpeg", (
+            "-c:a", "libmp3lame", "-b:a", "320k", "-id3v2_version", "3",
+            "-f", "mp3")),
+}
+
+def transcoder_available() -> bool:
+    """
+    Indicates whether ffmpeg is installed.
+    """
+    return which("ffmpeg") is not None
+
+class TranscodeResult(NamedTuple):
+    """
+    The outcome of transcoding one master to one format.
+    """
+    source: str
+    key: str
+    status: str
+    detail: str
+    bytes_read: int
+    bytes_written: int
+
+class TranscodeReport(NamedTuple):
+    """
+    Totals for a transcoding run.
+    """
+    masters: int
+    transcoded: int
+    skipped: int
+    bytes_read: int
+    bytes_written: int
+    failures: List[TranscodeResult]
+
+class Transcoder:
+    """
+    Transcode the FLAC masters stored under a bucket prefix. The S3 client's
+    connection pool should hold at least max_workers connections.
+    """
+
+    def __init__(
+            self, s3_client: Any, bucket_name: str, prefix: str,
+            formats: Sequence[DerivativeFormat],
+            max_workers: int = DEFAULT_TRANSCODE_WORKERS,
+            part_size: int = DEFAULT_MULTIPART_CHUNKSIZE) -> None:
+        super(Transcoder, self).__init__()
+        if not formats:
+            raise ValueError("No derivative formats specified")
+
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.formats = list(formats)
+        self.max_workers = max_workers
+        self.part_size = part_size
+
+    def list_masters(self) -> Tuple[Dict[str, List[Tuple[str, str]]], Set[str]]:
+        """
+        List the bucket prefix once, returning the (key, ETag) of each master
+        by disc, and the set of every key present.
+        """
+        masters: Dict[str, List[Tuple[str, str]]] = {}
+        keys: Set[str] = set()
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+                Bucket=self.bucket_name, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                keys.add(obj["Key"])
+                disc_id, _, name = obj["Key"][len(self.prefix):].partition("/")
+                if MASTER_NAME_RE.match(name):
+                    masters.setdefault(disc_id, []).append(
+                        (obj["Key"], obj["ETag"].strip('"')))
+        return masters, keys
+
+    def run(self, disc_ids: Optional[Iterable[str]] = None) -> TranscodeReport:
+        """
+        Transcode every master in the bucket, or only those of the discs in
+        disc_ids, to every format whose derivative is missing or stale.
+        """
+        started = monotonic()
+        masters, keys = self.list_masters()
+        if disc_ids is not None:
+            wanted = set(disc_ids)
+            for disc_id in sorted(wanted - set(masters)):
+                log.warning("No FLAC masters found for disc %s", disc_id)
+            masters = {
+                disc_id: sources for disc_id, sources in masters.items()
+                if disc_id in wanted}
+
+        jobs = [
+            (key, etag, fmt)
+            for disc_id in sorted(masters)
+            for key, etag in sorted(masters[disc_id])
+            for fmt in self.formats]
+        log.info("Transcoding %d masters on %d discs in s3://%s/%s to %s",
+                 sum(len(sources) for sources in masters.values()),
+                 len(masters), self.bucket_name, self.prefix,
+                 ", ".join(fmt.name for fmt in self.formats))
+
+        with ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="Transcoder") as executor:
+            results = list(executor.map(
+                lambda job: self.transcode(
+                    job[0], job[1], job[2],
+                    self.derivative_key(job[0], job[2]) in keys),
+                jobs))
+
+        report = TranscodeReport(
+            masters=sum(len(sources) for sources in masters.values()),
+            transcoded=sum(
+                1 for result in results if result.status == STATUS_TRANSCODED),
+            skipped=sum(
+                1 for result in results if result.status == STATUS_SKIPPED),
+            bytes_read=sum(result.bytes_read for result in results),
+            bytes_written=sum(result.bytes_written for result in results),
+            failures=[
+                result for result in results
+                if result.status == STATUS_FAILED])
+        log.info("Made %d derivatives (%d already done) in %.0f s: %d bytes "
+                 "read, %d bytes written", report.transcoded, report.skipped,
+                 monotonic() - started, report.bytes_read,
+                 report.bytes_written)
+        return report
+
+    @staticmethod
+    def derivative_key(source: str, fmt: DerivativeFormat) -> str:
+        """
+        Return the key of a master's derivative in the specified format.
+        """
+        return f"{source[:-len('.flac')]}.{fmt.extension}"
+
+    def is_complete(self, key: str, source_etag: str) -> bool:
+        """
+        Indicates whether a derivative exists and was made from the current
+        version of its master.
+        """
+        try:
+            head = self.s3.head_object(Bucket=self.bucket_name, Key=key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey"):
+                return False
+            raise
+        marker = head.get("Metadata", {}).get(SOURCE_ETAG_METADATA_KEY)
+        return marker == source_etag
+
+    def transcode(
+            self, source: str, source_etag: str, fmt: DerivativeFormat,
+            exists: bool = True) -> TranscodeResult:
+        """
+        Transcode one master to one format, unless the derivative is already
+        complete. exists may be False if the derivative is known not to exist.
+        """
+        key = self.derivative_key(source, fmt)
+        try:
+            if exists and self.is_complete(key, source_etag):
+                return TranscodeResult(source, key, STATUS_SKIPPED, "", 0, 0)
+
+            bytes_read, bytes_written = self._transcode(
+                source, source_etag, key, fmt)
+        except (BotoCoreError, ClientError, IOError) as e:
+            log.error("Unable to transcode s3://%s/%s to %s: %s",
+                      self.bucket_name, source, fmt.name, e)
+            return TranscodeResult(source, key, STATUS_FAILED, str(e), 0, 0)
+
+        log.info("Transcoded s3://%s/%s to %s (%d bytes)", self.bucket_name,
+                 source, key, bytes_written)
+        return TranscodeResult(
+            source, key, STATUS_TRANSCODED, "", bytes_read, bytes_written)
+
+    def _transcode(
+            self, source: str, source_etag: str, key: str,
+            fmt: DerivativeFormat) -> Tuple[int, int]:
+        """
+        Stream a master through ffmpeg to S3. Returns the bytes read and
+        written.
+        """
+        response = self.s3.get_object(
+            Bucket=self.bucket_name, Key=source, IfMatch=f'"{source_etag}"')
+        body = response["Body"]
+        cmd = [
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-threads", "1",
+            "-f", "flac", "-i", "pipe:0", "-map", "0:a", "-map_metadata", "0"]
+        cmd.extend(fmt.ffmpeg_options)
+        cmd.append("pipe:1")
+
+        with TemporaryFile() as errors, Popen(
+                cmd, stdin=PIPE, stdout=PIPE, stderr=errors) as proc:
+            read = [0]
+            feed_errors: List[BaseException] = []
+
+            def feed() -> None:
+                try:
+                    for block in iter(
+                            lambda: body.read(STREAM_BLOCK_BYTES), b""):
+                        proc.stdin.write(block)
+                        read[0] += len(block)
+                except (BotoCoreError, IOError) as e:
+                    feed_errors.append(e)
+                finally:
+                    body.close()
+                    try:
+                        proc.stdin.close()
+                    except BrokenPipeError:
+                        pass
+
+            def finish() -> None:
+                returncode = proc.wait()
+                feeder.join()
+                if returncode != 0:
+                    errors.seek(0)
+                    raise IOError(
+                        f"ffmpeg exited with status {returncode}: "
+                        f"{errors.read().decode('utf-8', 'replace').strip()}")
+                if feed_errors:
+                    raise IOError(f"Unable to read {source}: {feed_errors[0]}")
+
+            feeder = Thread(target=feed, name=f"Feed-{key}", daemon=True)
+            feeder.start()
+            try:
+                written = self._upload(key, proc.stdout, fmt, source_etag, finish)
+            finally:
+                proc.kill()
+                feeder.join()
+
+        return read[0], written
+
+    def _upload(
+            self, key: str, output: IO[bytes], fmt: DerivativeFormat,
+            source_etag: str, finish: Callable[[], None]) -> int:
+        """
+        Upload a stream a part at a time. finish() is called once the stream
+        ends and raises if the output is not good; the upload is only
+        completed if it returns. Returns the bytes written.
+        """
+        extra_args = {
+            "ContentType": fmt.content_type,
+            "Metadata": {SOURCE_ETAG_METADATA_KEY: source_etag},
+            "ChecksumAlgorithm": "SHA256"}
+        buffer = bytearray()
+        upload_id: Optional[str] = None
+        parts: List[Dict[str, Any]] = []
+        written = 0
+
+        def upload_part(data: bytes) -> None:
+            nonlocal upload_id, written
+            if upload_id is None:
+                upload_id = self.s3.create_multipart_upload(
+                    Bucket=self.bucket_name, Key=key, **extra_args)["UploadId"]
+            response = self.s3.upload_part(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                PartNumber=len(parts) + 1, Body=data,
+                ChecksumAlgorithm="SHA256")
+            parts.append({
+                "PartNumber": len(parts) + 1, "ETag": response["ETag"],
+                "ChecksumSHA256": response["ChecksumSHA256"]})
+            written += len(data)
+
+        try:
+            for chunk in iter(lambda: output.read(STREAM_BLOCK_BYTES), b""):
+                buffer += chunk
+                if len(buffer) >= self.part_size:
+                    upload_part(bytes(buffer))
+                    buffer = bytearray()
+
+            # Nothing more is uploaded if the encode failed.
+            finish()
+            if upload_id is None:
+                self.s3.put_object(
+                    Bucket=self.bucket_name, Key=key, Body=bytes(buffer),
+                    **extra_args)
+                return len(buffer)
+
+            if buffer:
+                upload_part(bytes(buffer))
+            self.s3.complete_multipart_upload(
+                Bucket=self.bucket_name, Key=key, UploadId=upload_id,
+                MultipartUpload={"Parts": parts})
+            return written
+        except BaseException:
+            if upload_id is not None:
+                try:
+                    self.s3.abort_multipart_upload(
+                        Bucket=self.bucket_name, Key=key, UploadId=upload_id)
+                except (BotoCoreError, ClientError):
+                    log.warning("Unable to abort upload %s of s3://%s/%s",
+                                upload_id, self.bucket_name, key,
+                                exc_info=True)
+            raise
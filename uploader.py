@@ -0,0 +1,276 @@
+"""\
+Shared S3 upload subsystem for the ripper.
+
+Every object the ripper writes goes through a single S3Uploader, which owns
+one boto3 transfer manager. The transfer manager's TransferConfig caps the
+number of concurrent S3 requests and the total bandwidth across all uploads,
+and the botocore connection pool is sized to match so requests never wait on
+(or overflow) the pool. Uploads are dispatched in priority order (audio
+before metadata before art before logs) and failed uploads are retried with
+exponentially increasing, jittered delays.
+"""
+
+from concurrent.futures import Future
+from enum import IntEnum
+from io import BytesIO
+from itertools import count
+from logging import getLogger
+from queue import PriorityQueue
+from random import uniform
+from threading import Condition, Thread, Timer
+from typing import Any, Dict, Optional, Tuple, Union
+
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+from boto3.session import Session
+from botocore.config import Config
+from s3transfer.subscribers import BaseSubscriber
+
+# pylint: disable=C0103,R0902,R0913
+
+DEFAULT_MAX_CONCURRENCY = 10
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_RETRY_BASE_DELAY = 1.0
+DEFAULT_RETRY_MAX_DELAY = 60.0
+MB = 1024 * 1024
+DEFAULT_MULTIPART_THRESHOLD = 16 * MB
+DEFAULT_MULTIPART_CHUNKSIZE = 16 * MB
+
+# Checksum S3 computes and stores with each object (and each part of a
+# multipart upload); the verifier compares against it without downloading.
+DEFAULT_CHECKSUM_ALGORITHM = "SHA256"
+
+# Connections beyond the transfer concurrency for the occasional non-transfer
+# call (HeadObject, ListObjects, etc.) made through the same client.
+EXTRA_POOL_CONNECTIONS = 2
+
+log = getLogger(__name__)
+
+class UploadPriority(IntEnum):
+    """
+    Upload priority; lower values are uploaded first.
+    """
+    audio = 0
+    metadata = 1
+    art = 2
+    log = 3
+
+class UploadJob:
+    """
+    A single object to be uploaded.
+    """
+    def __init__(
+            self, key: str, body: Union[bytes, str], priority: UploadPriority,
+            extra_args: Dict[str, Any]) -> None:
+        super(UploadJob, self).__init__()
+        self.key = key
+        self.body = body
+        self.priority = priority
+        self.extra_args = extra_args
+        self.attempts = 0
+        self.future: "Future[str]" = Future()
+
+    @property
+    def size(self) -> Optional[int]:
+        """
+        The size of the body, if it is held in memory.
+        """
+        return len(self.body) if isinstance(self.body, bytes) else None
+
+class _DoneSubscriber(BaseSubscriber):
+    """
+    Notifies the uploader when a transfer finishes.
+    """
+    def __init__(self, uploader: "S3Uploader", job: UploadJob) -> None:
+        super(_DoneSubscriber, self).__init__()
+        self.uploader = uploader
+        self.job = job
+
+    def on_done(self, future, **kwargs) -> None:
+        # pylint: disable=W0221
+        self.uploader._transfer_done(self.job, future) # pylint: disable=W0212
+
+class S3Uploader:
+    """
+    Upload objects to a single S3 bucket with a shared concurrency and
+    bandwidth budget, priority ordering, and jittered retries.
+    """
+    def __init__(
+            self, boto: Session, bucket_name: str,
+            max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+            max_bandwidth: Optional[int] = None,
+            max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+            multipart_threshold: int = DEFAULT_MULTIPART_THRESHOLD,
+            multipart_chunksize: int = DEFAULT_MULTIPART_CHUNKSIZE,
+            retry_base_delay: float = DEFAULT_RETRY_BASE_DELAY,
+            retry_max_delay: float = DEFAULT_RETRY_MAX_DELAY,
+            checksum_algorithm: Optional[str] = DEFAULT_CHECKSUM_ALGORITHM
+    ) -> None:
+        super(S3Uploader, self).__init__()
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+
+        self.bucket_name = bucket_name
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.checksum_algorithm = checksum_algorithm
+
+        # One pooled connection per concurrent request, so the transfer
+        # manager's threads never contend for (or overflow) the pool.
+        self.client = boto.client("s3", config=Config(
+            max_pool_connections=max_concurrency + EXTRA_POOL_CONNECTIONS,
+            retries={"mode": "standard"}))
+        self.transfer_config = TransferConfig(
+            multipart_threshold=multipart_threshold,
+            multipart_chunksize=multipart_chunksize,
+            max_concurrency=max_concurrency,
+            max_bandwidth=max_bandwidth)
+        self.manager = create_transfer_manager(
+            self.client, self.transfer_config)
+
+        self._queue: "PriorityQueue[Tuple[int, int, UploadJob]]" = (
+            PriorityQueue())
+        self._sequence = count()
+        self._condition = Condition()
+        self._in_flight = 0
+        self._pending = 0
+        self._shutdown = False
+        self._dispatcher = Thread(
+            target=self._dispatch, name="S3UploadDispatcher", daemon=True)
+        self._dispatcher.start()
+
+    def upload(
+            self, key: str, body: Union[bytes, str],
+            priority: UploadPriority = UploadPriority.audio,
+            content_type: Optional[str] = None,
+            acl: Optional[str] = "private",
+            metadata: Optional[Dict[str, str]] = None) -> "Future[str]":
+        """
+        Queue an object for upload. body is either the object contents or the
+        name of a file to upload. Returns a future that resolves to the key
+        once the object has been written, or raises the last error after all
+        attempts have failed.
+        """
+        extra_args: Dict[str, Any] = {}
+        if content_type is not None:
+            extra_args["ContentType"] = content_type
+        if acl is not None:
+            extra_args["ACL"] = acl
+        if metadata:
+            extra_args["Metadata"] = metadata
+        if self.checksum_algorithm is not None:
+            extra_args["ChecksumAlgorithm"] = self.checksum_algorithm
+
+        job = UploadJob(key, body, priority, extra_args)
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Uploader has been shut down")
+            self._pending += 1
+        self._enqueue(job)
+        return job.future
+
+    def wait(self) -> None:
+        """
+        Block until every queued upload has finished (successfully or not).
+        """
+        with self._condition:
+            while self._pending:
+                self._condition.wait()
+
+    def shutdown(self, wait: bool = True) -> None:
+        """
+        Release the transfer manager. If wait is True, queued uploads are
+        finished first; otherwise uploads in flight are cancelled and queued
+        ones are abandoned.
+        """
+        if wait:
+            self.wait()
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        self._dispatcher.join()
+        self.manager.shutdown(cancel=not wait)
+
+    def _enqueue(self, job: UploadJob) -> None:
+        with self._condition:
+            self._queue.put((int(job.priority), next(self._sequence), job))
+            self._condition.notify_all()
+
+    def _dispatch(self) -> None:
+        """
+        Hand queued jobs to the transfer manager in priority order, keeping
+        at most max_concurrency transfers in flight.
+        """
+        while True:
+            with self._condition:
+                while not self._shutdown and (
+                        self._queue.empty() or
+                        self._in_flight >= self.max_concurrency):
+                    self._condition.wait()
+
+                if self._shutdown:
+                    return
+
+                _, _, job = self._queue.get_nowait()
+                self._in_flight += 1
+
+            job.attempts += 1
+            body = BytesIO(job.body) if isinstance(job.body, bytes) else job.body
+            log.debug("Uploading s3://%s/%s (priority=%s, attempt %d)",
+                      self.bucket_name, job.key, job.priority.name,
+                      job.attempts)
+            try:
+                self.manager.upload(
+                    body, self.bucket_name, job.key,
+                    extra_args=job.extra_args,
+                    subscribers=[_DoneSubscriber(self, job)])
+            except Exception as e: # pylint: disable=W0703
+                self._finish_attempt(job, e)
+
+    def _transfer_done(self, job: UploadJob, transfer_future) -> None:
+        try:
+            transfer_future.result()
+        except Exception as e: # pylint: disable=W0703
+            self._finish_attempt(job, e)
+        else:
+            self._finish_attempt(job, None)
+
+    def _finish_attempt(
+            self, job: UploadJob, error: Optional[BaseException]) -> None:
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+        if error is None:
+            log.debug("Upload of s3://%s/%s succeeded", self.bucket_name,
+                      job.key)
+            self._complete(job, None)
+            return
+
+        if job.attempts >= self.max_attempts:
+            log.error("Upload of s3://%s/%s failed after %d attempts",
+                      self.bucket_name, job.key, job.attempts,
+                      exc_info=error)
+            self._complete(job, error)
+            return
+
+        # Full jitter: wait a random time up to the exponential backoff.
+        delay = uniform(0, min(
+            self.retry_max_delay,
+            self.retry_base_delay * 2 ** (job.attempts - 1)))
+        log.warning("Upload of s3://%s/%s failed (%s); retrying in %.1fs",
+                    self.bucket_name, job.key, error, delay)
+        timer = Timer(delay, self._enqueue, (job,))
+        timer.daemon = True
+        timer.start()
+
+    def _complete(self, job: UploadJob, error: Optional[BaseException]) -> None:
+        if error is None:
+            job.future.set_result(job.key)
+        else:
+            job.future.set_exception(error)
+
+        with self._condition:
+            self._pending -= 1
+            self._condition.notify_all()
@@ -0,0 +1,425 @@
+"""\
+Integrity verification of the collection stored in S3.
+
+Once a disc has been uploaded nothing reads it again, so corruption or an
+accidental overwrite would go unnoticed until someone tried to play it.
+CollectionVerifier audits every object under the bucket prefix against the
+SHA-256 recorded for it, cheaply where possible:
+
+  * Objects are uploaded with S3's SHA256 checksum algorithm and the hash of
+    the spooled file in their sha256 metadata. For a single-part object the
+    checksum S3 computed on arrival is compared with that hash using only a
+    HEAD request.
+  * Multipart objects carry a composite checksum (the hash of the part
+    hashes). Once the object has been read in full and matched, the composite
+    is recorded and later audits compare it with a HEAD request as well.
+  * Everything else -- objects stored before checksums were enabled, or whose
+    checksum has changed -- is read with ranged GETs aligned to the upload
+    part size and hashed as it streams in. An object with no recorded hash is
+    trusted on first read and its hash recorded for later audits.
+
+Discs are verified in parallel on a worker pool, least recently verified
+first. The time each disc last passed is kept in a SQLite state database, so
+an audit can be stopped at a time limit and the next run picks up where it
+left off; discs that failed stay at the head of the queue.
+"""
+
+from base64 import b64decode, b64encode
+from concurrent.futures import (
+    FIRST_COMPLETED, Future, ThreadPoolExecutor, wait as futures_wait)
+from hashlib import sha256
+from logging import getLogger
+import sqlite3
+from threading import Lock
+from time import monotonic, time
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Set, Tuple
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from spool import SHA256_METADATA_KEY
+from uploader import DEFAULT_MULTIPART_CHUNKSIZE
+
+# pylint: disable=C0103,R0902,R0913,R0914
+
+DEFAULT_VERIFY_WORKERS = 64
+
+# Discs verified more recently than this are skipped; 30 days.
+DEFAULT_MAX_AGE = 30 * 86400.0
+
+# Bytes read from a GET response at a time.
+STREAM_BLOCK_BYTES = 1024 * 1024
+
+# Ways an object can pass verification.
+METHOD_CHECKSUM = "checksum"
+METHOD_DOWNLOAD = "download"
+METHOD_RECORDED = "recorded"
+
+log = getLogger(__name__)
+
+class ObjectResult(NamedTuple):
+    """
+    The outcome of verifying one object. ok is None if the object could not
+    be read (it will be retried on the next run), and False if its contents
+    do not match the recorded hash or it is missing.
+    """
+    key: str
+    ok: Optional[bool]
+    method: Optional[str]
+    detail: str
+    etag: Optional[str]
+    size: int
+    sha256: Optional[str]
+    s3_checksum: Optional[str]
+    bytes_read: int
+
+class VerifyReport(NamedTuple):
+    """
+    Totals for a verification run.
+    """
+    discs: int
+    discs_passed: int
+    objects: int
+    bytes_read: int
+    failures: List[ObjectResult]
+    remaining: int
+
+def composite_checksum(part_digests: List[bytes]) -> str:
+    """
+    Return the checksum S3 reports for a multipart object with the given
+    part SHA-256 digests.
+    """
+    combined = sha256(b"".join(part_digests)).digest()
+    return f"{b64encode(combined).decode('ascii')}-{len(part_digests)}"
+
+class VerificationState:
+    """
+    SQLite record of the last verified state of each object and disc.
+    """
+
+    def __init__(self, filename: str) -> None:
+        super(VerificationState, self).__init__()
+        self.lock = Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        with self.lock, self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS objects(
+                    s3_key TEXT PRIMARY KEY,
+                    disc_id TEXT NOT NULL,
+                    etag TEXT,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT,
+                    s3_checksum TEXT,
+                    verified REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS objects_disc_id
+                    ON objects(disc_id);
+                CREATE TABLE IF NOT EXISTS discs(
+                    disc_id TEXT PRIMARY KEY,
+                    last_verified REAL,
+                    last_checked REAL NOT NULL,
+                    failures INTEGER NOT NULL);""")
+
+    def last_verified(self) -> Dict[str, float]:
+        """
+        Return the time each disc last passed verification. Discs that have
+        never passed are omitted.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT disc_id, last_verified FROM discs "
+                "WHERE last_verified IS NOT NULL").fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def get_objects(self, disc_id: str) -> Dict[str, Tuple[str, str, str]]:
+        """
+        Return the (etag, sha256, s3_checksum) last verified for each object
+        belonging to a disc, keyed by S3 key.
+        """
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT s3_key, etag, sha256, s3_checksum FROM objects "
+                "WHERE disc_id=?", (disc_id,)).fetchall()
+        return {row[0]: (row[1], row[2], row[3]) for row in rows}
+
+    def record_disc(
+            self, disc_id: str, results: List[ObjectResult],
+            checked: float) -> None:
+        """
+        Record the objects of a disc that passed and the outcome for the
+        disc. The disc's last verified time advances only if every object
+        passed.
+        """
+        failures = sum(1 for result in results if not result.ok)
+        with self.lock, self.db:
+            for result in results:
+                if not result.ok:
+                    continue
+                self.db.execute(
+                    "INSERT OR REPLACE INTO objects(s3_key, disc_id, etag, "
+                    "size, sha256, s3_checksum, verified) "
+                    "VALUES(?, ?, ?, ?, ?, ?, ?)",
+                    (result.key, disc_id, result.etag, result.size,
+                     result.sha256, result.s3_checksum, checked))
+            self.db.execute(
+                "INSERT INTO discs(disc_id, last_verified, last_checked, "
+                "failures) VALUES(?, ?, ?, ?) "
+                "ON CONFLICT(disc_id) DO UPDATE SET "
+                "last_verified=COALESCE(excluded.last_verified, "
+                "last_verified), last_checked=excluded.last_checked, "
+                "failures=excluded.failures",
+                (disc_id, None if failures else checked, checked, failures))
+
+    def close(self) -> None:
+        """
+        Close the database.
+        """
+        with self.lock:
+            self.db.close()
+
+class CollectionVerifier:
+    """
+    Verify the objects stored under a bucket prefix against their recorded
+    SHA-256 hashes. The S3 client's connection pool should hold at least
+    max_workers connections.
+    """
+
+    def __init__(
+            self, s3_client: Any, bucket_name: str, prefix: str,
+            state: VerificationState,
+            max_workers: int = DEFAULT_VERIFY_WORKERS,
+            part_size: int = DEFAULT_MULTIPART_CHUNKSIZE) -> None:
+        super(CollectionVerifier, self).__init__()
+        self.s3 = s3_client
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.state = state
+        self.max_workers = max_workers
+        self.part_size = part_size
+
+    def list_discs(self) -> Dict[str, List[Dict[str, Any]]]:
+        """
+        List the bucket prefix once, returning the objects of each disc.
+        """
+        discs: Dict[str, List[Dict[str, Any]]] = {}
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(
+                Bucket=self.bucket_name, Prefix=self.prefix):
+            for obj in page.get("Contents", []):
+                disc_id, _, name = obj["Key"][len(self.prefix):].partition("/")
+                if name:
+                    discs.setdefault(disc_id, []).append(obj)
+        return discs
+
+    def run(self, max_age: float = DEFAULT_MAX_AGE,
+            time_limit: Optional[float] = None) -> VerifyReport:
+        """
+        Verify every disc that has not passed within max_age seconds, least
+        recently verified first. If time_limit is given, no disc is started
+        after that many seconds; the rest are left for the next run.
+        """
+        started = monotonic()
+        now = time()
+        last_verified = self.state.last_verified()
+        discs = self.list_discs()
+        due = sorted(
+            (disc_id for disc_id in discs
+             if now - last_verified.get(disc_id, 0.0) >= max_age),
+            key=lambda disc_id: last_verified.get(disc_id, 0.0))
+        log.info("Verifying %d of %d discs in s3://%s/%s", len(due),
+                 len(discs), self.bucket_name, self.prefix)
+
+        objects = bytes_read = discs_done = discs_passed = 0
+        failures: List[ObjectResult] = []
+        pending: Set["Future[List[ObjectResult]]"] = set()
+        queue = iter(due)
+
+        with ThreadPoolExecutor(
+                max_workers=self.max_workers,
+                thread_name_prefix="Verifier") as executor:
+            # Keep the pool busy without queueing every disc up front, so a
+            # time limit stops the run promptly.
+            while True:
+                while len(pending) < 2 * self.max_workers and (
+                        time_limit is None or
+                        monotonic() - started < time_limit):
+                    disc_id = next(queue, None)
+                    if disc_id is None:
+                        break
+                    pending.add(executor.submit(
+                        self.verify_disc, disc_id, discs[disc_id]))
+
+                if not pending:
+                    break
+
+                done, pending = futures_wait(
+                    pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results = future.result()
+                    discs_done += 1
+                    objects += len(results)
+                    bytes_read += sum(result.bytes_read for result in results)
+                    disc_failures = [
+                        result for result in results if not result.ok]
+                    failures.extend(disc_failures)
+                    if not disc_failures:
+                        discs_passed += 1
+
+                if time_limit is not None and (
+                        monotonic() - started >= time_limit):
+                    # Let the discs in flight finish but start no more.
+                    queue = iter(())
+
+        report = VerifyReport(
+            discs=discs_done, discs_passed=discs_passed, objects=objects,
+            bytes_read=bytes_read, failures=failures,
+            remaining=len(due) - discs_done)
+        log.info("Verified %d discs (%d passed), %d objects, %d bytes read in "
+                 "%.0f s; %d discs remaining", report.discs,
+                 report.discs_passed, report.objects, report.bytes_read,
+                 monotonic() - started, report.remaining)
+        return report
+
+    def verify_disc(
+            self, disc_id: str,
+            objects: List[Mapping[str, Any]]) -> List[ObjectResult]:
+        """
+        Verify the objects of a disc and record the outcome.
+        """
+        checked = time()
+        known = self.state.get_objects(disc_id)
+        results = [
+            self.verify_object(obj["Key"], known.get(obj["Key"]))
+            for obj in objects]
+
+        # An object that passed before but is no longer listed was deleted.
+        listed = {obj["Key"] for obj in objects}
+        for key in sorted(set(known) - listed):
+            results.append(ObjectResult(
+                key=key, ok=False, method=None, detail="missing", etag=None,
+                size=0, sha256=None, s3_checksum=None, bytes_read=0))
+
+        for result in results:
+            if result.ok is None:
+                log.warning("Unable to verify s3://%s/%s: %s",
+                            self.bucket_name, result.key, result.detail)
+            elif not result.ok:
+                log.error("s3://%s/%s failed verification: %s",
+                          self.bucket_name, result.key, result.detail)
+
+        self.state.record_disc(disc_id, results, checked)
+        return results
+
+    def verify_object(
+            self, key: str,
+            known: Optional[Tuple[str, str, str]] = None) -> ObjectResult:
+        """
+        Verify one object. known is the (etag, sha256, s3_checksum) recorded
+        when it last passed, if it has.
+        """
+        try:
+            head = self.s3.head_object(
+                Bucket=self.bucket_name, Key=key, ChecksumMode="ENABLED")
+        except (BotoCoreError, ClientError) as e:
+            return ObjectResult(
+                key=key, ok=None, method=None, detail=str(e), etag=None,
+                size=0, sha256=None, s3_checksum=None, bytes_read=0)
+
+        etag = head.get("ETag")
+        size = int(head.get("ContentLength", 0))
+        s3_checksum = head.get("ChecksumSHA256")
+        if known is not None and known[0] != etag:
+            # The object has been replaced (e.g. retagged) since it was
+            # recorded; treat it as never having been verified.
+            known = None
+        expected = head.get("Metadata", {}).get(SHA256_METADATA_KEY)
+        if expected is None and known is not None:
+            expected = known[1]
+
+        def result(ok: Optional[bool], method: Optional[str], detail: str,
+                   digest: Optional[str] = expected,
+                   bytes_read: int = 0) -> ObjectResult:
+            return ObjectResult(
+                key=key, ok=ok, method=method, detail=detail, etag=etag,
+                size=size, sha256=digest, s3_checksum=s3_checksum,
+                bytes_read=bytes_read)
+
+        if s3_checksum is not None and expected is not None:
+            if "-" not in s3_checksum:
+                # S3 hashed the whole object as it arrived.
+                actual = b64decode(s3_checksum).hex()
+                if actual == expected:
+                    return result(True, METHOD_CHECKSUM, "")
+                return result(
+                    False, METHOD_CHECKSUM,
+                    f"S3 checksum {actual} does not match recorded {expected}")
+
+            if known is not None and known[2] == s3_checksum:
+                return result(True, METHOD_CHECKSUM, "")
+
+        try:
+            digest, part_digests = self._hash_object(key, size, etag)
+        except (BotoCoreError, ClientError, IOError) as e:
+            return result(None, None, str(e))
+
+        if expected is not None and digest != expected:
+            return result(
+                False, METHOD_DOWNLOAD,
+                f"Content hash {digest} does not match recorded {expected}",
+                digest, size)
+
+        if s3_checksum is not None:
+            count = s3_checksum.partition("-")[2]
+            if not count:
+                matches = b64decode(s3_checksum).hex() == digest
+            elif int(count) == len(part_digests):
+                matches = composite_checksum(part_digests) == s3_checksum
+            else:
+                # Uploaded with a different part size; nothing to compare.
+                matches = True
+
+            if not matches:
+                return result(
+                    False, METHOD_DOWNLOAD,
+                    f"Content does not match S3 checksum {s3_checksum}",
+                    digest, size)
+
+        return result(
+            True, METHOD_DOWNLOAD if expected else METHOD_RECORDED, "",
+            digest, size)
+
+    def _hash_object(
+            self, key: str, size: int,
+            etag: Optional[str]) -> Tuple[str, List[bytes]]:
+        """
+        Read an object with ranged GETs of part_size bytes, returning its
+        SHA-256 and the digest of each part. IfMatch ensures every range comes
+        from the same version of the object.
+        """
+        hasher = sha256()
+        part_digests: List[bytes] = []
+
+        for start in range(0, size, self.part_size):
+            end = min(start + self.part_size, size) - 1
+            kw: Dict[str, Any] = {}
+            if etag is not None:
+                kw["IfMatch"] = etag
+            response = self.s3.get_object(
+                Bucket=self.bucket_name, Key=key, Range=f"bytes={start}-{end}",
+                **kw)
+            body = response["Body"]
+            part_hasher = sha256()
+            received = 0
+            try:
+                for block in iter(lambda: body.read(STREAM_BLOCK_BYTES), b""):
+                    hasher.update(block)
+                    part_hasher.update(block)
+                    received += len(block)
+            finally:
+                body.close()
+
+            if received != end + 1 - start:
+                raise IOError(
+                    f"Short read at byte {start}: expected "
+                    f"{end + 1 - start} bytes, got {received}")
+            part_digests.append(part_hasher.digest())
+
+        return hasher.hexdigest(), part_digests